@@ -2,48 +2,85 @@ import gradio as gr
 from ultralytics import YOLO
 from pathlib import Path
 import json
+import os
+import queue
+import threading
 
-# Load model
+from backend.label_registry import LabelRegistry
+
+# torch (default), onnx or openvino - same switch as the Flask backend
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch").lower()
+MODELS_DIR = Path("backend/models")
 MODEL_PATH = Path("backend/results/weights/best.pt")
-if MODEL_PATH.exists():
-    model = YOLO(str(MODEL_PATH))
-    print(f"✅ Loaded trained model from {MODEL_PATH}")
-else:
-    model = YOLO("yolov8s-cls.pt")
-    print("⚠️ Using base model (no trained weights found)")
-
-# Load trained labels
+
+def resolve_model():
+    """Active registry version (exported runtime if verified), else legacy weights"""
+    registry_file = MODELS_DIR / "registry.json"
+    if registry_file.exists():
+        with open(registry_file, 'r') as f:
+            version = json.load(f).get("active")
+        if version:
+            version_dir = MODELS_DIR / version
+            with open(version_dir / "meta.json", 'r') as f:
+                runtimes = json.load(f).get("runtimes") or {}
+            exported = {
+                "onnx": version_dir / "weights.onnx",
+                "openvino": version_dir / "weights_openvino_model"
+            }.get(INFERENCE_BACKEND)
+            if exported is not None and exported.exists() and runtimes.get(INFERENCE_BACKEND, {}).get("parity_ok"):
+                return YOLO(str(exported), task="classify"), f"{version} ({INFERENCE_BACKEND})"
+            return YOLO(str(version_dir / "weights.pt")), version
+    if MODEL_PATH.exists():
+        return YOLO(str(MODEL_PATH)), str(MODEL_PATH)
+    return None, None
+
+# Gradio queue settings. Each click is queued and up to GRADIO_MAX_BATCH_SIZE
+# waiting images go through the model in one forward pass; every concurrent
+# batch gets its own model copy, since a YOLO predictor is not thread-safe.
+GRADIO_MAX_BATCH_SIZE = int(os.environ.get("GRADIO_MAX_BATCH_SIZE", 16))
+GRADIO_PREDICT_CONCURRENCY = int(os.environ.get("GRADIO_PREDICT_CONCURRENCY", 1))
+GRADIO_DEFAULT_CONCURRENCY = int(os.environ.get("GRADIO_DEFAULT_CONCURRENCY", 4))
+GRADIO_QUEUE_MAX_SIZE = int(os.environ.get("GRADIO_QUEUE_MAX_SIZE", 128))
+
+def load_model():
+    model, model_source = resolve_model()
+    if model is not None:
+        print(f"✅ Loaded trained model from {model_source}")
+    else:
+        model = YOLO("yolov8s-cls.pt")
+        print("⚠️ Using base model (no trained weights found)")
+    return model
+
+# Load model
+model_pool = queue.Queue()
+for _ in range(max(1, GRADIO_PREDICT_CONCURRENCY)):
+    model_pool.put(load_model())
+
+# Trained labels, re-read whenever the backend updates the file
 LABELS_FILE = Path("backend/trained_labels.json")
-trained_labels = []
-if LABELS_FILE.exists():
-    with open(LABELS_FILE, 'r') as f:
-        trained_labels = json.load(f)
-
-def predict_leaf(image):
-    """Predict leaf type from image"""
-    if image is None:
-        return "Please upload an image", None
+label_registry = LabelRegistry(LABELS_FILE)
+
+# Batch counters shown in the UI
+stats_lock = threading.Lock()
+stats = {"batches": 0, "images": 0, "last_batch_size": 0, "in_flight": 0}
+
+def format_result(result):
+    """Markdown summary and label dict for one classification result"""
+    top1_index = result.probs.top1
+    top1_conf = result.probs.top1conf.item()
+    class_name = result.names[top1_index]
     
-    try:
-        # Run prediction
-        results = model(image)
-        
-        # Get top prediction
-        top1_index = results[0].probs.top1
-        top1_conf = results[0].probs.top1conf.item()
-        class_name = results[0].names[top1_index]
-        
-        # Get all probabilities
-        probs_dict = {}
-        for i, prob in enumerate(results[0].probs.data):
-            if prob > 0.01:  # Only show >1% confidence
-                probs_dict[results[0].names[i]] = float(prob)
-        
-        # Sort by confidence
-        sorted_probs = dict(sorted(probs_dict.items(), key=lambda x: x[1], reverse=True))
-        
-        # Create result text
-        result_text = f"""
+    # Get all probabilities
+    probs_dict = {}
+    for i, prob in enumerate(result.probs.data):
+        if prob > 0.01:  # Only show >1% confidence
+            probs_dict[result.names[i]] = float(prob)
+    
+    # Sort by confidence
+    sorted_probs = dict(sorted(probs_dict.items(), key=lambda x: x[1], reverse=True))
+    
+    # Create result text
+    result_text = f"""
 ## 🌿 Prediction Result
 
 **Species:** {class_name.title()}  
@@ -51,16 +88,57 @@ def predict_leaf(image):
 
 ### All Predictions:
 """
-        for name, conf in list(sorted_probs.items())[:5]:
-            result_text += f"- **{name.title()}**: {conf * 100:.1f}%\n"
-        
-        return result_text, sorted_probs
-        
+    for name, conf in list(sorted_probs.items())[:5]:
+        result_text += f"- **{name.title()}**: {conf * 100:.1f}%\n"
+    
+    return result_text, sorted_probs
+
+def predict_leaf(images):
+    """Predict leaf types for a batch of images (one per queued request)"""
+    texts = ["Please upload an image"] * len(images)
+    probs = [None] * len(images)
+    valid = [i for i, image in enumerate(images) if image is not None]
+    if not valid:
+        return texts, probs
+    
+    with stats_lock:
+        stats["in_flight"] += len(valid)
+    model = model_pool.get()
+    try:
+        # One forward pass for the whole batch
+        results = model([images[i] for i in valid], verbose=False)
+        for i, result in zip(valid, results):
+            texts[i], probs[i] = format_result(result)
     except Exception as e:
-        return f"❌ Error: {str(e)}", None
+        for i in valid:
+            texts[i] = f"❌ Error: {str(e)}"
+    finally:
+        model_pool.put(model)
+        with stats_lock:
+            stats["in_flight"] -= len(valid)
+            stats["batches"] += 1
+            stats["images"] += len(valid)
+            stats["last_batch_size"] = len(valid)
+    
+    return texts, probs
+
+def get_queue_status_text():
+    """Queue depth and batching stats"""
+    waiting = None
+    try:
+        # Same numbers Gradio serves at /queue/status
+        waiting = demo._queue.get_status().queue_size
+    except Exception:
+        pass
+    with stats_lock:
+        average = stats["images"] / stats["batches"] if stats["batches"] else 0
+        text = (f"**Queue:** {waiting if waiting is not None else '?'} waiting · {stats['in_flight']} in progress · "
+                f"last batch {stats['last_batch_size']} · average batch {average:.1f}")
+    return text
 
 def get_trained_labels_text():
     """Get formatted text of trained labels"""
+    trained_labels = label_registry.labels()
     if trained_labels:
         return "**Trained leaf types:** " + ", ".join([l.title() for l in trained_labels])
     return "No trained models yet. Using base model."
@@ -72,7 +150,8 @@ with gr.Blocks(theme=gr.themes.Soft(), title="🌿 Leaf Classifier") as demo:
     Upload an image of a leaf to identify its species using AI-powered classification.
     """)
     
-    gr.Markdown(get_trained_labels_text())
+    labels_md = gr.Markdown(get_trained_labels_text())
+    queue_md = gr.Markdown(get_queue_status_text())
     
     with gr.Row():
         with gr.Column():
@@ -98,9 +177,19 @@ with gr.Blocks(theme=gr.themes.Soft(), title="🌿 Leaf Classifier") as demo:
     predict_btn.click(
         fn=predict_leaf,
         inputs=image_input,
-        outputs=[result_output, probs_output]
+        outputs=[result_output, probs_output],
+        batch=True,
+        max_batch_size=GRADIO_MAX_BATCH_SIZE,
+        concurrency_limit=GRADIO_PREDICT_CONCURRENCY
     )
     
+    # Refresh the queue line every few seconds
+    queue_timer = gr.Timer(5)
+    queue_timer.tick(fn=get_queue_status_text, inputs=None, outputs=queue_md, show_progress="hidden", queue=False)
+    
+    # Refresh the label list on every page load instead of only at startup
+    demo.load(fn=get_trained_labels_text, inputs=None, outputs=labels_md)
+    
     gr.Markdown("""
     ---
     ### ℹ️ About
@@ -112,6 +201,9 @@ with gr.Blocks(theme=gr.themes.Soft(), title="🌿 Leaf Classifier") as demo:
     - Avoid blurry or dark images
     """)
 
+# Queue every event; predictions are batched (see predict_btn.click)
+demo.queue(default_concurrency_limit=GRADIO_DEFAULT_CONCURRENCY, max_size=GRADIO_QUEUE_MAX_SIZE)
+
 # Launch
 if __name__ == "__main__":
     demo.launch(
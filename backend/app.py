@@ -1,18 +1,43 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Request, Response, request, jsonify, send_file, send_from_directory, stream_with_context
 from flask_cors import CORS
+from werkzeug.datastructures import FileStorage
 from ultralytics import YOLO
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import io
+import json
 import os
-import uuid
+import queue
 import shutil
 import threading
 import time
+import uuid
 from pathlib import Path
 import sys
-import requests
 
 # Import from local modules (now in same directory)
 from download_images import download_images
-from prepare_data_split import split_dataset
+from prepare_data_split import MANIFEST_DB, split_dataset
+from dataset_manifest import DatasetManifest
+from image_io import ImageDecodeError, buffer_of, decode_image
+from batching import BatchScheduler
+from prediction_cache import PredictionCache
+from dedup import PerceptualIndex, dedupe_dataset
+from file_utils import file_lock
+from incremental import train_incremental
+from job_queue import FINISHED_STATUSES, JobQueue
+from label_registry import LabelRegistry
+from model_registry import ModelRegistry
+from export_runtime import INFERENCE_BACKEND, export_and_verify, sample_images
+from image_cache import CachedClassificationTrainer, ImageArrayStore, split_image_paths, use_store
+from training_progress import EpochReporter
+from training_config import EarlyStopping, parse_training_config, resolve_config, torch_threads
+from thumbnails import ThumbnailCache
+from prototypes import PROTOTYPE_MODE, PrototypeIndex, capture_features
+from ingest import OUTPUT_EXTENSION as INGEST_EXTENSION, ingest_many
+from url_fetch import UrlFetcher
+from metrics import (REGISTRY as METRICS, CONTENT_TYPE as METRICS_CONTENT_TYPE, PREDICT_BATCH_SIZE, PREDICT_REQUEST_SECONDS,
+                     PREDICT_REQUESTS, PREDICT_STAGE_SECONDS, TRAINING_RUNS, TRAINING_STAGE_SECONDS)
 
 # Project paths
 PROJECT_ROOT = Path(__file__).resolve().parent
@@ -21,85 +46,234 @@ DATA_DIR = PROJECT_ROOT / "data"
 RESULTS_DIR = PROJECT_ROOT / "results"
 WEIGHTS_PATH = RESULTS_DIR / "weights/best.pt"
 TRAINED_LABELS_FILE = PROJECT_ROOT / "trained_labels.json"
+TRAINING_JOBS_DB = PROJECT_ROOT / "training_jobs.db"
+MODELS_DIR = PROJECT_ROOT / "models"
+IMAGE_CACHE_DIR = PROJECT_ROOT / "cache"
+THUMBNAIL_DIR = PROJECT_ROOT / "cache" / "thumbnails"
+PROTOTYPES_FILE = PROJECT_ROOT / "cache" / "prototypes.npz"
+LOCKS_DIR = PROJECT_ROOT / "cache" / "locks"
+
+# "incremental" fine-tunes the current best.pt for new classes with a replay
+# buffer (falling back to "full" when that isn't possible); "full" retrains
+# every class from the base model
+TRAIN_MODE = os.environ.get("TRAIN_MODE", "incremental")
+
+# Whole request body (e.g. a /train/upload of many images) and single image caps
+MAX_UPLOAD_BYTES = int(float(os.environ.get("MAX_UPLOAD_MB", 200)) * 1024 * 1024)
+PREDICT_MAX_FILE_BYTES = int(float(os.environ.get("PREDICT_MAX_FILE_MB", 10)) * 1024 * 1024)
+
+class InMemoryRequest(Request):
+    """Keep the single /predict upload in memory instead of spooling it to a temp file.
+
+    Other routes (including /predict/batch, which may carry hundreds of
+    files) keep werkzeug's spooled temp files.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.path == '/predict':
+            return io.BytesIO()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
 
 app = Flask(__name__)
+app.request_class = InMemoryRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
 CORS(app)
 
-# Global Training State
-training_state = {
-    "status": "idle", # idle, downloading, preparing, training, completed, error
-    "message": "",
-    "progress": 0,
-    "result": None
-}
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({'error': f"Request too large (max {MAX_UPLOAD_BYTES // (1024 * 1024)} MB)"}), 413
+
+def upload_size(stream):
+    """Size of an uploaded file stream, leaving it at the start"""
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+# Training jobs live in SQLite so status survives restarts and is shared by
+# every worker process. Job status: queued, starting, downloading, preparing,
+# training, finalizing, completed, error
+job_queue = JobQueue(TRAINING_JOBS_DB)
+# /train/events re-checks jobs trained by another process this often
+TRAIN_EVENTS_POLL_INTERVAL = float(os.environ.get("TRAIN_EVENTS_POLL_INTERVAL", 1.0))
+TRAIN_EVENTS_HEARTBEAT = float(os.environ.get("TRAIN_EVENTS_HEARTBEAT", 15.0))
+# Long-lived streams (/train/events, streamed previews) each hold a request
+# thread until they end; cap them per process so they can't take every
+# thread from /predict. 0 means no limit (the dev server's default).
+STREAM_MAX_CLIENTS = int(os.environ.get("STREAM_MAX_CLIENTS", 0))
+stream_slots = threading.BoundedSemaphore(STREAM_MAX_CLIENTS) if STREAM_MAX_CLIENTS > 0 else None
+label_registry = LabelRegistry(TRAINED_LABELS_FILE)
+
+# Cached predictions belong to one model version; activating another clears them
+prediction_cache = PredictionCache(max_bytes=int(float(os.environ.get("PREDICTION_CACHE_MAX_MB", 32)) * 1024 * 1024))
+
+# Versioned weights; the active (version, model) pair is swapped atomically
+# after the new model has been loaded and warmed up
+def on_model_activated(version):
+    prediction_cache.set_model_version(version)
+    # Prototypes live in the feature space of one model version
+    prototypes.set_backbone(version)
+
+registry = ModelRegistry(MODELS_DIR, on_activate=on_model_activated)
+
+def model_loaded():
+    return registry.current()[1] is not None
+
+# Concurrent /predict calls share batched forward passes through this queue.
+# The active model is resolved once per batch, so a swap never splits one.
+PREDICT_MAX_BATCH_SIZE = int(os.environ.get("PREDICT_MAX_BATCH_SIZE", 8))
+PREDICT_MAX_WAIT_MS = float(os.environ.get("PREDICT_MAX_WAIT_MS", 5))
+
+def record_batch(size, queue_waits, forward_seconds):
+    """Scheduler callback: per-image queue wait and per-batch forward time"""
+    PREDICT_BATCH_SIZE.observe(size)
+    PREDICT_STAGE_SECONDS.observe(forward_seconds, stage='forward')
+    for seconds in queue_waits:
+        PREDICT_STAGE_SECONDS.observe(seconds, stage='queue_wait')
+
+# Backbone features for the prototype classifier are captured in the same batched forward pass
+scheduler = BatchScheduler(registry.current, max_batch_size=PREDICT_MAX_BATCH_SIZE, max_wait_ms=PREDICT_MAX_WAIT_MS,
+                           on_batch=record_batch, capture=capture_features if PROTOTYPE_MODE != 'off' else None)
+
+# Read at scrape time
+METRICS.gauge("leaf_predict_queue_depth", "Images waiting for a forward pass", function=scheduler.pending)
+METRICS.gauge("leaf_prediction_cache_entries", "Cached predictions", function=lambda: prediction_cache.stats()['entries'])
+METRICS.counter("leaf_prediction_cache_hits", "Prediction cache hits since start", function=lambda: prediction_cache.stats()['hits'])
+METRICS.counter("leaf_prediction_cache_misses", "Prediction cache misses since start", function=lambda: prediction_cache.stats()['misses'])
+
+# /predict/batch settings: how many decoded images may sit on the model queue
+# per request, and how many URLs are fetched in parallel across requests.
+PREDICT_BATCH_CHUNK_SIZE = int(os.environ.get("PREDICT_BATCH_CHUNK_SIZE", 32))
+PREDICT_BATCH_MAX_ITEMS = int(os.environ.get("PREDICT_BATCH_MAX_ITEMS", 1000))
+
+# One pooled keep-alive client for every URL download (size-capped, with deadlines)
+url_fetcher = UrlFetcher()
+url_fetch_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("URL_FETCH_WORKERS", 8)), thread_name_prefix="url-fetch")
+
+# Training images decoded once into a 224px memory-mapped store, reused
+# across runs; the trainer reads from it instead of the original files
+image_store = ImageArrayStore(IMAGE_CACHE_DIR, size=224)
+use_store(image_store)
+
+# Class, hashes, size, source URL and split of every dataset image; the
+# training paths query it instead of walking dataset/
+dataset_manifest = DatasetManifest(PROJECT_ROOT / MANIFEST_DB, DATASET_DIR)
 
-def load_model():
+# Preview tiles are served as small cached thumbnails instead of the originals;
+# source hashes come from the manifest
+thumbnails = ThumbnailCache(THUMBNAIL_DIR, DATASET_DIR, manifest=dataset_manifest)
+PREVIEW_THUMBNAIL_SIZE = int(os.environ.get("PREVIEW_THUMBNAIL_SIZE", 256))
+
+def thumbnail_url(relpath, size=PREVIEW_THUMBNAIL_SIZE):
+    """Content-versioned thumbnail URL, safe to cache forever"""
+    try:
+        version = thumbnails.digest(relpath)[:16]
+    except OSError:
+        return f"/train/images/{relpath}?size={size}"
+    return f"/train/images/{relpath}?size={size}&v={version}"
+
+def sync_dataset_manifest():
+    """Index dataset images added or removed outside the app (e.g. pre-existing folders)"""
     try:
-        path = str(WEIGHTS_PATH) if WEIGHTS_PATH.exists() else 'yolov8n-cls.pt'
-        print(f"Loading model from: {path}")
-        return YOLO(path)
+        # Stat every file: in-place rewrites don't move the folder mtime
+        dataset_manifest.sync(force=True)
+        print(f"Dataset manifest ready: {sum(dataset_manifest.classes().values())} images")
     except Exception as e:
-        print(f"Error loading model: {e}")
-        return None
+        print(f"Dataset manifest sync failed: {e}")
+        return
+    # Classes found on disk may need prototypes
+    refresh_prototypes()
+
+# Perceptual hashes of every dataset image, used to reject near-duplicates
+dedup_index = PerceptualIndex(DATASET_DIR)
+
+def sync_dedup_index():
+    """Hash any dataset images the index hasn't seen yet (e.g. pre-existing folders)"""
+    try:
+        # Waits for a sync running in another process, so no image is left out
+        dataset_manifest.sync()
+        dedup_index.sync(dataset_manifest)
+        print(f"Dedup index ready: {len(dedup_index)} images")
+    except Exception as e:
+        print(f"Dedup index sync failed: {e}")
+
+# Mean backbone embedding of every dataset class, so a class that was just
+# uploaded or previewed is predictable (nearest class mean) before any
+# retraining. Periodic jobs fold those classes into the model head.
+PROTOTYPE_FOLD_INTERVAL = float(os.environ.get("PROTOTYPE_FOLD_INTERVAL", 6 * 3600))
+
+def prototype_weights(version):
+    return 'yolov8n-cls.pt' if version == 'base' else registry.weights_path(version)
+
+prototypes = PrototypeIndex(PROTOTYPES_FILE, dataset_manifest, prototype_weights, on_change=prediction_cache.clear)
+
+def head_classes():
+    model = registry.current()[1]
+    return set(model.names.values()) if model is not None else set()
+
+def refresh_prototypes():
+    """Rebuild changed prototypes in the background if the head is missing any dataset class"""
+    if PROTOTYPE_MODE == 'off':
+        return
+    if set(prototypes.dataset_classes()) - head_classes():
+        prototypes.update_async()
+
+def fold_in_prototype_classes():
+    """Every PROTOTYPE_FOLD_INTERVAL, queue training for classes only the prototypes know"""
+    while True:
+        time.sleep(PROTOTYPE_FOLD_INTERVAL)
+        try:
+            with file_lock(LOCKS_DIR / "prototype-fold-in.lock", blocking=False) as acquired:
+                if acquired:
+                    queue_prototype_classes()
+        except Exception as e:
+            print(f"Prototype fold-in failed: {e}")
+
+def queue_prototype_classes():
+    for class_name in prototypes.classes_outside(head_classes()):
+        if job_queue.pending_for(class_name) is None:
+            job = job_queue.submit(class_name)
+            print(f"Queued job {job['id']} to fold prototype class '{class_name}' into the model")
 
-model = load_model()
 
 # --- Label Tracking Functions ---
 
 def load_trained_labels():
-    """Load the list of trained labels from JSON file"""
-    if TRAINED_LABELS_FILE.exists():
-        try:
-            import json
-            with open(TRAINED_LABELS_FILE, 'r') as f:
-                return json.load(f)
-        except:
-            return []
-    return []
+    """Load the list of trained labels (served from memory, re-read when the file changes)"""
+    return label_registry.labels()
 
 def save_trained_labels(labels):
     """Save the list of trained labels to JSON file"""
-    import json
-    with open(TRAINED_LABELS_FILE, 'w') as f:
-        json.dump(labels, f, indent=2)
+    label_registry.replace(labels)
 
 def add_trained_label(label_name):
     """Add a label to the trained labels list"""
-    labels = load_trained_labels()
-    normalized_label = label_name.lower().strip()
-    if normalized_label not in labels:
-        labels.append(normalized_label)
-        save_trained_labels(labels)
+    if label_registry.add(label_name):
         print(f"Added '{label_name}' to trained labels")
 
 def remove_trained_label(label_name):
     """Remove a label from the trained labels list"""
-    labels = load_trained_labels()
-    normalized_label = label_name.lower().strip()
-    if normalized_label in labels:
-        labels.remove(normalized_label)
-        save_trained_labels(labels)
+    if label_registry.remove(label_name):
         print(f"Removed '{label_name}' from trained labels")
         return True
     return False
 
 def is_label_trained(label_name):
     """Check if a label has already been trained"""
-    labels = load_trained_labels()
-    normalized_label = label_name.lower().strip()
-    return normalized_label in labels
+    return label_registry.contains(label_name)
+
+# Serve the active version (importing results/weights/best.pt on first run)
+registry.bootstrap(legacy_weights=WEIGHTS_PATH, trained_labels=load_trained_labels())
 
 def cleanup_after_training():
-    """Clean up data folder and temporary files, but KEEP dataset for future training"""
+    """Clean up temporary files, but KEEP dataset and split for future training"""
     try:
         # NOTE: We MUST keep DATASET_DIR so we can include these images 
         # when training future leaves. If we delete it, the model will 
         # forget previous classes!
         
-        # Delete data folder (split dataset) - we recreate this each time
-        if DATA_DIR.exists():
-            shutil.rmtree(DATA_DIR)
-            print("Cleaned up data directory")
+        # DATA_DIR is kept too: it only holds hardlinks into DATASET_DIR plus
+        # the split manifest that the next incremental split builds on.
             
         # Optional: Clean up runs folder if it exists (YOLO artifacts)
         runs_dir = PROJECT_ROOT / "runs"
@@ -122,7 +296,7 @@ def cleanup_after_training():
 
 # --- Helper Functions ---
 
-def download_images_for_preview(keyword, max_images=20):
+def download_images_for_preview(keyword, max_images=20, on_saved=None, cancel_event=None):
     """Download images and return paths for preview"""
     print(f"=== PREVIEW START: Downloading preview images for '{keyword}' ===")
     sys.stdout.flush()
@@ -134,55 +308,88 @@ def download_images_for_preview(keyword, max_images=20):
     # Pass DATASET_DIR to ensure images are saved in the correct location
     print(f"Calling download_images with keyword='{keyword}', max_images={max_images}, base_dir={DATASET_DIR}")
     sys.stdout.flush()
-    download_images([keyword], max_images=max_images, base_dir=str(DATASET_DIR))
+    download_images([keyword], max_images=max_images, base_dir=str(DATASET_DIR), dedup_index=dedup_index,
+                    manifest=dataset_manifest, on_saved=on_saved, cancel_event=cancel_event)
     print("download_images call completed")
     sys.stdout.flush()
     
     # Get the downloaded image paths
-    save_dir = DATASET_DIR / folder_name
-    print(f"Checking save_dir: {save_dir}, exists: {save_dir.exists()}")
+    images = dataset_manifest.images(folder_name)
+    print(f"Found {len(images)} images for {folder_name}")
     sys.stdout.flush()
-    if save_dir.exists():
-        images = [f for f in save_dir.iterdir() if f.is_file() and f.suffix.lower() in ['.jpg', '.jpeg', '.png']]
-        print(f"Found {len(images)} images in {save_dir}")
-        sys.stdout.flush()
-        return [str(img.relative_to(DATASET_DIR)) for img in images]
-    print("save_dir does not exist, returning empty list")
-    sys.stdout.flush()
-    return []
+    return images
 
 def prepare_data_split():
     """Prepare train/val split using the existing module"""
-    # Clear existing data dir to ensure fresh split
-    if DATA_DIR.exists():
-        shutil.rmtree(DATA_DIR)
-    
-    # Use the split_dataset function from the module
-    split_dataset(str(DATASET_DIR), output_dir=str(DATA_DIR), train_ratio=0.8)
+    # Incremental: only classes that changed since the last run are relinked,
+    # and existing images keep their train/val assignment
+    split_dataset(str(DATASET_DIR), output_dir=str(DATA_DIR), train_ratio=0.8, mode="link", manifest=dataset_manifest)
 
-def run_training_workflow(leaf_name):
-    global model
-    global training_state
+def run_training_workflow(jobs):
+    """Train one model run covering every leaf in `jobs` (claimed together from the queue)"""
+    job_ids = [job['id'] for job in jobs]
+    leaf_names = [job['leaf_name'] for job in jobs]
+    mode = jobs[0]['mode'] or TRAIN_MODE
+    # Claimed jobs share one config (the queue only coalesces identical ones)
+    overrides = jobs[0]['config'] or {}
+    config = resolve_config(overrides)
+    # The image store holds 224px crops; larger runs read the original files
+    use_image_store = config['imgsz'] <= image_store.size
+    timings = {}
+    
+    def report(**fields):
+        job_queue.update(job_ids, **fields)
+    
+    def stage_done(name, started):
+        timings[name] = round(time.time() - started, 3)
+        TRAINING_STAGE_SECONDS.observe(time.time() - started, stage=name)
+        report(timings=timings)
+    
+    def epoch_done(entry, history):
+        # Training spans 25% to 90% of the overall progress bar
+        message = f"Epoch {entry['epoch']}/{entry['epochs']}"
+        if entry['loss'] is not None:
+            message += f" - loss {entry['loss']:.3f}"
+        if entry['top1'] is not None:
+            message += f", top-1 {entry['top1']:.1%}"
+        report(
+            message=message,
+            progress=round(0.25 + 0.65 * entry['epoch'] / entry['epochs'], 4),
+            epoch_log=history
+        )
+    
+    epoch_reporter = EpochReporter(epoch_done)
     
     try:
         # Step 1: Download (if not already downloaded in preview)
-        folder_name = leaf_name.split(' ')[0].lower()
-        
-        # Check if images already exist from preview
-        if not (DATASET_DIR / folder_name).exists() or len(list((DATASET_DIR / folder_name).glob('*'))) < 20:
-            training_state.update({"status": "downloading", "message": f"Downloading images for {leaf_name}..."})
-            download_images([f"{leaf_name} leaf"], max_images=50, base_dir=str(DATASET_DIR))
+        started = time.time()
+        dataset_manifest.sync(force=True)
+        for index, leaf_name in enumerate(leaf_names):
+            folder_name = leaf_name.split(' ')[0].lower()
+            
+            # Check if images already exist from preview
+            if dataset_manifest.count(folder_name) < 20:
+                report(status="downloading", message=f"Downloading images for {leaf_name}...", progress=0.2 * index / len(leaf_names))
+                download_images([f"{leaf_name} leaf"], max_images=50, base_dir=str(DATASET_DIR), dedup_index=dedup_index,
+                                manifest=dataset_manifest)
+        stage_done('download', started)
         
         # Step 2: Prepare Data
-        training_state.update({"status": "preparing", "message": "Organizing dataset..."})
+        started = time.time()
+        report(status="preparing", message="Organizing dataset...", progress=0.2)
         prepare_data_split()
+        stage_done('split', started)
         
-        # Step 3: Train
-        training_state.update({"status": "training", "message": "Training YOLOv8 model..."})
+        # Decode only new or changed images into the training cache
+        started = time.time()
+        if use_image_store:
+            report(message="Preprocessing new images...")
+            image_store.sync(split_image_paths(DATA_DIR))
+        stage_done('preprocess', started)
         
-        # Load base model for training (can use 'yolov8n-cls.pt' or existing 'best.pt')
-        # Using existing best.pt to fine-tune is usually better if classes are added
-        train_model = YOLO('yolov8n-cls.pt') 
+        # Step 3: Train
+        started = time.time()
+        report(status="training", message="Training YOLOv8 model...", progress=0.25)
         
         # Verify data directory exists
         if not DATA_DIR.exists():
@@ -193,118 +400,477 @@ def run_training_workflow(leaf_name):
              raise FileNotFoundError(f"Data directory missing train/val folders at: {DATA_DIR}")
 
         print(f"Training with data path: {str(DATA_DIR.resolve())}")
+        print(f"Training config: {config}")
         
-        # Train
-        results = train_model.train(
-            data=str(DATA_DIR.resolve()), # key change: ensure absolute resolved path
-            epochs=20, # Keep it short for demo; increase for real usage
-            imgsz=224,
-            batch=16,
+        train_kwargs = dict(
+            imgsz=config['imgsz'],
+            batch=config['batch'],
+            workers=config['workers'],
             project=str(RESULTS_DIR.parent), # e:\leaf\results (parent of parent is root, project arg creates subdir)
             name='results',
             exist_ok=True # Overwrite existing 'results' folder
         )
+        if use_image_store:
+            train_kwargs['trainer'] = CachedClassificationTrainer # Read pre-decoded images from image_store
+        
+        # Patience on validation top-1 and the wall-clock budget span both runs
+        early_stopping = EarlyStopping(config['patience'], config['time_budget'])
+        
+        results = None
+        training_report = {'mode': 'full'}
+        # The dedicated trainer doesn't watch registry.json: pick up any
+        # activation or rollback made in a web worker before fine-tuning
+        registry.sync_active()
+        active_version = registry.current()[0]
+        with torch_threads(config['threads']):
+            if mode == 'incremental' and active_version not in (None, 'base'):
+                # Fine-tune the serving weights for the new classes only
+                report(message="Fine-tuning current model for new classes...")
+                callbacks = [*epoch_reporter.callbacks('incremental').items(), *early_stopping.callbacks().items()]
+                # Incremental runs keep their own (shorter) default epoch count
+                epochs = {'epochs': overrides['epochs']} if 'epochs' in overrides else {}
+                results, training_report = train_incremental(registry.weights_path(active_version), DATA_DIR, PROJECT_ROOT / "runs", train_kwargs,
+                                                             callbacks=callbacks, **epochs)
+                if results is None:
+                    print(f"Incremental training not used: {training_report.get('fallback')}")
+                    training_report = {'mode': 'full', 'incremental': training_report}
+            
+            if results is None:
+                report(message="Training YOLOv8 model...")
+                # Full retrain of every class from the base model
+                train_model = YOLO('yolov8n-cls.pt') 
+                for event, callback in [*epoch_reporter.callbacks('full').items(), *early_stopping.callbacks().items()]:
+                    train_model.add_callback(event, callback)
+                results = train_model.train(
+                    data=str(DATA_DIR.resolve()), # key change: ensure absolute resolved path
+                    epochs=config['epochs'],
+                    **train_kwargs
+                )
+        training_report['config'] = config
+        training_report['early_stop'] = early_stopping.stopped
+        stage_done('train', started)
+        
+        # validation metrics
+        metrics = results.results_dict if hasattr(results, 'results_dict') else str(results)
         
-        # Step 4: Update Global Model
-        training_state.update({"status": "finalizing", "message": "Reloading model..."})
+        # Step 4: Publish and hot-swap the new model version
+        started = time.time()
+        report(status="finalizing", message="Loading new model version...", progress=0.9)
         
         # path is project/name/weights/best.pt -> e:\leaf\results\weights\best.pt
         # Ultralytics saves to {project}/{name}/weights/best.pt
         # Here project=e:\leaf, name=results -> e:\leaf\results\weights\best.pt
         
-        global model
-        model = YOLO(str(WEIGHTS_PATH))
-        
-        # validation metrics
-        metrics = results.results_dict if hasattr(results, 'results_dict') else str(results)
+        trained_labels = load_trained_labels()
+        for leaf_name in leaf_names:
+            normalized_label = leaf_name.lower().strip()
+            if normalized_label not in trained_labels:
+                trained_labels.append(normalized_label)
+        new_version = registry.publish(WEIGHTS_PATH, trained_labels=trained_labels, metrics=metrics)
+        if INFERENCE_BACKEND != 'torch':
+            # Export for the CPU runtime and check it against PyTorch first
+            report(message=f"Exporting model for {INFERENCE_BACKEND}...")
+            try:
+                runtimes = export_and_verify(registry.weights_path(new_version), sample_images(DATA_DIR))
+                registry.update_meta(new_version, runtimes=runtimes)
+            except Exception as e:
+                print(f"Runtime export failed, serving PyTorch weights: {e}")
+        # Loads and warms up here, on the training thread; serving switches
+        # over only once the new model is ready
+        registry.activate(new_version)
+        stage_done('reload', started)
+        # Classes still missing from the head need prototypes in the new feature space
+        refresh_prototypes()
         
-        # Step 5: Cleanup and save label
-        training_state.update({"status": "finalizing", "message": "Cleaning up temporary files..."})
+        # Step 5: Cleanup and save labels
+        started = time.time()
+        report(message="Cleaning up temporary files...")
         
-        # Add label to trained labels
-        add_trained_label(leaf_name)
+        # Add labels to trained labels
+        for leaf_name in leaf_names:
+            add_trained_label(leaf_name)
         
         # Cleanup dataset and data folders
         cleanup_after_training()
+        stage_done('cleanup', started)
         
-        training_state.update({
-            "status": "completed", 
-            "message": "Training successful! Model updated and temporary files cleaned.",
-            "result": {
-                "metrics": metrics
+        report(
+            status="completed",
+            message="Training successful! Model updated and temporary files cleaned.",
+            progress=1.0,
+            finished_at=time.time(),
+            result={
+                "metrics": metrics,
+                "training": training_report,
+                "leaf_names": leaf_names,
+                "model_version": new_version
             }
-        })
+        )
+        TRAINING_RUNS.inc(mode=training_report['mode'], status="completed")
         
     except Exception as e:
         print(f"Training failed: {e}")
-        training_state.update({"status": "error", "message": str(e)})
+        TRAINING_RUNS.inc(mode=mode, status="error")
+        report(status="error", message=str(e), finished_at=time.time())
+
+def job_status(job):
+    """Public view of a training job (a superset of the old /train/status fields)"""
+    return {
+        'job_id': job['id'],
+        'leaf_name': job['leaf_name'],
+        'mode': job['mode'],
+        'config': job['config'],
+        'status': job['status'],
+        'message': job['message'],
+        'progress': job['progress'],
+        'result': job['result'],
+        'run_id': job['run_id'],
+        'timings': job['timings'],
+        'epochs': job['epoch_log'] or [],
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at']
+    }
+
+def fetch_image_bytes(url):
+    """Fetch an image URL, revalidating a previously cached download.
+
+    Returns (cached prediction, None, None) if the origin says our copy is
+    still current, otherwise (None, body, validators).
+    """
+    validators = prediction_cache.url_validators(url)
+    with PREDICT_STAGE_SECONDS.time(stage='url_fetch'):
+        fetched = url_fetcher.fetch(url, validators)
+    if fetched.body is None:
+        cached = prediction_cache.revalidated(url)
+        if cached is not None:
+            return cached, None, None
+        # Evicted in the meantime: download it after all
+        with PREDICT_STAGE_SECONDS.time(stage='url_fetch'):
+            fetched = url_fetcher.fetch(url)
+    return None, fetched.body, fetched.validators
+
+def format_prediction(result, version):
+    """Convert a YOLO classification result into the /predict response shape"""
+    top1_index = result.probs.top1
+    top1_conf = result.probs.top1conf.item()
+    class_name = result.names[top1_index]
+
+    clean_probs = {}
+    if result.probs.top5:
+        for i in result.probs.top5:
+            clean_probs[result.names[i]] = float(result.probs.data[i])
+    else:
+        for i, prob in enumerate(result.probs.data):
+            if prob > 0.01:
+                clean_probs[result.names[i]] = float(prob)
+
+    return {
+        'class': class_name,
+        'confidence': float(top1_conf),
+        'all_probs': clean_probs,
+        'model_version': version
+    }
+
+def refine_prediction(prediction, result, image, features=None):
+    """Answer with a class the head doesn't have yet when the image is nearest to its prototype.
+
+    `features` are the image's backbone features captured by the batch
+    scheduler. Exported runtimes (ONNX, OpenVINO) can't be hooked, so their
+    images are embedded again with the version's PyTorch weights.
+    """
+    if PROTOTYPE_MODE == 'off':
+        return prediction
+    head = set(result.names.values())
+    if not prototypes.classes_outside(head):
+        return prediction
+    with PREDICT_STAGE_SECONDS.time(stage='prototype'):
+        if features is not None:
+            ranked = prototypes.classify_embedding(features, prediction['model_version'])
+        else:
+            ranked = prototypes.classify(image)
+    if not ranked or ranked[0][0] in head:
+        return prediction
+    return {
+        'class': ranked[0][0],
+        'confidence': ranked[0][1],
+        'all_probs': dict(ranked),
+        'model_version': prediction['model_version'],
+        'source': 'prototype'
+    }
+
+# Background threads every serving process runs. Under gunicorn with
+# preload_app (see gunicorn.conf.py) they are started in each worker after
+# the fork, never in the master that loaded the model.
+TRAINING_IN_WEB_WORKERS = os.environ.get("TRAINING_IN_WEB_WORKERS", "true").lower() == "true"
+MODEL_WATCH_INTERVAL = float(os.environ.get("MODEL_WATCH_INTERVAL", 2.0))
+# Directory shared by every process (gunicorn workers, train_worker.py). When
+# set, each one writes its metrics there and /metrics reports their sum.
+METRICS_DIR = os.environ.get("METRICS_DIR")
+METRICS_EXPORT_INTERVAL = float(os.environ.get("METRICS_EXPORT_INTERVAL", 5.0))
+
+def start_metrics_export():
+    if METRICS_DIR:
+        threading.Thread(target=METRICS.export_forever, args=(METRICS_DIR, METRICS_EXPORT_INTERVAL),
+                         name="metrics-export", daemon=True).start()
+
+def run_exclusive(name, target):
+    """Run a start-up sync in one process at a time.
+
+    Every worker (and the training worker) starts at once; the first to
+    take the lock does the work, the others skip it and read the shared
+    result (SQLite tables, files on disk).
+    """
+    with file_lock(LOCKS_DIR / f"{name}.lock", blocking=False) as acquired:
+        if acquired:
+            target()
+        else:
+            print(f"Skipping {name}: another process is running it")
+
+def sync_dataset_indexes():
+    # The dedup index is filled from the manifest, so the manifest goes first
+    run_exclusive("manifest-sync", sync_dataset_manifest)
+    run_exclusive("dedup-sync", sync_dedup_index)
+
+def start_background_workers():
+    threading.Thread(target=sync_dataset_indexes, name="dataset-sync", daemon=True).start()
+    start_metrics_export()
+    # Follow model versions activated by other worker processes
+    threading.Thread(target=registry.watch, args=(MODEL_WATCH_INTERVAL,), name="model-watch", daemon=True).start()
+    if TRAINING_IN_WEB_WORKERS:
+        # Drains the job queue; only the process holding the trainer lock trains
+        threading.Thread(target=job_queue.run_worker, args=(run_training_workflow,), name="training-worker", daemon=True).start()
+    refresh_prototypes()
+    if PROTOTYPE_MODE != 'off' and PROTOTYPE_FOLD_INTERVAL > 0:
+        threading.Thread(target=fold_in_prototype_classes, name="prototype-fold-in", daemon=True).start()
+
+if os.environ.get("DEFER_BACKGROUND_WORKERS", "false").lower() != "true":
+    start_background_workers()
 
 # --- Routes ---
 
 @app.route('/predict', methods=['POST'])
 def predict():
-    if not model:
-        return jsonify({'error': 'Model not loaded'}), 500
+    started = time.perf_counter()
+    source = 'none'
+
+    def finish(body, outcome, status=200):
+        PREDICT_REQUESTS.inc(source=source, outcome=outcome)
+        PREDICT_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint='predict', outcome=outcome)
+        return jsonify(body), status
 
-    filepath = None 
+    if not model_loaded():
+        return finish({'error': 'Model not loaded'}, 'error', 500)
+    # Cached answers are dropped when another process changed the prototypes
+    prototypes.poll()
 
-    # Handle File Upload
-    if 'file' in request.files:
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'No selected file'}), 400
-        if file:
-            filename = f"temp_{uuid.uuid4().hex}.jpg"
-            filepath = os.path.join('.', filename)
-            file.save(filepath)
+    image_bytes = None
+    url = None
+    validators = None
+
+    # Single uploads are buffered in memory: refuse oversized bodies before reading them
+    if (request.content_length or 0) > PREDICT_MAX_FILE_BYTES + 64 * 1024:
+        return finish({'error': f"Image larger than {PREDICT_MAX_FILE_BYTES} bytes"}, 'bad_request', 413)
+
+    # Handle File Upload (the multipart body is read on first access)
+    with PREDICT_STAGE_SECONDS.time(stage='upload'):
+        has_file = 'file' in request.files
+        if has_file:
+            file = request.files['file']
+            image_bytes = buffer_of(file.stream) if file.filename != '' else None
+    if has_file:
+        source = 'upload'
+        if image_bytes is None:
+            return finish({'error': 'No selected file'}, 'bad_request', 400)
+        if len(image_bytes) > PREDICT_MAX_FILE_BYTES:
+            return finish({'error': f"Image larger than {PREDICT_MAX_FILE_BYTES} bytes"}, 'bad_request', 413)
 
     # Handle URL
     elif request.form.get('url') or (request.json and request.json.get('url')):
+        source = 'url'
         url = request.form.get('url') or request.json.get('url')
+        cached = prediction_cache.get_url(url)
+        if cached is not None:
+            return finish(cached, 'cache_hit')
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            filename = f"temp_{uuid.uuid4().hex}.jpg"
-            filepath = os.path.join('.', filename)
-            with open(filepath, 'wb') as f:
-                f.write(response.content)
+            cached, image_bytes, validators = fetch_image_bytes(url)
         except Exception as e:
-            return jsonify({'error': f"Failed to download image: {str(e)}"}), 400
+            return finish({'error': f"Failed to download image: {str(e)}"}, 'bad_request', 400)
+        if cached is not None:
+            return finish(cached, 'cache_hit')
 
     else:
-        return jsonify({'error': 'No file or URL provided'}), 400
+        return finish({'error': 'No file or URL provided'}, 'bad_request', 400)
+
+    with PREDICT_STAGE_SECONDS.time(stage='cache_lookup'):
+        digest = prediction_cache.key_for(image_bytes)
+        cached = prediction_cache.get(digest)
+    if cached is not None:
+        if url:
+            prediction_cache.remember_url(url, digest, validators)
+        return finish(cached, 'cache_hit')
 
-    if filepath:
+    try:
+        with PREDICT_STAGE_SECONDS.time(stage='decode'):
+            image = decode_image(image_bytes)
+    except ImageDecodeError as e:
+        return finish({'error': str(e)}, 'bad_request', 400)
+
+    try:
+        # queue_wait and forward are recorded by the batch scheduler
+        result, version, features = scheduler.predict(image)
+        with PREDICT_STAGE_SECONDS.time(stage='postprocess'):
+            prediction = format_prediction(result, version)
+        prediction = refine_prediction(prediction, result, image, features)
+        prediction_cache.put(digest, prediction, version, url=url, validators=validators)
+        return finish(prediction, 'ok')
+    except Exception as e:
+        return finish({'error': str(e)}, 'error', 500)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics of every process sharing METRICS_DIR (else of this process)"""
+    body = METRICS.render_merged(METRICS_DIR) if METRICS_DIR else METRICS.render()
+    return Response(body, content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/predict/cache', methods=['GET'])
+def get_prediction_cache_stats():
+    """Hit/miss counters and size of the prediction cache"""
+    return jsonify(prediction_cache.stats())
+
+@app.route('/predict/batch', methods=['POST'])
+def predict_batch():
+    """Classify many uploaded files and/or URLs, streaming one NDJSON line per image"""
+    if not model_loaded():
+        return jsonify({'error': 'Model not loaded'}), 500
+    prototypes.poll()
+
+    payload = request.get_json(silent=True) or {}
+    files = request.files.getlist('files') + request.files.getlist('file')
+    urls = request.form.getlist('urls') + request.form.getlist('url') + list(payload.get('urls') or [])
+
+    if not files and not urls:
+        return jsonify({'error': 'No files or URLs provided'}), 400
+    if len(files) + len(urls) > PREDICT_BATCH_MAX_ITEMS:
+        return jsonify({'error': f"Too many images (max {PREDICT_BATCH_MAX_ITEMS})"}), 400
+
+    # Uploads stay spooled until their turn (at most a chunk is in memory);
+    # index results in submission order
+    ready = deque()
+    for file in files:
+        ready.append((len(ready), file.filename, file, None, None))
+    url_jobs = [(len(ready) + i, url) for i, url in enumerate(urls)]
+
+    def line(index, source, body):
+        return json.dumps({'index': index, 'source': source, **body}) + "\n"
+
+    started = time.perf_counter()
+
+    def generate():
+        # URL downloads run on the fetch pool while earlier images are
+        # already going through the model.
+        fetching = {}
+        predicting = {}
         try:
-            results = model(filepath)
-            top1_index = results[0].probs.top1
-            top1_conf = results[0].probs.top1conf.item()
-            class_name = results[0].names[top1_index]
-            
-            clean_probs = {}
-            if results[0].probs.top5:
-                 for i in results[0].probs.top5:
-                     clean_probs[results[0].names[i]] = float(results[0].probs.data[i])
-            else:
-                 for i, prob in enumerate(results[0].probs.data):
-                     if prob > 0.01:
-                        clean_probs[results[0].names[i]] = float(prob)
-
-            if os.path.exists(filepath):
-                os.remove(filepath)
-            
-            return jsonify({
-                'class': class_name,
-                'confidence': float(top1_conf),
-                'all_probs': clean_probs
-            })
-            
-        except Exception as e:
-            if os.path.exists(filepath):
-                os.remove(filepath)
-            return jsonify({'error': str(e)}), 500
-    
-    return jsonify({'error': 'Processing failed'}), 500
+            for index, url in url_jobs:
+                cached = prediction_cache.get_url(url)
+                if cached is not None:
+                    yield line(index, url, cached)
+                else:
+                    fetching[url_fetch_pool.submit(fetch_image_bytes, url)] = (index, url)
+
+            while ready or fetching or predicting:
+                while ready and len(predicting) < PREDICT_BATCH_CHUNK_SIZE:
+                    index, source, data, url, validators = ready.popleft()
+                    if isinstance(data, FileStorage):
+                        if upload_size(data.stream) > PREDICT_MAX_FILE_BYTES:
+                            yield line(index, source, {'error': f"Image larger than {PREDICT_MAX_FILE_BYTES} bytes"})
+                            continue
+                        data = buffer_of(data.stream)
+                    digest = prediction_cache.key_for(data)
+                    cached = prediction_cache.get(digest)
+                    if cached is not None:
+                        if url:
+                            prediction_cache.remember_url(url, digest, validators)
+                        yield line(index, source, cached)
+                        continue
+                    try:
+                        with PREDICT_STAGE_SECONDS.time(stage='decode'):
+                            image = decode_image(data)
+                    except ImageDecodeError as e:
+                        yield line(index, source, {'error': str(e)})
+                        continue
+                    predicting[scheduler.submit(image)] = (index, source, digest, url, validators, image)
+
+                done, _ = wait(list(fetching) + list(predicting), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in fetching:
+                        index, url = fetching.pop(future)
+                        try:
+                            cached, data, validators = future.result()
+                        except Exception as e:
+                            yield line(index, url, {'error': f"Failed to download image: {str(e)}"})
+                            continue
+                        if cached is not None:
+                            yield line(index, url, cached)
+                        else:
+                            ready.append((index, url, data, url, validators))
+                    else:
+                        index, source, digest, url, validators, image = predicting.pop(future)
+                        try:
+                            result, version, features = future.result()
+                            with PREDICT_STAGE_SECONDS.time(stage='postprocess'):
+                                prediction = format_prediction(result, version)
+                            prediction = refine_prediction(prediction, result, image, features)
+                            prediction_cache.put(digest, prediction, version, url=url, validators=validators)
+                            yield line(index, source, prediction)
+                        except Exception as e:
+                            yield line(index, source, {'error': str(e)})
+        finally:
+            # Client went away or we finished: drop work nobody will read
+            for future in list(fetching) + list(predicting):
+                future.cancel()
+            outcome = 'cancelled' if fetching or predicting else 'ok'
+            PREDICT_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint='predict_batch', outcome=outcome)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/models', methods=['GET'])
+def list_models():
+    """Published model versions and the one currently serving"""
+    return jsonify({
+        'active': registry.current()[0],
+        'versions': registry.versions()
+    })
+
+@app.route('/models/rollback', methods=['POST'])
+def rollback_model():
+    """Switch back to the previously active model version"""
+    try:
+        version = registry.rollback()
+        if version is None:
+            return jsonify({'error': 'No previous model version to roll back to'}), 409
+        # Trained labels follow the model they were trained into
+        save_trained_labels(registry.meta(version)['trained_labels'])
+        refresh_prototypes()
+        return jsonify({'message': f"Rolled back to {version}", 'active': version})
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/models/<version>/activate', methods=['POST'])
+def activate_model(version):
+    """Serve a specific published model version"""
+    if version not in [meta['version'] for meta in registry.versions()]:
+        return jsonify({'error': f"Model version '{version}' not found"}), 404
+    try:
+        registry.activate(version)
+        save_trained_labels(registry.meta(version)['trained_labels'])
+        refresh_prototypes()
+        return jsonify({'message': f"Activated {version}", 'active': version})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/train/start', methods=['POST'])
 def start_train():
@@ -321,35 +887,118 @@ def start_train():
             'already_trained': True
         }), 409
         
-    if training_state['status'] in ['downloading', 'preparing', 'training']:
-        return jsonify({'error': 'Training already in progress'}), 409
-        
-    # Reset state
-    training_state.update({
-        "status": "starting",
-        "message": "Initializing training...",
-        "progress": 0,
-        "result": None
-    })
+    mode = data.get('mode')
+    if mode not in (None, 'incremental', 'full'):
+        return jsonify({'error': "mode must be 'incremental' or 'full'"}), 400
+    
+    # Per-job overrides of epochs, imgsz, batch, workers, threads, time_budget, patience
+    try:
+        config = parse_training_config(data.get('config'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    # Start background thread
-    thread = threading.Thread(target=run_training_workflow, args=(leaf_name,))
-    thread.start()
+    # Asking twice for the same leaf returns the job that's already queued
+    existing = job_queue.pending_for(leaf_name)
+    if existing:
+        return jsonify({'message': 'Training already queued', **job_status(existing)}), 202
     
-    return jsonify({'message': 'Training started successfully'})
+    # The training worker picks the job up from the queue
+    job = job_queue.submit(leaf_name, mode=mode, config=config)
+    
+    return jsonify({'message': 'Training queued successfully', **job_status(job)}), 202
 
 @app.route('/train/status', methods=['GET'])
 def get_status():
-    return jsonify(training_state)
+    """Status of ?job_id=..., or of the most recent job"""
+    job_id = request.args.get('job_id')
+    job = job_queue.get(job_id) if job_id else job_queue.latest()
+    if job is None:
+        if job_id:
+            return jsonify({'error': f"Job '{job_id}' not found"}), 404
+        return jsonify({"status": "idle", "message": "", "progress": 0, "result": None})
+    return jsonify(job_status(job))
+
+def stream_response(generator, mimetype):
+    """Streaming response that holds one of the STREAM_MAX_CLIENTS slots until it closes,
+    or a 503 if they are all taken"""
+    if stream_slots is not None and not stream_slots.acquire(blocking=False):
+        response = jsonify({'error': 'Too many open streams, try again shortly'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    response = Response(stream_with_context(generator), mimetype=mimetype, headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    if stream_slots is not None:
+        # Runs once the response is closed, whether the stream finished or the client left
+        response.call_on_close(stream_slots.release)
+    return response
+
+@app.route('/train/events', methods=['GET'])
+def training_events():
+    """Server-Sent Events stream of one job's status (?job_id=..., or the most recent job).
+
+    Sends a `status` event (the /train/status payload) whenever the job
+    changes and closes the stream once it has completed or failed.
+    """
+    job_id = request.args.get('job_id')
+    job = job_queue.get(job_id) if job_id else job_queue.latest()
+    if job is None and job_id:
+        return jsonify({'error': f"Job '{job_id}' not found"}), 404
+    last_event_id = request.headers.get('Last-Event-ID')
+
+    def events():
+        if job is None:
+            yield f"event: status\ndata: {json.dumps({'status': 'idle', 'message': '', 'progress': 0, 'result': None})}\n\n"
+            return
+        revision = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+        last_sent = time.time()
+        while True:
+            current = job_queue.get(job['id'])
+            if current['revision'] != revision:
+                revision = current['revision']
+                last_sent = time.time()
+                yield f"id: {revision}\nevent: status\ndata: {json.dumps(job_status(current))}\n\n"
+            if current['status'] in FINISHED_STATUSES:
+                return
+            if time.time() - last_sent >= TRAIN_EVENTS_HEARTBEAT:
+                # Comment line keeps proxies from closing an idle stream
+                last_sent = time.time()
+                yield ": keep-alive\n\n"
+            # Woken immediately by updates from this process; other processes are polled
+            job_queue.wait_for_change(TRAIN_EVENTS_POLL_INTERVAL)
+
+    return stream_response(events(), 'text/event-stream')
+
+@app.route('/train/jobs', methods=['GET'])
+def list_training_jobs():
+    """Recent training jobs, newest first"""
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify({'jobs': [job_status(job) for job in job_queue.list(limit)]})
+
+@app.route('/train/jobs/<job_id>', methods=['GET'])
+def get_training_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': f"Job '{job_id}' not found"}), 404
+    return jsonify(job_status(job))
 
 @app.route('/train/labels', methods=['GET'])
 def get_trained_labels():
     """Get list of all trained labels"""
     labels = load_trained_labels()
-    return jsonify({
+    etag = label_registry.etag
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+    response = jsonify({
         'labels': labels,
-        'count': len(labels)
+        'count': len(labels),
+        'version': label_registry.version
     })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/train/labels/<label_name>', methods=['DELETE'])
 def delete_trained_label(label_name):
@@ -362,11 +1011,17 @@ def delete_trained_label(label_name):
         # 2. Delete dataset folder
         folder_name = label_name.split(' ')[0].lower()
         dataset_path = DATASET_DIR / folder_name
+        image_count = dataset_manifest.count(folder_name)
         
         folder_removed = False
-        if dataset_path.exists():
-            shutil.rmtree(dataset_path)
+        if image_count or dataset_path.exists():
+            shutil.rmtree(dataset_path, ignore_errors=True)
             folder_removed = True
+        # The next split drops the class's train/val links
+        dataset_manifest.remove_class(folder_name)
+        dedup_index.remove_class(folder_name)
+        thumbnails.remove_class(folder_name)
+        prototypes.remove_class(folder_name)
             
         if not was_removed and not folder_removed:
             return jsonify({'error': f"Label '{label_name}' not found"}), 404
@@ -374,7 +1029,8 @@ def delete_trained_label(label_name):
         return jsonify({
             'message': f"Successfully deleted '{label_name}'",
             'label_removed': was_removed,
-            'folder_removed': folder_removed
+            'folder_removed': folder_removed,
+            'images_removed': image_count
         })
         
     except Exception as e:
@@ -400,27 +1056,55 @@ def upload_training_images():
         # Save each uploaded image
         uploaded_count = 0
         uploaded_paths = []
+        duplicates = []
+        rejected = []
+        
+        # Verify, normalize and re-encode every upload (in parallel) into
+        # staging files, whatever format or extension the client sent
+        files = [file for file in files if file.filename != '']
+        # Unique per request: concurrent uploads to one class must not share staged or final names
+        batch_id = uuid.uuid4().hex
+        staged = [save_dir / f".upload_{batch_id}_{i}.part" for i in range(len(files))]
+        outcomes = ingest_many([(file.stream, path) for file, path in zip(files, staged)])
         
-        for file in files:
-            if file.filename == '':
-                continue
+        try:
+            for file, staged_path, (info, error) in zip(files, staged, outcomes):
+                if error is not None:
+                    print(f"Rejected upload {file.filename}: {error}")
+                    rejected.append({'file': file.filename, 'error': error})
+                    continue
                 
-            # Generate unique filename
-            ext = os.path.splitext(file.filename)[1] or '.jpg'
-            filename = f"{folder_name}_{int(time.time())}_{uploaded_count}{ext}"
-            filepath = save_dir / filename
-            
-            # Save file
-            file.save(str(filepath))
-            uploaded_paths.append(str(filepath.relative_to(DATASET_DIR)))
-            uploaded_count += 1
+                # Generate unique filename
+                filename = f"{folder_name}_{int(time.time())}_{batch_id[:8]}_{uploaded_count}{INGEST_EXTENSION}"
+                filepath = save_dir / filename
+                
+                # Skip near-duplicates of images already in the dataset
+                duplicate = dedup_index.check_and_add(filepath, info['hash'])
+                if duplicate is not None:
+                    duplicates.append({'file': file.filename, 'duplicate_of': duplicate})
+                    continue
+                
+                # Save file
+                os.replace(staged_path, filepath)
+                dataset_manifest.add(filepath, info)
+                uploaded_paths.append(str(filepath.relative_to(DATASET_DIR)))
+                uploaded_count += 1
+        finally:
+            for staged_path in staged:
+                if staged_path.exists():
+                    staged_path.unlink()
         
-        print(f"Uploaded {uploaded_count} images for '{leaf_name}'")
+        print(f"Uploaded {uploaded_count} images for '{leaf_name}' ({len(duplicates)} duplicates, {len(rejected)} rejected)")
+        if uploaded_count:
+            refresh_prototypes()
         
         return jsonify({
             'success': True,
             'count': uploaded_count,
             'images': [f"/train/images/{path}" for path in uploaded_paths],
+            'thumbnails': [thumbnail_url(path) for path in uploaded_paths],
+            'duplicates': duplicates,
+            'rejected': rejected,
             'leaf_name': leaf_name
         })
         
@@ -428,8 +1112,91 @@ def upload_training_images():
         print(f"Upload error: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/train/dedup', methods=['POST'])
+def dedup_training_images():
+    """Remove near-duplicate images from every class folder in the dataset"""
+    data = request.get_json(silent=True) or {}
+    try:
+        removed = dedupe_dataset(DATASET_DIR, dry_run=bool(data.get('dry_run')), manifest=dataset_manifest)
+        if not data.get('dry_run'):
+            dataset_manifest.remove([entry['image'] for entry in removed])
+        return jsonify({
+            'success': True,
+            'removed': removed,
+            'count': len(removed)
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Streamed previews send a keep-alive line this often while nothing new arrived,
+# so proxies keep the connection open and a gone client is noticed
+PREVIEW_HEARTBEAT = float(os.environ.get("PREVIEW_HEARTBEAT", 5.0))
+
+def stream_preview(leaf_name, max_images):
+    """NDJSON preview: one line per image as soon as it is saved, then a summary line.
+
+    Downloads run on a background thread; if the client disconnects, the
+    next write fails, the generator is closed and the remaining downloads
+    are cancelled.
+    """
+    folder_name = leaf_name.split(' ')[0].lower()
+    saved = queue.Queue()
+    cancel = threading.Event()
+
+    def on_saved(path, info):
+        saved.put(str(Path(path).relative_to(DATASET_DIR)))
+
+    def run():
+        try:
+            download_images_for_preview(f"{leaf_name} leaf", max_images=max_images, on_saved=on_saved, cancel_event=cancel)
+        except Exception as e:
+            saved.put(e)
+        finally:
+            saved.put(None)
+
+    def line(kind, **body):
+        return json.dumps({'type': kind, **body}) + "\n"
+
+    def generate():
+        threading.Thread(target=run, name="preview-download", daemon=True).start()
+        try:
+            yield line('start', leaf_name=leaf_name, max_images=max_images)
+            count = 0
+            while True:
+                try:
+                    item = saved.get(timeout=PREVIEW_HEARTBEAT)
+                except queue.Empty:
+                    yield line('heartbeat')
+                    continue
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    yield line('error', error=str(item))
+                    continue
+                count += 1
+                yield line('image', index=count, image=f"/train/images/{item}", thumbnail=thumbnail_url(item))
+
+            # Everything the class has now, including images from earlier previews
+            image_paths = dataset_manifest.images(folder_name)
+            if image_paths:
+                refresh_prototypes()
+            yield line('done', success=True, count=len(image_paths), downloaded=count, leaf_name=leaf_name,
+                       images=[f"/train/images/{path}" for path in image_paths],
+                       thumbnails=[thumbnail_url(path) for path in image_paths])
+        finally:
+            # Finished, or the client went away: stop whatever is still downloading
+            cancel.set()
+
+    return stream_response(generate(), 'application/x-ndjson')
+
 @app.route('/train/preview', methods=['POST'])
 def preview_training():
+    """Download preview images for a leaf.
+
+    With {"stream": true} (or Accept: application/x-ndjson) each image is
+    streamed as soon as it is saved; otherwise one JSON response is sent
+    once all downloads are done.
+    """
     data = request.json
     leaf_name = data.get('leaf_name')
     max_images = data.get('max_images', 20)
@@ -437,9 +1204,14 @@ def preview_training():
     if not leaf_name:
         return jsonify({'error': 'Leaf name is required'}), 400
     
+    if data.get('stream') or 'application/x-ndjson' in request.headers.get('Accept', ''):
+        return stream_preview(leaf_name, max_images)
+    
     try:
         # Download images using the modular function
         image_paths = download_images_for_preview(f"{leaf_name} leaf", max_images=max_images)
+        if image_paths:
+            refresh_prototypes()
         
         # Return list of image URLs that frontend can fetch
         image_urls = [f"/train/images/{path}" for path in image_paths]
@@ -447,6 +1219,7 @@ def preview_training():
         return jsonify({
             'success': True,
             'images': image_urls,
+            'thumbnails': [thumbnail_url(path) for path in image_paths],
             'count': len(image_urls),
             'leaf_name': leaf_name
         })
@@ -455,11 +1228,33 @@ def preview_training():
 
 @app.route('/train/images/<path:filepath>')
 def serve_training_image(filepath):
-    """Serve images from the dataset directory"""
+    """Serve images from the dataset directory (?size=N for a cached thumbnail)"""
+    size = request.args.get('size', type=int)
+    if not size:
+        try:
+            return send_from_directory(DATASET_DIR, filepath)
+        except Exception as e:
+            return jsonify({'error': str(e)}), 404
+
     try:
-        return send_from_directory(DATASET_DIR, filepath)
+        path, digest, size = thumbnails.get(filepath, size)
+    except FileNotFoundError:
+        return jsonify({'error': f"Image '{filepath}' not found"}), 404
     except Exception as e:
-        return jsonify({'error': str(e)}), 404
+        return jsonify({'error': f"Could not create thumbnail: {str(e)}"}), 500
+
+    # A URL carrying the content version never changes; a bare one must revalidate
+    etag = f"{digest}-{size}"
+    if request.args.get('v') == digest[:16]:
+        cache_control = 'public, max-age=31536000, immutable'
+    else:
+        cache_control = 'no-cache'
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"', 'Cache-Control': cache_control})
+    response = send_file(path, mimetype=thumbnails.mimetype, etag=False, conditional=False, max_age=None)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
 
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
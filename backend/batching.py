@@ -0,0 +1,131 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import nullcontext
+
+
+class BatchScheduler:
+    """Collect concurrent predict requests into one batched forward pass.
+
+    Requests are queued by the HTTP threads and drained by a single worker
+    thread, which also serializes access to the (non thread-safe) YOLO
+    predictor. While one batch is running, new requests pile up in the
+    queue and go out together in the next forward pass.
+
+    `get_active` returns the (version, model) pair to serve with; it is
+    resolved once per batch, so a model swap never splits a batch.
+    `on_batch(size, queue_waits, forward_seconds)` is called after every
+    forward pass, e.g. to record metrics.
+
+    `capture(model)`, if given, is a context manager wrapped around the
+    forward pass that yields a list it fills with feature arrays (e.g. from
+    a hook on the model). Their rows are handed back with each result, so
+    features come from the same batched pass instead of a second one.
+    """
+
+    def __init__(self, get_active, max_batch_size=8, max_wait_ms=5, on_batch=None, capture=None):
+        self._get_active = get_active
+        self.on_batch = on_batch
+        self.capture = capture
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms) / 1000.0)
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_pid = None
+        self._start_lock = threading.Lock()
+        self._last_batch_size = 0
+
+    def submit(self, image):
+        """Queue a decoded image; returns a Future resolving to (YOLO result, model version, features or None)"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((image, future, time.perf_counter()))
+        return future
+
+    def predict(self, image, timeout=None):
+        """Run one image through the model via the shared batch queue"""
+        return self.submit(image).result(timeout=timeout)
+
+    def pending(self):
+        """Number of images waiting for a forward pass"""
+        return self._queue.qsize()
+
+    def _ensure_worker(self):
+        # Started lazily (and per process) so the scheduler survives being
+        # imported before a fork.
+        if self._worker is not None and self._worker.is_alive() and self._worker_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._worker is not None and self._worker.is_alive() and self._worker_pid == os.getpid():
+                return
+            if self._worker_pid != os.getpid():
+                # Items queued in the parent are not ours to serve
+                self._queue = queue.Queue()
+            self._worker_pid = os.getpid()
+            self._worker = threading.Thread(target=self._run, name="predict-batcher", daemon=True)
+            self._worker.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+
+        # Only linger for stragglers when the last batch showed concurrent
+        # traffic; a lone request at low load is dispatched immediately.
+        wait = self.max_wait if self._last_batch_size > 1 else 0.0
+        deadline = time.monotonic() + wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            self._last_batch_size = len(batch)
+
+            # Callers that went away (e.g. a closed batch stream) cancel
+            # their futures; don't spend a forward pass on them.
+            batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            images = [image for image, _, _ in batch]
+            futures = [future for _, future, _ in batch]
+            started = time.perf_counter()
+            queue_waits = [started - queued_at for _, _, queued_at in batch]
+
+            try:
+                version, model = self._get_active()
+                if model is None:
+                    raise RuntimeError("Model not loaded")
+                with self.capture(model) if self.capture else nullcontext([]) as captured:
+                    results = model(images, verbose=False)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            forward_seconds = time.perf_counter() - started
+
+            # Results (and captured feature rows) come back in input order, one per image
+            features = _rows(captured, len(images))
+            for future, result, row in zip(futures, results, features):
+                future.set_result((result, version, row))
+
+            if self.on_batch:
+                try:
+                    self.on_batch(len(images), queue_waits, forward_seconds)
+                except Exception as e:
+                    print(f"Batch callback failed: {e}")
+
+
+def _rows(captured, count):
+    """Split captured feature batches into one row per image; Nones if they don't line up"""
+    rows = [row for batch in captured for row in batch]
+    return rows if len(rows) == count else [None] * count
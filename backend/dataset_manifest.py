@@ -0,0 +1,287 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from PIL import Image
+
+from file_utils import file_digest, file_lock
+from ingest import ACCEPTED_FORMATS
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    relpath TEXT PRIMARY KEY,
+    class TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    format TEXT,
+    digest TEXT,
+    dhash TEXT,
+    source_url TEXT,
+    ingested_at REAL NOT NULL,
+    valid INTEGER NOT NULL DEFAULT 1,
+    split TEXT,
+    linked INTEGER NOT NULL DEFAULT 0,
+    missing INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS images_class ON images (class, missing);
+CREATE TABLE IF NOT EXISTS classes (
+    name TEXT PRIMARY KEY,
+    dir_mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Usable training images: present on disk and decodable
+LIVE = "missing = 0 AND valid = 1"
+
+
+def probe_image(path):
+    """(width, height, format, valid) from the image header, without decoding pixels"""
+    try:
+        with Image.open(path) as image:
+            return image.size[0], image.size[1], image.format, image.format in ACCEPTED_FORMATS
+    except Exception:
+        return None, None, None, False
+
+
+class DatasetManifest:
+    """SQLite index of every image in dataset/<class>/.
+
+    Records class, size, dimensions, content hash, dHash, source URL,
+    ingest time and train/val split of each image, so listing and counting
+    a class never walks the filesystem. Images added by the app are
+    recorded as they are saved; sync() picks up anything changed on disk
+    behind its back: a file counts as changed when its size or st_mtime_ns
+    moved. Rows of deleted files are kept (missing=1) until the split has
+    removed their links, then purged.
+    """
+
+    def __init__(self, db_path, dataset_dir):
+        self.db_path = str(db_path)
+        self.dataset_dir = Path(dataset_dir)
+        self.sync_lock_path = self.db_path + ".sync.lock"
+        self._sync_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    # --- Recording ---
+
+    def add(self, path, info=None, source_url=None):
+        """Record an image just saved into the dataset (`info` as returned by ingest_image)"""
+        path = Path(path)
+        stat = path.stat()
+        if info is not None:
+            width, height = info['size']
+            image_format, valid, dhash = 'JPEG', True, f"{info['hash']:016x}"
+        else:
+            width, height, image_format, valid = probe_image(path)
+            dhash = None
+        row = (
+            f"{path.parent.name}/{path.name}", path.parent.name, path.name, stat.st_size, stat.st_mtime_ns,
+            width, height, image_format, file_digest(path), dhash, source_url, time.time(), int(valid)
+        )
+        with self._connect() as conn:
+            self._upsert(conn, [row])
+
+    @staticmethod
+    def _upsert(conn, rows):
+        # A replaced file keeps its split, but its link must be remade. Its
+        # dHash only survives if the content is unchanged.
+        conn.executemany(
+            "INSERT INTO images (relpath, class, name, size, mtime_ns, width, height, format, digest, dhash, "
+            "source_url, ingested_at, valid) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(relpath) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, "
+            "width = excluded.width, height = excluded.height, format = excluded.format, digest = excluded.digest, "
+            "dhash = CASE WHEN excluded.dhash IS NOT NULL THEN excluded.dhash WHEN excluded.digest = digest THEN dhash END, "
+            "source_url = COALESCE(excluded.source_url, source_url), "
+            "ingested_at = excluded.ingested_at, valid = excluded.valid, linked = 0, missing = 0",
+            rows
+        )
+
+    def remove_class(self, class_name):
+        """Mark every image of a deleted class folder as gone"""
+        with self._connect() as conn:
+            conn.execute("UPDATE images SET missing = 1 WHERE class = ?", (class_name,))
+            conn.execute("DELETE FROM classes WHERE name = ?", (class_name,))
+
+    def remove(self, relpaths):
+        with self._connect() as conn:
+            conn.executemany("UPDATE images SET missing = 1 WHERE relpath = ?", [(p,) for p in relpaths])
+
+    def sync(self, force=False):
+        """Bring the manifest in line with the files on disk; returns the number of changed rows.
+
+        By default only class folders whose mtime changed (a file was added,
+        removed or atomically replaced) are listed. force=True stats every
+        file, which also catches files rewritten in place: that doesn't move
+        the folder's mtime. Either way only new or modified files are read.
+        Syncs hold a file lock, so processes starting together take turns
+        and the later ones find nothing left to do.
+        """
+        changed = 0
+        with self._sync_lock, file_lock(self.sync_lock_path), self._connect() as conn:
+            known = {row['name']: row['dir_mtime_ns'] for row in conn.execute("SELECT * FROM classes")}
+            present = set()
+            if self.dataset_dir.exists():
+                for entry in os.scandir(self.dataset_dir):
+                    if not entry.is_dir() or entry.name.startswith('.'):
+                        continue
+                    present.add(entry.name)
+                    dir_mtime = entry.stat().st_mtime_ns
+                    if not force and known.get(entry.name) == dir_mtime:
+                        continue
+                    changed += self._sync_class(conn, entry.name, Path(entry.path))
+                    conn.execute("INSERT OR REPLACE INTO classes (name, dir_mtime_ns) VALUES (?, ?)",
+                                 (entry.name, dir_mtime))
+
+            gone = [name for name in known if name not in present]
+            gone += [row['class'] for row in conn.execute("SELECT DISTINCT class FROM images WHERE missing = 0")
+                     if row['class'] not in present and row['class'] not in gone]
+            for name in gone:
+                changed += conn.execute("UPDATE images SET missing = 1 WHERE class = ? AND missing = 0",
+                                        (name,)).rowcount
+                conn.execute("DELETE FROM classes WHERE name = ?", (name,))
+        if changed:
+            print(f"Dataset manifest: {changed} images changed on disk")
+        return changed
+
+    def _sync_class(self, conn, class_name, class_dir):
+        on_disk = {}
+        for entry in os.scandir(class_dir):
+            if entry.is_file() and not entry.name.startswith('.') and Path(entry.name).suffix.lower() in IMAGE_EXTENSIONS:
+                stat = entry.stat()
+                on_disk[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        recorded = {
+            row['name']: (row['size'], row['mtime_ns'], row['missing'])
+            for row in conn.execute("SELECT name, size, mtime_ns, missing FROM images WHERE class = ?", (class_name,))
+        }
+
+        rows = []
+        for name, (size, mtime_ns) in on_disk.items():
+            if recorded.get(name) == (size, mtime_ns, 0):
+                continue
+            path = class_dir / name
+            width, height, image_format, valid = probe_image(path)
+            try:
+                digest = file_digest(path)
+            except OSError:
+                continue # removed while we were looking
+            rows.append((f"{class_name}/{name}", class_name, name, size, mtime_ns,
+                         width, height, image_format, digest, None, None, time.time(), int(valid)))
+        removed = [(f"{class_name}/{name}",) for name, entry in recorded.items() if name not in on_disk and not entry[2]]
+
+        conn.execute("BEGIN")
+        self._upsert(conn, rows)
+        conn.executemany("UPDATE images SET missing = 1 WHERE relpath = ?", removed)
+        conn.execute("COMMIT")
+        return len(rows) + len(removed)
+
+    # --- Queries ---
+
+    def classes(self):
+        """{class: usable image count}"""
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT class, COUNT(*) AS n FROM images WHERE {LIVE} GROUP BY class ORDER BY class")
+            return {row['class']: row['n'] for row in rows}
+
+    def count(self, class_name):
+        with self._connect() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM images WHERE class = ? AND {LIVE}", (class_name,)).fetchone()[0]
+
+    def images(self, class_name):
+        """Relative paths ("<class>/<file>") of a class's usable images"""
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT relpath FROM images WHERE class = ? AND {LIVE} ORDER BY name", (class_name,))
+            return [row['relpath'] for row in rows]
+
+    def get(self, relpath):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM images WHERE relpath = ?", (relpath,)).fetchone()
+            return dict(row) if row else None
+
+    def class_signatures(self):
+        """{class: [usable image count, newest mtime_ns]}; changes whenever a class's images do"""
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT class, COUNT(*) AS n, MAX(mtime_ns) AS newest FROM images "
+                                f"WHERE {LIVE} GROUP BY class ORDER BY class")
+            return {row['class']: [row['n'], row['newest']] for row in rows}
+
+    def dhashes(self):
+        """[(relpath, digest, dHash or None)] of every usable image"""
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT relpath, digest, dhash FROM images WHERE {LIVE} ORDER BY relpath")
+            return [(row['relpath'], row['digest'], None if row['dhash'] is None else int(row['dhash'], 16))
+                    for row in rows]
+
+    def set_dhashes(self, rows):
+        """Store [(relpath, digest, dHash)] computed elsewhere, unless the file changed since"""
+        with self._connect() as conn:
+            conn.execute("BEGIN")
+            conn.executemany("UPDATE images SET dhash = ? WHERE relpath = ? AND digest = ?",
+                             [(f"{value:016x}", relpath, digest) for relpath, digest, value in rows])
+            conn.execute("COMMIT")
+
+    # --- Train/val split state (used by prepare_data_split) ---
+
+    def setting(self, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+            return row['value'] if row else None
+
+    def set_setting(self, key, value):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+
+    def split_rows(self):
+        """Every row that is usable or still has a split link to clean up"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT relpath, class, name, split, linked, missing, valid FROM images "
+                "WHERE (missing = 0 AND valid = 1) OR split IS NOT NULL ORDER BY class, name"
+            )
+            return [dict(row) for row in rows]
+
+    def record_links(self, assignments):
+        """Store [(relpath, split)] whose links now match the files"""
+        with self._connect() as conn:
+            conn.execute("BEGIN")
+            conn.executemany("UPDATE images SET split = ?, linked = 1 WHERE relpath = ?",
+                             [(split, relpath) for relpath, split in assignments])
+            conn.execute("COMMIT")
+
+    def reset_splits(self):
+        with self._connect() as conn:
+            conn.execute("UPDATE images SET split = NULL, linked = 0")
+
+    def clear_links(self, relpaths):
+        """Take images out of the split (e.g. a file that became unreadable)"""
+        with self._connect() as conn:
+            conn.executemany("UPDATE images SET split = NULL, linked = 0 WHERE relpath = ?", [(p,) for p in relpaths])
+
+    def purge(self, relpaths):
+        """Forget rows whose files and split links are gone"""
+        with self._connect() as conn:
+            conn.execute("BEGIN")
+            conn.executemany("DELETE FROM images WHERE relpath = ? AND missing = 1", [(p,) for p in relpaths])
+            conn.execute("COMMIT")
@@ -0,0 +1,265 @@
+import json
+import os
+import sqlite3
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+from PIL import Image
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+INDEX_FILENAME = ".phash_index.sqlite"
+# Earlier JSON index, imported once
+LEGACY_INDEX_FILENAME = ".phash_index.json"
+
+# dHash is 64 bits; split into 8 bands of 8 bits for multi-index lookup.
+# Two hashes within Hamming distance <= 7 must agree exactly on at least one
+# band (pigeonhole), so only images sharing a band value are compared.
+HASH_BITS = 64
+BAND_BITS = 8
+BANDS = HASH_BITS // BAND_BITS
+MAX_THRESHOLD = BANDS - 1
+DEFAULT_THRESHOLD = int(os.environ.get("DEDUP_THRESHOLD", 6))
+
+
+def dhash(image):
+    """64-bit difference hash of a PIL image"""
+    small = image.convert('L').resize((9, 8), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def dhash_file(path):
+    """dHash of an image file (or file-like object); raises if it can't be decoded"""
+    with Image.open(path) as image:
+        image.draft('L', (64, 64)) # JPEG: decode at reduced size, much faster
+        return dhash(image)
+
+
+def _bands(value):
+    return [(band, (value >> (band * BAND_BITS)) & ((1 << BAND_BITS) - 1)) for band in range(BANDS)]
+
+
+def _to_signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def _to_unsigned(value):
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+
+BAND_COLUMNS = [f"b{band}" for band in range(BANDS)]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    relpath TEXT PRIMARY KEY,
+    hash INTEGER NOT NULL,
+    {columns}
+);
+{indexes}
+""".format(
+    columns=",\n    ".join(f"{column} INTEGER NOT NULL" for column in BAND_COLUMNS),
+    indexes="\n".join(f"CREATE INDEX IF NOT EXISTS hashes_{column} ON hashes ({column});" for column in BAND_COLUMNS)
+)
+
+
+class PerceptualIndex:
+    """Perceptual-hash index over every image in a dataset directory.
+
+    Used to reject near-duplicates (thumbnails, re-encodes, re-hosted
+    copies) at ingest time and to dedupe existing class folders. The index
+    is an SQLite table next to the class folders, shared by every process:
+    check_and_add() looks up and inserts in one write transaction, so two
+    workers can't both accept copies of the same image. Each band value has
+    its own column index, so a lookup only compares rows sharing a band.
+    """
+
+    def __init__(self, dataset_dir, threshold=DEFAULT_THRESHOLD):
+        if threshold > MAX_THRESHOLD:
+            raise ValueError(f"threshold must be <= {MAX_THRESHOLD}")
+        self.dataset_dir = Path(dataset_dir)
+        self.index_path = self.dataset_dir / INDEX_FILENAME
+        self.threshold = threshold
+        self.dataset_dir.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+        self._import_legacy()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(str(self.index_path), timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _import_legacy(self):
+        """Carry hashes over from the JSON index used before the SQLite one"""
+        legacy_path = self.dataset_dir / LEGACY_INDEX_FILENAME
+        if not legacy_path.exists():
+            return
+        try:
+            with open(legacy_path, 'r') as f:
+                stored = json.load(f)
+        except Exception as e:
+            print(f"Ignoring unreadable dedup index: {e}")
+            stored = {}
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._insert(conn, [(relpath, int(hex_hash, 16)) for relpath, hex_hash in stored.items()], replace=False)
+            conn.execute("COMMIT")
+        legacy_path.unlink(missing_ok=True)
+
+    def relpath(self, path):
+        return Path(path).resolve().relative_to(self.dataset_dir.resolve()).as_posix()
+
+    @staticmethod
+    def _insert(conn, entries, replace=True):
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        conn.executemany(
+            f"{verb} INTO hashes (relpath, hash, {', '.join(BAND_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * (BANDS + 2))})",
+            [(relpath, _to_signed(value), *(band_value for _, band_value in _bands(value)))
+             for relpath, value in entries]
+        )
+
+    def _find(self, conn, value, exclude=None):
+        where = " OR ".join(f"{column} = ?" for column in BAND_COLUMNS)
+        rows = conn.execute(f"SELECT relpath, hash FROM hashes WHERE {where} ORDER BY relpath",
+                            [band_value for _, band_value in _bands(value)])
+        for relpath, stored in rows:
+            if relpath != exclude and (_to_unsigned(stored) ^ value).bit_count() <= self.threshold:
+                return relpath
+        return None
+
+    def find(self, value, exclude=None):
+        """Relative path of an indexed near-duplicate of `value`, or None"""
+        with self._connect() as conn:
+            return self._find(conn, value, exclude)
+
+    def add(self, path, value):
+        with self._connect() as conn:
+            self._insert(conn, [(self.relpath(path), value)])
+
+    def check_and_add(self, path, value):
+        """Index `path` unless it duplicates an existing image; returns the duplicate's path"""
+        relpath = self.relpath(path)
+        with self._connect() as conn:
+            # Takes the write lock up front: no other process can add in between
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                duplicate = self._find(conn, value, exclude=relpath)
+                if duplicate is None:
+                    self._insert(conn, [(relpath, value)])
+            finally:
+                conn.execute("COMMIT")
+            return duplicate
+
+    def remove(self, path):
+        self.remove_many([self.relpath(path)])
+
+    def remove_many(self, relpaths):
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM hashes WHERE relpath = ?", [(p,) for p in relpaths])
+
+    def remove_class(self, class_name):
+        prefix = f"{class_name}/"
+        with self._connect() as conn:
+            conn.execute("DELETE FROM hashes WHERE substr(relpath, 1, ?) = ?", (len(prefix), prefix))
+
+    def entries(self):
+        """[(relpath, hash)] of every indexed image, sorted by path"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT relpath, hash FROM hashes ORDER BY relpath")
+            return [(relpath, _to_unsigned(stored)) for relpath, stored in rows]
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+
+    def sync(self, manifest=None):
+        """Hash files missing from the index and forget files that are gone.
+
+        With a DatasetManifest the file list and the dHashes recorded at
+        ingest come from it; only images it has no dHash for are decoded,
+        and those hashes are stored back in the manifest. Without one the
+        class folders are listed.
+        """
+        with self._connect() as conn:
+            indexed = {relpath: _to_unsigned(stored)
+                       for relpath, stored in conn.execute("SELECT relpath, hash FROM hashes")}
+
+        if manifest is not None:
+            rows = manifest.dhashes()
+            known = {relpath: value for relpath, _, value in rows}
+            self.remove_many(set(indexed) - set(known))
+            # A null dHash means a new or replaced file: hash it even if indexed
+            missing = [(relpath, digest) for relpath, digest, value in rows if value is None]
+            entries = [(relpath, value) for relpath, value in known.items()
+                       if value is not None and indexed.get(relpath) != value]
+            replace = True
+        else:
+            on_disk = set()
+            if self.dataset_dir.exists():
+                for class_dir in self.dataset_dir.iterdir():
+                    if not class_dir.is_dir():
+                        continue
+                    for f in class_dir.iterdir():
+                        if f.is_file() and f.suffix.lower() in IMAGE_EXTENSIONS:
+                            on_disk.add(f"{class_dir.name}/{f.name}")
+            self.remove_many(set(indexed) - on_disk)
+            missing = [(relpath, None) for relpath in sorted(on_disk - set(indexed))]
+            entries = []
+            # Keep hashes another process recorded meanwhile (e.g. at upload)
+            replace = False
+
+        hashed = []
+        for relpath, digest in missing:
+            try:
+                hashed.append((relpath, digest, dhash_file(self.dataset_dir / relpath)))
+            except Exception as e:
+                print(f"Skipping unreadable image {relpath}: {e}")
+        entries += [(relpath, value) for relpath, _, value in hashed]
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._insert(conn, entries, replace=replace)
+            conn.execute("COMMIT")
+        if manifest is not None and hashed:
+            manifest.set_dhashes(hashed)
+
+
+def dedupe_dataset(dataset_dir, threshold=DEFAULT_THRESHOLD, dry_run=False, manifest=None):
+    """Delete near-duplicate images across all class folders, keeping the first seen"""
+    index = PerceptualIndex(dataset_dir, threshold=threshold)
+    index.sync(manifest)
+
+    # Walk in a stable order so the earliest file of each group survives
+    entries = index.entries()
+    kept = defaultdict(list)  # (band, band value) -> [(relpath, hash)] of kept images
+    removed = []
+    for relpath, value in entries:
+        duplicate = next((other for key in _bands(value) for other, other_value in kept[key]
+                          if (other_value ^ value).bit_count() <= threshold), None)
+        if duplicate is None:
+            for key in _bands(value):
+                kept[key].append((relpath, value))
+            continue
+        removed.append({'image': relpath, 'duplicate_of': duplicate})
+        if not dry_run:
+            (Path(dataset_dir) / relpath).unlink(missing_ok=True)
+
+    if not dry_run:
+        index.remove_many([entry['image'] for entry in removed])
+    print(f"Dedup: {len(removed)} near-duplicates {'found' if dry_run else 'removed'} out of {len(entries)} images")
+    return removed
+
+if __name__ == "__main__":
+    dedupe_dataset("dataset")
@@ -1,81 +1,220 @@
 import os
 import requests
+import threading
 import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from ddgs import DDGS
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
 
-def download_images(keywords, max_images=50, base_dir=None):
-    for keyword in keywords:
-        print(f"Searching for {keyword}...")
-        # Create folder based on the leaf name (e.g., "Hibiscus leaf" -> "hibiscus")
-        folder_name = keyword.split(' ')[0].lower()# specific handling if needed
-        
-        # Use base_dir if provided, otherwise use relative path
-        if base_dir:
-            save_dir = Path(base_dir) / folder_name
-        else:
-            save_dir = Path(f"dataset/{folder_name}")
-        save_dir.mkdir(parents=True, exist_ok=True)
-        
-        count = 0
+from ingest import OUTPUT_EXTENSION, ingest_image
+
+# Add user-agent to avoid some 403s from image hosts
+HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 16))
+DOWNLOAD_PER_HOST_LIMIT = int(os.environ.get("DOWNLOAD_PER_HOST_LIMIT", 4))
+DOWNLOAD_MAX_BYTES = int(float(os.environ.get("DOWNLOAD_MAX_MB", 15)) * 1024 * 1024)
+DOWNLOAD_TIMEOUT = (3.05, 5)  # (connect, read) seconds
+CHUNK_SIZE = 64 * 1024
+# How often a running download checks whether its caller cancelled it
+CANCEL_POLL_INTERVAL = 0.5
+
+
+class DownloadCancelled(Exception):
+    """Raised inside a worker once enough images have been saved"""
+
+
+class DuplicateImage(Exception):
+    """Raised when a download is a near-duplicate of an image we already have"""
+
+
+class HostPool:
+    """One pooled session and a concurrency cap per image host"""
+
+    def __init__(self, per_host_limit=DOWNLOAD_PER_HOST_LIMIT):
+        self.per_host_limit = per_host_limit
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        host = urlparse(url).netloc.lower()
+        with self._lock:
+            if host not in self._hosts:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.per_host_limit)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers.update(HEADERS)
+                self._hosts[host] = (session, threading.BoundedSemaphore(self.per_host_limit))
+            return self._hosts[host]
+
+    def close(self):
+        with self._lock:
+            for session, _ in self._hosts.values():
+                session.close()
+            self._hosts.clear()
+
+
+def search_images(keyword, max_results):
+    """Image search with retries; returns the raw DDGS results"""
+    max_retries = 3
+    for attempt in range(max_retries):
         try:
-            results = []
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    with DDGS() as ddgs:
-                        # Fetch more than 50 just in case some fail to download
-                        results = list(ddgs.images(keyword, max_results=max_images + 30))
-                        if results:
-                            print(f"Found {len(results)} search results for '{keyword}'")
-                            break
-                except Exception as e:
-                    print(f"Attempt {attempt+1}/{max_retries} failed for '{keyword}': {e}")
-                    if attempt < max_retries - 1:
-                        time.sleep(2 * (attempt + 1)) # Exponential backoff: 2s, 4s, ...
-            
-            if not results:
-                print(f"Could not find any images for '{keyword}' after {max_retries} attempts")
-                continue
-
-            for result in results:
+            with DDGS() as ddgs:
+                results = list(ddgs.images(keyword, max_results=max_results))
+                if results:
+                    print(f"Found {len(results)} search results for '{keyword}'")
+                    return results
+        except Exception as e:
+            print(f"Attempt {attempt+1}/{max_retries} failed for '{keyword}': {e}")
+            if attempt < max_retries - 1:
+                time.sleep(2 * (attempt + 1)) # Exponential backoff: 2s, 4s, ...
+    return []
+
+
+def fetch_to_file(hosts, url, file_path, stop_event, max_bytes=DOWNLOAD_MAX_BYTES):
+    """Stream one URL to disk, aborting on the size cap or once we're done"""
+    session, slots = hosts.get(url)
+    with slots:
+        if stop_event.is_set():
+            raise DownloadCancelled()
+        with session.get(url, timeout=DOWNLOAD_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            declared = response.headers.get('Content-Length')
+            if declared and declared.isdigit() and int(declared) > max_bytes:
+                raise ValueError(f"Image too large ({declared} bytes)")
+
+            written = 0
+            with open(file_path, 'wb') as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    if stop_event.is_set():
+                        raise DownloadCancelled()
+                    written += len(chunk)
+                    if written > max_bytes:
+                        raise ValueError(f"Image larger than {max_bytes} bytes")
+                    f.write(chunk)
+            if written == 0:
+                raise ValueError("Empty response")
+
+
+def download_keyword(keyword, save_dir, folder_name, max_images, hosts, dedup_index=None, manifest=None,
+                     on_saved=None, cancel_event=None, workers=DOWNLOAD_WORKERS):
+    """Download up to max_images search results for one keyword concurrently.
+
+    `on_saved(file_path, info)` is called as each validated image lands in
+    save_dir. Setting `cancel_event` abandons the remaining downloads.
+    """
+    # Fetch more than max_images just in case some fail to download
+    results = search_images(keyword, max_images + 30)
+    if not results:
+        print(f"Could not find any images for '{keyword}'")
+        return 0
+
+    stop_event = threading.Event()
+    lock = threading.Lock()
+    count = 0
+    # Unique per call: earlier previews, a training top-up or a download in
+    # another worker may be filling the same class folder
+    call_id = uuid.uuid4().hex[:12]
+
+    def worker(slot, image_url):
+        nonlocal count
+        part_path = save_dir / f".{folder_name}_{call_id}_{slot:03d}.part"
+        staged_path = save_dir / f".{folder_name}_{call_id}_{slot:03d}.ingest"
+        try:
+            fetch_to_file(hosts, image_url, part_path, stop_event)
+            # Rejects HTML error pages and broken files; stores a capped RGB JPEG
+            info = ingest_image(part_path, staged_path)
+
+            with lock:
                 if count >= max_images:
+                    raise DownloadCancelled()
+                file_path = save_dir / f"{folder_name}_{call_id}_{count:03d}{OUTPUT_EXTENSION}"
+                if dedup_index is not None:
+                    duplicate = dedup_index.check_and_add(file_path, info['hash'])
+                    if duplicate is not None:
+                        raise DuplicateImage(duplicate)
+                os.replace(staged_path, file_path)
+                if manifest is not None:
+                    manifest.add(file_path, info, source_url=image_url)
+                if on_saved is not None:
+                    on_saved(file_path, info)
+                count += 1
+                print(f"[{count}/{max_images}] Downloaded {folder_name} image")
+                if count >= max_images:
+                    stop_event.set()
+        finally:
+            for path in (part_path, staged_path):
+                if path.exists():
+                    path.unlink()
+
+    urls = iter(enumerate(result['image'] for result in results if result.get('image')))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download") as pool:
+        # Keep only as many requests in flight as there are workers, so that
+        # stopping early leaves nothing queued behind.
+        in_flight = set()
+        while not stop_event.is_set():
+            while len(in_flight) < workers:
+                item = next(urls, None)
+                if item is None:
                     break
-                
-                image_url = result['image']
+                in_flight.add(pool.submit(worker, *item))
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, timeout=CANCEL_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            if cancel_event is not None and cancel_event.is_set():
+                print(f"Download of '{keyword}' cancelled after {count} images")
+                break
+            for future in done:
                 try:
-                    # Add user-agent to avoid some 403s from image hosts
-                    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-                    response = requests.get(image_url, timeout=5, headers=headers)
-                    response.raise_for_status()
-                    
-                    # Determine extension or default to .jpg
-                    ext = '.jpg'
-                    if 'png' in image_url.lower(): ext = '.png'
-                    elif 'jpeg' in image_url.lower(): ext = '.jpg'
-                    
-                    file_path = save_dir / f"{folder_name}_{count:03d}{ext}"
-                    
-                    with open(file_path, 'wb') as f:
-                        f.write(response.content)
-                    
-                    count += 1
-                    print(f"[{count}/{max_images}] Downloaded {folder_name} image")
-                    
-                except Exception as e:
-                    # print(f"Failed to download {image_url}: {e}") # Reduce noise
-                    pass
-                    
-        except Exception as search_err:
-            print(f"Search failed for {keyword}: {search_err}")
+                    future.result()
+                except Exception:
+                    pass # Failed or cancelled downloads are expected; reduce noise
+
+        # Enough good images: stop streaming bodies we no longer need
+        stop_event.set()
+        for future in in_flight:
+            future.cancel()
+
+    return count
+
+
+def download_images(keywords, max_images=50, base_dir=None, dedup_index=None, manifest=None, on_saved=None, cancel_event=None):
+    hosts = HostPool()
+    try:
+        for keyword in keywords:
+            if cancel_event is not None and cancel_event.is_set():
+                print("Download cancelled")
+                break
+            print(f"Searching for {keyword}...")
+            # Create folder based on the leaf name (e.g., "Hibiscus leaf" -> "hibiscus")
+            folder_name = keyword.split(' ')[0].lower()# specific handling if needed
+
+            # Use base_dir if provided, otherwise use relative path
+            if base_dir:
+                save_dir = Path(base_dir) / folder_name
+            else:
+                save_dir = Path(f"dataset/{folder_name}")
+            save_dir.mkdir(parents=True, exist_ok=True)
+
+            try:
+                download_keyword(keyword, save_dir, folder_name, max_images, hosts, dedup_index=dedup_index,
+                                 manifest=manifest, on_saved=on_saved, cancel_event=cancel_event)
+            except Exception as search_err:
+                print(f"Search failed for {keyword}: {search_err}")
+    finally:
+        hosts.close()
 
 if __name__ == "__main__":
     leaves = [
         "Hibiscus leaf",
-        "Tulasi leaf", 
-        "Rose leaf", 
-        "Neem leaf", 
-        "Onion leaf", 
+        "Tulasi leaf",
+        "Rose leaf",
+        "Neem leaf",
+        "Onion leaf",
         "Jasmine leaf" # Using correct spelling for search
     ]
     download_images(leaves)
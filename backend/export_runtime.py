@@ -0,0 +1,147 @@
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+from ultralytics import YOLO
+
+# torch (default), onnx or openvino. Exported runtimes go through the same
+# ultralytics predictor, so preprocessing and top-5 postprocessing match.
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch").lower()
+EXPORT_FORMATS = [f.strip() for f in os.environ.get("EXPORT_FORMATS", "onnx,openvino").split(",") if f.strip()]
+# Share of sample images whose top-1 must match PyTorch for an export to be served
+PARITY_MIN_AGREEMENT = float(os.environ.get("PARITY_MIN_AGREEMENT", 1.0))
+BENCHMARK_RUNS = int(os.environ.get("BENCHMARK_RUNS", 3))
+
+
+def openvino_available():
+    try:
+        import openvino # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def runtime_artifact(version_dir, backend):
+    """Path of an exported model for `backend` inside a registry version folder"""
+    version_dir = Path(version_dir)
+    if backend == 'onnx':
+        path = version_dir / "weights.onnx"
+    elif backend == 'openvino':
+        path = version_dir / "weights_openvino_model"
+    else:
+        return None
+    return path if path.exists() else None
+
+
+def load_runtime(version_dir, backend):
+    """YOLO wrapper around an exported model"""
+    path = runtime_artifact(version_dir, backend)
+    if path is None:
+        raise FileNotFoundError(f"No {backend} export in {version_dir}")
+    return YOLO(str(path), task='classify')
+
+
+def top1_predictions(model, images, batch=16):
+    top1 = []
+    for start in range(0, len(images), batch):
+        for result in model(images[start:start + batch], verbose=False):
+            top1.append(result.names[result.probs.top1])
+    return top1
+
+
+def benchmark(model, images, runs=BENCHMARK_RUNS, batch=16):
+    """Per-image latency (batch of one) and batched throughput on CPU"""
+    model(images[0], verbose=False) # warm-up
+
+    latencies = []
+    for _ in range(runs):
+        for image in images:
+            started = time.perf_counter()
+            model(image, verbose=False)
+            latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+
+    started = time.perf_counter()
+    for _ in range(runs):
+        for offset in range(0, len(images), batch):
+            model(images[offset:offset + batch], verbose=False)
+    elapsed = time.perf_counter() - started
+
+    return {
+        'latency_p50_ms': round(latencies[len(latencies) // 2], 2),
+        'latency_p95_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2),
+        'throughput_ips': round(runs * len(images) / elapsed, 1)
+    }
+
+
+def sample_images(data_dir, limit=32, imgsz=224):
+    """Validation images to check exports against; random pixels if there are none.
+
+    Images are taken round-robin across class folders, so the parity check
+    covers as many output classes as `limit` allows.
+    """
+    val_dir = Path(data_dir) / "val" if data_dir else None
+    per_class = []
+    if val_dir is not None and val_dir.exists():
+        for class_dir in sorted(d for d in val_dir.iterdir() if d.is_dir()):
+            files = sorted(p for p in class_dir.iterdir() if p.suffix.lower() in ['.jpg', '.jpeg', '.png'])
+            if files:
+                per_class.append(files)
+    images = []
+    for round_index in range(max(map(len, per_class), default=0)):
+        for files in per_class:
+            if round_index < len(files) and len(images) < limit:
+                images.append(str(files[round_index]))
+        if len(images) >= limit:
+            break
+    if images:
+        return images
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 255, (imgsz, imgsz, 3), dtype=np.uint8) for _ in range(8)]
+
+
+def export_and_verify(weights_path, images, imgsz=224, formats=EXPORT_FORMATS):
+    """Export weights to each runtime, then compare top-1 and speed against PyTorch.
+
+    Exports are written next to `weights_path`. Returns a report keyed by
+    backend; an export is only marked `parity_ok` if its top-1 agrees with
+    PyTorch on at least PARITY_MIN_AGREEMENT of the sample images.
+    """
+    weights_path = Path(weights_path)
+    reference = YOLO(str(weights_path))
+    expected = top1_predictions(reference, images)
+    report = {'torch': benchmark(reference, images)}
+
+    for fmt in formats:
+        if fmt == 'openvino' and not openvino_available():
+            continue
+        try:
+            exported = Path(YOLO(str(weights_path)).export(format=fmt, imgsz=imgsz, dynamic=True))
+            # ultralytics names exports after the weights file; keep them in the version folder
+            target = weights_path.parent / exported.name
+            if exported.resolve() != target.resolve():
+                if target.is_dir():
+                    shutil.rmtree(target)
+                elif target.exists():
+                    target.unlink()
+                shutil.move(str(exported), str(target))
+
+            runtime = load_runtime(weights_path.parent, fmt)
+            actual = top1_predictions(runtime, images)
+            agreement = sum(a == b for a, b in zip(expected, actual)) / len(expected)
+            report[fmt] = {
+                'top1_agreement': round(agreement, 4),
+                'parity_ok': agreement >= PARITY_MIN_AGREEMENT,
+                **benchmark(runtime, images)
+            }
+        except Exception as e:
+            print(f"{fmt} export failed: {e}")
+            report[fmt] = {'error': str(e), 'parity_ok': False}
+
+    for backend, stats in report.items():
+        if 'latency_p50_ms' in stats:
+            print(f"[{backend}] p50 {stats['latency_p50_ms']}ms, p95 {stats['latency_p95_ms']}ms, "
+                  f"{stats['throughput_ips']} img/s" + (f", top-1 agreement {stats['top1_agreement']:.2%}" if 'top1_agreement' in stats else ""))
+    return report
@@ -0,0 +1,80 @@
+"""Small filesystem and host helpers with no heavy imports, safe to use from any process."""
+import hashlib
+import math
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError: # Windows: no cross-process locking
+    fcntl = None
+
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """Exclusive lock on `path` shared by every process on this host.
+
+    Yields True once the lock is held. With blocking=False it yields False
+    right away if another process holds it. The lock is released when the
+    block exits or the holding process dies.
+    """
+    if fcntl is None:
+        yield True
+        return
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def file_digest(path):
+    """Content hash of a file, read in 1 MB chunks"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _cgroup_cpu_limit():
+    """CPU quota of this container in cores (cgroup v2, then v1); None if unlimited"""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus():
+    """Cores this process may actually use.
+
+    os.cpu_count() reports every core of the host; a container is usually
+    pinned to fewer (CPU affinity) or throttled to a quota (cgroup cpu.max).
+    """
+    try:
+        count = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        count = os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        count = min(count, max(1, math.ceil(limit)))
+    return max(1, count)
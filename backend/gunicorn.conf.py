@@ -0,0 +1,67 @@
+"""Production serving: N pre-forked inference workers sharing the preloaded model.
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The app (and the active model) is imported once in the master and forked,
+so the read-only weights are shared copy-on-write. Each worker then sets
+its own torch thread count and starts its background threads. A model
+version activated in any worker is picked up by the others through
+models/registry.json.
+"""
+import gc
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from file_utils import available_cpus
+
+# Cores this container may use: CPU affinity and the cgroup quota, not the host's count
+cpu_count = available_cpus()
+
+# Intra-op threads per worker; workers x threads should not exceed the cores
+TORCH_THREADS_PER_WORKER = int(os.environ.get("TORCH_THREADS_PER_WORKER", 1))
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", max(1, cpu_count // TORCH_THREADS_PER_WORKER)))
+worker_class = "gthread"
+# Concurrent requests per worker; they share the worker's batch scheduler.
+# Each open /train/events or streamed preview holds one of them until it ends.
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+# Streams beyond this many per worker get a 503, so at least the other half
+# of the threads stays free for /predict
+os.environ.setdefault("STREAM_MAX_CLIENTS", str(max(1, threads // 2)))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+preload_app = True
+
+# The master only loads and warms the model: keep its OpenMP pool at one
+# thread so no OpenMP worker threads exist at fork time, and don't start
+# the app's background threads there.
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ["DEFER_BACKGROUND_WORKERS"] = "true"
+# Training runs in train_worker.py (started next to gunicorn in the Dockerfile),
+# not in the serving workers
+os.environ.setdefault("TRAINING_IN_WEB_WORKERS", "false")
+# Each worker writes its metrics here; /metrics in any worker sums them
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), "leaf_metrics"))
+
+
+def on_starting(server):
+    # Snapshots from a previous run would be added to this one's totals
+    shutil.rmtree(os.environ["METRICS_DIR"], ignore_errors=True)
+
+
+def pre_fork(server, worker):
+    # Move everything allocated so far out of the GC's reach so collections
+    # in the workers don't write to (and un-share) the preloaded pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import torch
+    torch.set_num_threads(TORCH_THREADS_PER_WORKER)
+
+    import app
+    app.start_background_workers()
+    server.log.info(f"Worker {worker.pid} ready ({TORCH_THREADS_PER_WORKER} torch threads)")
@@ -0,0 +1,245 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+from ultralytics.data import ClassificationDataset
+from ultralytics.models.yolo.classify import ClassificationTrainer, ClassificationValidator
+
+from file_utils import available_cpus, file_digest, file_lock
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+PREPROCESS_WORKERS = int(os.environ.get("PREPROCESS_WORKERS", available_cpus()))
+
+
+def resize_center_crop(image, size):
+    """Shortest side to `size`, then a centered size x size crop"""
+    h, w = image.shape[:2]
+    scale = size / min(h, w)
+    resized = cv2.resize(image, (max(size, round(w * scale)), max(size, round(h * scale))), interpolation=cv2.INTER_AREA)
+    h, w = resized.shape[:2]
+    top, left = (h - size) // 2, (w - size) // 2
+    return resized[top:top + size, left:left + size]
+
+
+class ImageArrayStore:
+    """Decoded, resized dataset images kept in one memory-mapped uint8 array.
+
+    Slots are keyed by content hash so an image is decoded once no matter
+    how many runs (or hardlinked split copies) use it. A small index maps
+    file identity (device, inode, size, mtime) to the hash, so unchanged
+    files are not even re-read.
+
+    sync() is the only writer: it holds a lock file shared by every process,
+    reloads the index, and treats the paths it is given as the whole dataset.
+    Slots of images that are gone or replaced are freed for reuse, and the
+    array is compacted once more than half of it is free.
+    """
+
+    def __init__(self, root, size=224):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.size = size
+        self.array_path = self.root / f"images_{size}.u8"
+        self.index_path = self.root / f"index_{size}.json"
+        self.lock_path = self.root / f"index_{size}.lock"
+        self._lock = threading.Lock()
+        self._array = None
+        self._array_pid = None
+        self._load_index()
+
+    def _load_index(self):
+        self.slots = {}  # content hash -> slot
+        self.files = {}  # "dev:ino" -> [size, mtime_ns, content hash]
+        self.free = []   # slots no longer referenced, reused before the array grows
+        self.capacity = 0
+        if self.index_path.exists() and self.array_path.exists():
+            try:
+                with open(self.index_path, 'r') as f:
+                    index = json.load(f)
+                self.slots, self.files, self.capacity = index['slots'], index['files'], index['capacity']
+                self.free = index.get('free', [])
+            except Exception as e:
+                print(f"Rebuilding unreadable image cache index: {e}")
+                self.slots, self.files, self.free, self.capacity = {}, {}, [], 0
+        # Another process may have grown or compacted the array
+        self._array = None
+
+    def save(self):
+        if self._array is not None:
+            self._array.flush()
+        tmp_path = self.index_path.with_name(f"{self.index_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump({'size': self.size, 'capacity': self.capacity, 'slots': self.slots,
+                       'files': self.files, 'free': self.free}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _open(self):
+        # Re-open after a fork (dataloader workers) instead of sharing the handle
+        if self._array is None or self._array_pid != os.getpid():
+            if self.capacity == 0:
+                return None
+            self._array = np.memmap(self.array_path, dtype=np.uint8, mode='r+',
+                                    shape=(self.capacity, self.size, self.size, 3))
+            self._array_pid = os.getpid()
+        return self._array
+
+    def _grow(self, needed):
+        if needed <= self.capacity:
+            return
+        capacity = max(needed, self.capacity * 2, 256)
+        if self._array is not None:
+            self._array.flush()
+            self._array = None
+        with open(self.array_path, 'ab') as f:
+            f.truncate(capacity * self.size * self.size * 3)
+        self.capacity = capacity
+
+    def _allocate(self):
+        if self.free:
+            return self.free.pop()
+        slot = len(self.slots)
+        self._grow(slot + 1)
+        return slot
+
+    def _evict(self, keep):
+        """Drop file entries not in `keep` and free slots nothing refers to any more"""
+        self.files = {key: entry for key, entry in self.files.items() if key in keep}
+        referenced = {entry[2] for entry in self.files.values()}
+        stale = [digest for digest in self.slots if digest not in referenced]
+        for digest in stale:
+            self.free.append(self.slots.pop(digest))
+        return len(stale)
+
+    def _compact(self):
+        """Move live slots to the front of the array and truncate the rest"""
+        array = self._open()
+        live = sorted(self.slots.items(), key=lambda item: item[1])
+        for slot, (digest, old) in enumerate(live):
+            if slot != old: # slot < old, so the source is never overwritten first
+                array[slot] = array[old]
+                self.slots[digest] = slot
+        if array is not None:
+            array.flush()
+        self._array = None
+        self.free = []
+        self.capacity = len(live)
+        with open(self.array_path, 'ab') as f:
+            f.truncate(self.capacity * self.size * self.size * 3)
+
+    @staticmethod
+    def _identity(path):
+        stat = os.stat(path)
+        return f"{stat.st_dev}:{stat.st_ino}", [stat.st_size, stat.st_mtime_ns]
+
+    def digest_for(self, path):
+        """Content hash of `path` if it is cached and unchanged, else None"""
+        key, signature = self._identity(path)
+        entry = self.files.get(key)
+        if entry and entry[:2] == signature and entry[2] in self.slots:
+            return entry[2]
+        return None
+
+    def get(self, path):
+        """Cached BGR array for an image file, or None if it isn't in the store"""
+        try:
+            digest = self.digest_for(path)
+        except OSError:
+            return None
+        if digest is None:
+            return None
+        array = self._open()
+        return None if array is None else array[self.slots[digest]]
+
+    def sync(self, paths, workers=PREPROCESS_WORKERS):
+        """Decode and store every new or changed image among `paths`.
+
+        `paths` is the whole dataset: cached images not among them are evicted.
+        """
+        with self._lock, file_lock(self.lock_path):
+            self._load_index()
+            pending, seen = {}, set()
+            for path in paths:
+                key, signature = self._identity(path)
+                seen.add(key)
+                entry = self.files.get(key)
+                if entry and entry[:2] == signature and entry[2] in self.slots:
+                    continue
+                pending[key] = (path, signature)
+
+            def preprocess(item):
+                key, (path, signature) = item
+                digest = file_digest(path)
+                if digest in self.slots:
+                    return key, signature, digest, None
+                image = cv2.imread(str(path), cv2.IMREAD_COLOR)
+                if image is None:
+                    return key, signature, digest, False
+                return key, signature, digest, resize_center_crop(image, self.size)
+
+            added = 0
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for key, signature, digest, image in pool.map(preprocess, pending.items()):
+                    if image is False:
+                        seen.discard(key)
+                        continue # unreadable; the trainer's own loader will report it
+                    if digest not in self.slots and image is not None:
+                        slot = self._allocate()
+                        self._open()[slot] = image
+                        self.slots[digest] = slot
+                        added += 1
+                    self.files[key] = signature + [digest]
+
+            evicted = self._evict(seen)
+            if self.free and len(self.free) >= len(self.slots):
+                self._compact()
+            if added or evicted or pending:
+                self.save()
+        print(f"Image cache: {added} images preprocessed, {evicted} evicted, {len(self.slots)} cached")
+        return added
+
+
+class CachedClassificationDataset(ClassificationDataset):
+    """ClassificationDataset that reads pre-decoded images from the array store"""
+
+    store = None
+
+    def __getitem__(self, i):
+        f, j, fn, im = self.samples[i]
+        im = self.store.get(f) if self.store is not None else None
+        if im is None:
+            im = cv2.imread(f)
+        im = Image.fromarray(cv2.cvtColor(np.ascontiguousarray(im), cv2.COLOR_BGR2RGB))
+        sample = self.torch_transforms(im)
+        return {"img": sample, "cls": j}
+
+
+class CachedClassificationValidator(ClassificationValidator):
+    def build_dataset(self, img_path):
+        return CachedClassificationDataset(root=img_path, args=self.args, augment=False, prefix=self.args.split)
+
+
+class CachedClassificationTrainer(ClassificationTrainer):
+    """Pass as `trainer=` to YOLO.train() to train and validate from the store"""
+
+    def build_dataset(self, img_path, mode="train", batch=None):
+        return CachedClassificationDataset(root=img_path, args=self.args, augment=mode == "train", prefix=mode)
+
+    def get_validator(self):
+        self.loss_names = ["loss"]
+        return CachedClassificationValidator(self.test_loader, self.save_dir, args=copy(self.args), _callbacks=self.callbacks)
+
+
+def use_store(store):
+    """Make the trainer classes read from `store`"""
+    CachedClassificationDataset.store = store
+
+
+def split_image_paths(data_dir):
+    data_dir = Path(data_dir)
+    return [p for p in data_dir.glob("*/*/*") if p.suffix.lower() in IMAGE_EXTENSIONS]
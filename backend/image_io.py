@@ -0,0 +1,32 @@
+import io
+
+import cv2
+import numpy as np
+
+
+class ImageDecodeError(ValueError):
+    """Raised when request bytes cannot be decoded into an image"""
+
+
+def buffer_of(stream):
+    """Return a zero-copy view of an in-memory upload stream's bytes"""
+    # BytesIO exposes its internal buffer directly; anything else (e.g. a
+    # spooled file from a non-predict route) has to be read once.
+    if isinstance(stream, io.BytesIO):
+        return stream.getbuffer()
+    stream.seek(0)
+    return stream.read()
+
+
+def decode_image(data):
+    """Decode encoded image bytes (JPEG/PNG/...) into a BGR uint8 array"""
+    if data is None or len(data) == 0:
+        raise ImageDecodeError("Empty image data")
+
+    # np.frombuffer wraps the existing bytes/memoryview without copying,
+    # so the only allocation is the decoded pixel array itself.
+    encoded = np.frombuffer(data, dtype=np.uint8)
+    image = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ImageDecodeError("Data is not a supported image format")
+    return image
@@ -0,0 +1,154 @@
+import os
+import random
+import shutil
+from pathlib import Path
+
+import torch
+from ultralytics import YOLO
+
+from prepare_data_split import IMAGE_EXTENSIONS, materialize
+
+# Old-class images replayed per class during incremental fine-tuning
+REPLAY_EXEMPLARS = int(os.environ.get("REPLAY_EXEMPLARS", 10))
+INCREMENTAL_EPOCHS = int(os.environ.get("INCREMENTAL_EPOCHS", 5))
+# Allowed drop in mean old-class val accuracy before falling back to a full retrain
+INCREMENTAL_TOLERANCE = float(os.environ.get("INCREMENTAL_TOLERANCE", 0.05))
+
+
+def model_class_names(yolo):
+    """Class names of a classification model in head order"""
+    names = yolo.names
+    return [names[i] for i in range(len(names))]
+
+
+def list_class_images(class_dir):
+    if not class_dir.exists():
+        return []
+    return sorted(f for f in class_dir.iterdir() if f.is_file() and f.suffix.lower() in IMAGE_EXTENSIONS)
+
+
+def extend_classifier_head(weights_path, class_names, out_path):
+    """Write a checkpoint whose classifier head covers `class_names`.
+
+    Rows for classes the current model already knows are copied over (and
+    re-ordered to match `class_names`); rows for new classes keep their
+    fresh initialization. Everything below the head is untouched.
+    """
+    yolo = YOLO(str(weights_path))
+    net = yolo.model
+    head = net.model[-1]
+    old_linear = head.linear
+    old_names = model_class_names(yolo)
+
+    new_linear = torch.nn.Linear(old_linear.in_features, len(class_names))
+    with torch.no_grad():
+        for new_index, name in enumerate(class_names):
+            if name in old_names:
+                old_index = old_names.index(name)
+                new_linear.weight[new_index] = old_linear.weight[old_index]
+                new_linear.bias[new_index] = old_linear.bias[old_index]
+
+    head.linear = new_linear
+    net.names = dict(enumerate(class_names))
+    net.yaml['nc'] = len(class_names)
+
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    torch.save({**yolo.ckpt, 'model': net, 'ema': None, 'optimizer': None}, str(out_path))
+    return out_path
+
+
+def build_replay_split(data_dir, out_dir, new_classes, exemplars=REPLAY_EXEMPLARS):
+    """Training set of all new-class images plus a few exemplars per old class.
+
+    Validation keeps the complete val split so old-class accuracy can be
+    measured. Exemplars are chosen with a per-class seed, so each class
+    replays the same images on every incremental run.
+    """
+    data_dir = Path(data_dir)
+    out_dir = Path(out_dir)
+    if out_dir.exists():
+        shutil.rmtree(out_dir)
+
+    classes = sorted(d.name for d in (data_dir / 'train').iterdir() if d.is_dir())
+    for cls in classes:
+        train_images = list_class_images(data_dir / 'train' / cls)
+        if cls not in new_classes and len(train_images) > exemplars:
+            train_images = random.Random(cls).sample(train_images, exemplars)
+        for split, images in (('train', train_images), ('val', list_class_images(data_dir / 'val' / cls))):
+            (out_dir / split / cls).mkdir(parents=True, exist_ok=True)
+            for img in images:
+                materialize(img, out_dir / split / cls / img.name, "link")
+    return classes
+
+
+def evaluate_top1(yolo, val_dir, classes, batch=32):
+    """Per-class top-1 accuracy of `yolo` on val_dir/<class>/ images"""
+    names = model_class_names(yolo)
+    accuracy = {}
+    for cls in classes:
+        images = [str(p) for p in list_class_images(Path(val_dir) / cls)]
+        if not images or cls not in names:
+            continue
+        correct = 0
+        for start in range(0, len(images), batch):
+            for result in yolo(images[start:start + batch], verbose=False):
+                correct += int(names[result.probs.top1] == cls)
+        accuracy[cls] = correct / len(images)
+    return accuracy
+
+
+def mean(values):
+    values = list(values)
+    return sum(values) / len(values) if values else 0.0
+
+
+def train_incremental(weights_path, data_dir, work_dir, train_kwargs, epochs=INCREMENTAL_EPOCHS, tolerance=INCREMENTAL_TOLERANCE, callbacks=None):
+    """Fine-tune the current weights for newly added classes with a replay buffer.
+
+    Returns (results, report), or (None, report) when incremental training
+    does not apply or old-class accuracy dropped by more than `tolerance`;
+    the caller should then fall back to a full retrain. `callbacks` is a
+    list of (ultralytics callback event, function) pairs added to the trainer.
+    """
+    work_dir = Path(work_dir)
+    current = YOLO(str(weights_path))
+    old_classes = model_class_names(current)
+    classes = sorted(d.name for d in (Path(data_dir) / 'train').iterdir() if d.is_dir())
+    new_classes = [cls for cls in classes if cls not in old_classes]
+    report = {'mode': 'incremental', 'new_classes': new_classes}
+
+    if not new_classes or any(cls not in classes for cls in old_classes):
+        # Nothing to add, or a class was removed: the head can't just grow
+        report['fallback'] = 'class set not a superset of the current model'
+        return None, report
+
+    # Baseline: how well the current model does on old classes today
+    kept_classes = [cls for cls in old_classes if cls in classes]
+    baseline = evaluate_top1(current, Path(data_dir) / 'val', kept_classes)
+    del current
+
+    init_path = extend_classifier_head(weights_path, classes, work_dir / 'incremental_init.pt')
+    replay_dir = work_dir / 'replay_data'
+    build_replay_split(data_dir, replay_dir, new_classes)
+
+    train_model = YOLO(str(init_path))
+    for event, callback in callbacks or []:
+        train_model.add_callback(event, callback)
+    results = train_model.train(
+        data=str(replay_dir.resolve()),
+        epochs=epochs,
+        **train_kwargs
+    )
+
+    after = evaluate_top1(YOLO(str(train_model.trainer.best)), Path(data_dir) / 'val', kept_classes)
+    report.update({
+        'old_class_accuracy_before': mean(baseline.values()),
+        'old_class_accuracy_after': mean(after.values())
+    })
+    drop = report['old_class_accuracy_before'] - report['old_class_accuracy_after']
+    print(f"Incremental training: old-class accuracy {report['old_class_accuracy_before']:.3f} -> {report['old_class_accuracy_after']:.3f}")
+    if drop > tolerance:
+        report['fallback'] = f"old-class accuracy dropped by {drop:.3f} (tolerance {tolerance})"
+        return None, report
+    return results, report
@@ -0,0 +1,104 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from PIL import Image, ImageOps
+
+from dedup import dhash
+from file_utils import available_cpus
+
+# Every dataset image is stored as an RGB JPEG no larger than this on its long side
+INGEST_MAX_SIDE = int(os.environ.get("INGEST_MAX_SIDE", 1024))
+INGEST_MIN_SIDE = int(os.environ.get("INGEST_MIN_SIDE", 32))
+INGEST_JPEG_QUALITY = int(os.environ.get("INGEST_JPEG_QUALITY", 90))
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", available_cpus()))
+# Refuse decompression bombs well before Pillow's own (warning-only) limit
+INGEST_MAX_PIXELS = int(os.environ.get("INGEST_MAX_PIXELS", 60_000_000))
+
+ACCEPTED_FORMATS = {'JPEG', 'MPO', 'PNG', 'WEBP', 'GIF', 'BMP', 'TIFF'}
+OUTPUT_EXTENSION = '.jpg'
+
+
+class IngestError(ValueError):
+    """The input is not an image we can train on"""
+
+
+def normalize_image(image):
+    """Orientation-corrected RGB copy of a decoded image, capped to INGEST_MAX_SIDE"""
+    if getattr(image, 'is_animated', False):
+        image.seek(0) # first frame of animated GIF/WebP/PNG
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+        # Flatten transparency onto white rather than black
+        rgba = image.convert('RGBA')
+        image = Image.new('RGB', rgba.size, (255, 255, 255))
+        image.paste(rgba, mask=rgba.getchannel('A'))
+    elif image.mode != 'RGB':
+        # CMYK, palette, greyscale and 16-bit modes
+        image = image.convert('RGB')
+    if max(image.size) > INGEST_MAX_SIDE:
+        image.thumbnail((INGEST_MAX_SIDE, INGEST_MAX_SIDE), Image.LANCZOS)
+    return image
+
+
+def ingest_image(source, dest_path):
+    """Decode-verify `source` (path or file-like) and write it to `dest_path` as a normalized JPEG.
+
+    Returns a dict with the detected source format, original and stored
+    size and the dHash of the stored image. Raises IngestError for
+    anything that isn't a complete, decodable image of a usable size.
+    """
+    dest_path = Path(dest_path)
+    try:
+        with Image.open(source) as image:
+            source_format = image.format
+            if source_format not in ACCEPTED_FORMATS:
+                raise IngestError(f"Unsupported image format: {source_format}")
+            width, height = image.size
+            if width * height > INGEST_MAX_PIXELS:
+                raise IngestError(f"Image too large ({width}x{height})")
+            if min(width, height) < INGEST_MIN_SIDE:
+                raise IngestError(f"Image too small ({width}x{height})")
+            # JPEG: decode at a reduced scale that still covers INGEST_MAX_SIDE
+            image.draft('RGB', (INGEST_MAX_SIDE, INGEST_MAX_SIDE))
+            image.load() # full decode; truncated files fail here
+            normalized = normalize_image(image)
+    except IngestError:
+        raise
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        # Pillow reports HTML error pages and truncated bodies this way
+        raise IngestError(f"Not a valid image: {e}")
+
+    tmp_path = dest_path.with_name(f".{dest_path.name}.{threading.get_ident()}.tmp")
+    try:
+        normalized.save(tmp_path, 'JPEG', quality=INGEST_JPEG_QUALITY)
+        os.replace(tmp_path, dest_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return {
+        'format': source_format,
+        'original_size': [width, height],
+        'size': list(normalized.size),
+        'hash': dhash(normalized)
+    }
+
+
+def ingest_many(items, workers=INGEST_WORKERS):
+    """Ingest (source, dest_path) pairs in parallel; returns (info, None) or (None, error) per item.
+
+    Threads are enough to use every core: Pillow releases the GIL while
+    decoding, resizing and encoding. (A process pool would have to fork
+    the multi-threaded server.)
+    """
+    def run(item):
+        try:
+            return ingest_image(*item), None
+        except IngestError as e:
+            return None, str(e)
+
+    if len(items) <= 1 or workers <= 1:
+        return [run(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(workers, len(items)), thread_name_prefix="ingest") as pool:
+        return list(pool.map(run, items))
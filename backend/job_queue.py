@@ -0,0 +1,233 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError: # Windows: single-process deployments only
+    fcntl = None
+
+ACTIVE_STATUSES = ['starting', 'downloading', 'preparing', 'training', 'finalizing']
+FINISHED_STATUSES = ['completed', 'error']
+JSON_FIELDS = ['result', 'timings', 'epoch_log', 'config']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    leaf_name TEXT NOT NULL,
+    mode TEXT,
+    config TEXT,
+    status TEXT NOT NULL,
+    message TEXT NOT NULL DEFAULT '',
+    progress REAL NOT NULL DEFAULT 0,
+    result TEXT,
+    timings TEXT,
+    epoch_log TEXT,
+    run_id TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    updated_at REAL NOT NULL,
+    revision INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+"""
+
+# Columns added after the first release, created on existing databases at startup
+MIGRATIONS = {
+    'epoch_log': "ALTER TABLE jobs ADD COLUMN epoch_log TEXT",
+    'config': "ALTER TABLE jobs ADD COLUMN config TEXT"
+}
+
+
+class JobQueue:
+    """Training jobs persisted in SQLite so every worker process sees the same state.
+
+    Jobs are submitted by the HTTP handlers and drained by whichever
+    process holds the trainer lock; queued jobs with the same mode and
+    training config are claimed together and trained in one run.
+    """
+
+    def __init__(self, db_path, lock_path=None):
+        self.db_path = str(db_path)
+        self.lock_path = str(lock_path or f"{db_path}.lock")
+        self.wakeup = threading.Event()
+        # Notified on every update made by this process, so status streams
+        # don't have to wait for their next poll
+        self.changed = threading.Condition()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, statement in MIGRATIONS.items():
+                if column not in columns:
+                    conn.execute(statement)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _to_dict(row):
+        if row is None:
+            return None
+        job = dict(row)
+        for field in JSON_FIELDS:
+            job[field] = json.loads(job[field]) if job[field] else None
+        return job
+
+    def submit(self, leaf_name, mode=None, config=None):
+        """Queue a training job; returns the new job.
+
+        `config` holds the job's training overrides as canonical JSON
+        (see training_config.parse_training_config), or None for defaults.
+        """
+        now = time.time()
+        job_id = uuid.uuid4().hex[:12]
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, leaf_name, mode, config, status, message, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, 'queued', 'Waiting for a training slot...', ?, ?)",
+                (job_id, leaf_name, mode, config, now, now)
+            )
+        self.wakeup.set()
+        return self.get(job_id)
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            return self._to_dict(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def latest(self):
+        with self._connect() as conn:
+            return self._to_dict(conn.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT 1").fetchone())
+
+    def list(self, limit=50):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+            return [self._to_dict(row) for row in rows]
+
+    def pending_for(self, leaf_name):
+        """Queued or running job for this leaf, if any"""
+        placeholders = ",".join("?" * (len(ACTIVE_STATUSES) + 1))
+        with self._connect() as conn:
+            row = conn.execute(
+                f"SELECT * FROM jobs WHERE lower(leaf_name) = lower(?) AND status IN ({placeholders}) "
+                "ORDER BY created_at LIMIT 1",
+                (leaf_name.strip(), 'queued', *ACTIVE_STATUSES)
+            ).fetchone()
+            return self._to_dict(row)
+
+    def update(self, job_ids, **fields):
+        """Set fields on one or more jobs and bump their revision"""
+        if isinstance(job_ids, str):
+            job_ids = [job_ids]
+        if not job_ids:
+            return
+        fields['updated_at'] = time.time()
+        for field in JSON_FIELDS:
+            if field in fields and fields[field] is not None:
+                fields[field] = json.dumps(fields[field])
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        placeholders = ",".join("?" * len(job_ids))
+        with self._connect() as conn:
+            conn.execute(
+                f"UPDATE jobs SET {assignments}, revision = revision + 1 WHERE id IN ({placeholders})",
+                (*fields.values(), *job_ids)
+            )
+        with self.changed:
+            self.changed.notify_all()
+
+    def wait_for_change(self, timeout):
+        """Block until this process updates a job, or `timeout` seconds pass"""
+        with self.changed:
+            self.changed.wait(timeout)
+
+    def claim(self):
+        """Atomically take the oldest queued job plus any queued jobs it can train with"""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                first = conn.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+                ).fetchone()
+                if first is None:
+                    conn.execute("COMMIT")
+                    return []
+                # Coalesce jobs that would train the same way
+                rows = conn.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued' AND mode IS ? AND config IS ? ORDER BY created_at",
+                    (first['mode'], first['config'])
+                ).fetchall()
+                run_id = uuid.uuid4().hex[:12]
+                now = time.time()
+                ids = [row['id'] for row in rows]
+                conn.execute(
+                    f"UPDATE jobs SET status = 'starting', message = 'Initializing training...', run_id = ?, "
+                    f"started_at = ?, updated_at = ?, revision = revision + 1 "
+                    f"WHERE id IN ({','.join('?' * len(ids))})",
+                    (run_id, now, now, *ids)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return [self.get(job_id) for job_id in ids]
+
+    def requeue_interrupted(self):
+        """Put jobs left mid-run by a dead trainer back on the queue.
+
+        Only call this while holding the trainer lock: then no other
+        process can legitimately own a running job.
+        """
+        placeholders = ",".join("?" * len(ACTIVE_STATUSES))
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"UPDATE jobs SET status = 'queued', message = 'Re-queued after restart', progress = 0, epoch_log = NULL, "
+                f"run_id = NULL, updated_at = ?, revision = revision + 1 WHERE status IN ({placeholders})",
+                (time.time(), *ACTIVE_STATUSES)
+            )
+            return cursor.rowcount
+
+    @contextmanager
+    def trainer_lock(self):
+        """Yield True if this process may train, False if another one already does"""
+        if fcntl is None:
+            yield True
+            return
+        with open(self.lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def run_worker(self, handle_jobs, poll_interval=2.0):
+        """Drain the queue forever, calling handle_jobs(jobs) for each claimed group"""
+        while True:
+            self.wakeup.wait(poll_interval)
+            self.wakeup.clear()
+            with self.trainer_lock() as acquired:
+                if not acquired:
+                    continue
+                self.requeue_interrupted()
+                while True:
+                    jobs = self.claim()
+                    if not jobs:
+                        break
+                    try:
+                        handle_jobs(jobs)
+                    except Exception as e:
+                        print(f"Training worker error: {e}")
+                        self.update([job['id'] for job in jobs], status='error', message=str(e), finished_at=time.time())
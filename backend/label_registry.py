@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError: # Windows: the in-process lock still applies
+    fcntl = None
+
+
+class LabelRegistry:
+    """Trained labels served from memory, persisted atomically under a file lock.
+
+    The JSON file keeps its original format (a plain list), so other
+    readers are unaffected. Reads only stat the file, at most once per
+    `check_interval` seconds, and re-parse it when another process (or the
+    Gradio app) has changed it. Writes hold an exclusive lock on a sidecar
+    lock file, re-read the latest contents, and replace the file atomically.
+
+    `version` is stored in a sidecar file next to the labels together with
+    the etag it belongs to, so every process reports the same number and it
+    survives restarts. A label file edited by hand (etag mismatch) counts as
+    one version past the stored one.
+    """
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = Path(path)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self.version_path = self.path.with_name(self.path.name + ".version")
+        self.check_interval = check_interval
+        self.version = 0
+        self.etag = None
+        self._labels = []
+        self._signature = None
+        self._checked_at = 0.0
+        self._lock = threading.RLock()
+        self._refresh(force=True)
+
+    def _stat_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    @staticmethod
+    def _etag(labels):
+        return hashlib.sha1(json.dumps(labels, sort_keys=True).encode()).hexdigest()
+
+    def _stored_version(self):
+        """(version, etag) last recorded by a write; (0, None) if there is none"""
+        try:
+            with open(self.version_path, 'r') as f:
+                stored = json.load(f)
+            return int(stored['version']), stored.get('etag')
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            return 0, None
+
+    def _apply(self, labels, signature):
+        self._labels = labels
+        self._signature = signature
+        self.etag = self._etag(labels)
+        version, etag = self._stored_version()
+        self.version = version if etag == self.etag else version + 1
+
+    def _refresh(self, force=False):
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+            signature = self._stat_signature()
+            if signature == self._signature and not force:
+                return
+            labels = []
+            if signature is not None:
+                try:
+                    with open(self.path, 'r') as f:
+                        labels = json.load(f)
+                except Exception as e:
+                    print(f"Could not read {self.path}: {e}")
+                    labels = list(self._labels)
+            if labels != self._labels or self.etag is None:
+                self._apply(labels, signature)
+            else:
+                self._signature = signature
+
+    @contextmanager
+    def _file_lock(self):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _replace(path, write):
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _write(self, labels):
+        # Caller holds the file lock; the version is written first so a
+        # reader that sees the new labels also sees their version
+        version = self.version + 1
+        self._replace(self.version_path, lambda f: json.dump({'version': version, 'etag': self._etag(labels)}, f))
+        self._replace(self.path, lambda f: json.dump(labels, f, indent=2))
+        self._apply(labels, self._stat_signature())
+
+    def _mutate(self, change):
+        """Apply change(labels) -> new labels or None, under the file lock"""
+        with self._file_lock():
+            self._refresh(force=True)
+            updated = change(list(self._labels))
+            if updated is None:
+                return False
+            self._write(updated)
+            return True
+
+    @staticmethod
+    def normalize(label_name):
+        return label_name.lower().strip()
+
+    def labels(self):
+        self._refresh()
+        return list(self._labels)
+
+    def contains(self, label_name):
+        self._refresh()
+        return self.normalize(label_name) in self._labels
+
+    def add(self, label_name):
+        normalized_label = self.normalize(label_name)
+        return self._mutate(lambda labels: None if normalized_label in labels else labels + [normalized_label])
+
+    def remove(self, label_name):
+        normalized_label = self.normalize(label_name)
+        return self._mutate(lambda labels: [l for l in labels if l != normalized_label] if normalized_label in labels else None)
+
+    def replace(self, labels):
+        return self._mutate(lambda current: None if list(labels) == current else list(labels))
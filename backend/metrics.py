@@ -0,0 +1,328 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# Seconds; covers sub-millisecond cache hits up to multi-second URL fetches
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Training stages and model loads take seconds to hours
+SLOW_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ""
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def values(self):
+        """[(label values, value)] for snapshots; function-backed metrics are read now"""
+        if getattr(self, 'function', None) is not None:
+            try:
+                return [((), self.function())]
+            except Exception:
+                return []
+        with self._lock:
+            return list(self._values.items())
+
+    def merge(self, key, value):
+        """Add another process's value for `key` (counters and gauges sum)"""
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Counter(Metric):
+    """Monotonic count, incremented directly or read from `function()` at scrape time"""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = self.header()
+        if self.function is not None:
+            try:
+                lines.append(f"{self.name}_total {_format_value(self.function())}")
+            except Exception:
+                pass
+            return lines
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}_total{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Metric):
+    """Gauge set directly, or read from `function()` at scrape time"""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        lines = self.header()
+        if self.function is not None:
+            try:
+                lines.append(f"{self.name} {_format_value(self.function())}")
+            except Exception:
+                pass
+            return lines
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(Metric):
+    """Cumulative-bucket histogram of observed values (usually seconds)"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def values(self):
+        with self._lock:
+            return [(key, [list(state[0]), state[1], state[2]]) for key, state in self._values.items()]
+
+    def merge(self, key, value):
+        counts, total, count = value
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0] = [a + b for a, b in zip(state[0], counts)]
+            state[1] += total
+            state[2] += count
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = sorted((key, ([*state[0]], state[1], state[2])) for key, state in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Metrics of this process, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), function=None):
+        return self._register(Counter(name, documentation, labelnames, function))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self._register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    # --- Several processes (gunicorn workers, train_worker.py) ---
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {
+            metric.name: {
+                'kind': metric.kind,
+                'documentation': metric.documentation,
+                'labelnames': list(metric.labelnames),
+                'buckets': list(getattr(metric, 'buckets', ())),
+                'values': [[list(key), value] for key, value in metric.values()]
+            }
+            for metric in metrics
+        }
+
+    def write_snapshot(self, directory):
+        """Save this process's metrics as <directory>/<pid>.json (atomically)"""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"{os.getpid()}.json"
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def export_forever(self, directory, interval):
+        while True:
+            try:
+                self.write_snapshot(directory)
+            except OSError as e:
+                print(f"Could not write metrics snapshot: {e}")
+            time.sleep(interval)
+
+    def render_merged(self, directory):
+        """Metrics summed over every process that wrote a snapshot to `directory`.
+
+        This process's snapshot is refreshed first. Counters and histograms
+        of exited processes still count, so totals never go backwards;
+        gauges only come from processes that are still running.
+        """
+        self.write_snapshot(directory)
+        merged = MetricsRegistry()
+        kinds = {'counter': merged.counter, 'gauge': merged.gauge}
+        own = Path(directory) / f"{os.getpid()}.json"
+        paths = [own] + sorted(p for p in Path(directory).glob("*.json") if p != own)
+        for path in paths:
+            try:
+                with open(path, 'r') as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = _process_alive(int(path.stem)) if path.stem.isdigit() else False
+            for name, data in snapshot.items():
+                if data['kind'] == 'gauge' and not alive:
+                    continue
+                metric = merged._metrics.get(name)
+                if metric is None:
+                    if data['kind'] == 'histogram':
+                        metric = merged.histogram(name, data['documentation'], data['labelnames'], data['buckets'])
+                    else:
+                        metric = kinds[data['kind']](name, data['documentation'], data['labelnames'])
+                for key, value in data['values']:
+                    metric.merge(tuple(key), value)
+        return merged.render()
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Shared by every module in this process
+REGISTRY = MetricsRegistry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+PREDICT_STAGE_SECONDS = REGISTRY.histogram(
+    "leaf_predict_stage_seconds",
+    "Time spent in each stage of a prediction request",
+    ["stage"]
+)
+PREDICT_REQUEST_SECONDS = REGISTRY.histogram(
+    "leaf_predict_request_seconds",
+    "End-to-end prediction request latency",
+    ["endpoint", "outcome"]
+)
+PREDICT_REQUESTS = REGISTRY.counter(
+    "leaf_predict_requests",
+    "Prediction requests by image source and result",
+    ["source", "outcome"]
+)
+PREDICT_BATCH_SIZE = REGISTRY.histogram(
+    "leaf_predict_batch_size",
+    "Images per batched forward pass",
+    buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+TRAINING_STAGE_SECONDS = REGISTRY.histogram(
+    "leaf_training_stage_seconds",
+    "Time spent in each stage of a training run",
+    ["stage"],
+    buckets=SLOW_BUCKETS
+)
+TRAINING_RUNS = REGISTRY.counter(
+    "leaf_training_runs",
+    "Finished training runs by mode and status",
+    ["mode", "status"]
+)
+MODEL_LOAD_SECONDS = REGISTRY.histogram(
+    "leaf_model_load_seconds",
+    "Time to load and warm up a model version",
+    ["backend"],
+    buckets=SLOW_BUCKETS
+)
@@ -0,0 +1,261 @@
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from ultralytics import YOLO
+
+from export_runtime import INFERENCE_BACKEND, load_runtime
+from file_utils import file_lock
+from metrics import MODEL_LOAD_SECONDS
+
+REGISTRY_FILE = "registry.json"
+LOCK_FILE = "registry.lock"
+WEIGHTS_FILE = "weights.pt"
+META_FILE = "meta.json"
+WARMUP_RUNS = int(os.environ.get("MODEL_WARMUP_RUNS", 2))
+
+
+def write_json_atomic(path, data):
+    # Unique per process: several serving workers may write at once
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class ModelRegistry:
+    """Versioned model weights with one warm, active model in memory.
+
+    Each published version lives in its own folder (weights plus a
+    meta.json with its class names and trained labels). Activating a
+    version loads and warms it up on the calling thread, then swaps the
+    (version, model) pair in a single assignment: requests that already
+    picked up the old pair finish on it, new requests see the new one.
+    The pair it replaced stays loaded, so rolling back (or switching back
+    after another worker's rollback) is a swap, not a reload.
+
+    Publishing and every read-modify-write of registry.json hold a lock
+    file in the models folder, since the serving workers and
+    train_worker.py all update it.
+    """
+
+    def __init__(self, root, imgsz=224, on_activate=None, backend=INFERENCE_BACKEND):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.imgsz = imgsz
+        self.backend = backend
+        self.on_activate = on_activate
+        self._active = (None, None)
+        self._previous = (None, None)  # the pair `_active` replaced, kept warm
+        self._lock = threading.Lock()
+
+    # --- On-disk state ---
+
+    def _read_state(self):
+        path = self.root / REGISTRY_FILE
+        if path.exists():
+            try:
+                with open(path, 'r') as f:
+                    return json.load(f)
+            except Exception as e:
+                print(f"Ignoring unreadable model registry: {e}")
+        return {"active": None, "history": []}
+
+    def _write_state(self, state):
+        write_json_atomic(self.root / REGISTRY_FILE, state)
+
+    @contextmanager
+    def _state_lock(self):
+        """Serialize registry updates across threads and processes"""
+        with self._lock, file_lock(self.root / LOCK_FILE):
+            yield
+
+    def version_dir(self, version):
+        return self.root / version
+
+    def weights_path(self, version):
+        return self.version_dir(version) / WEIGHTS_FILE
+
+    def meta(self, version):
+        with open(self.version_dir(version) / META_FILE, 'r') as f:
+            return json.load(f)
+
+    def update_meta(self, version, **fields):
+        meta = self.meta(version)
+        meta.update(fields)
+        write_json_atomic(self.version_dir(version) / META_FILE, meta)
+
+    def versions(self):
+        """Metadata of every published version, oldest first"""
+        found = []
+        for d in sorted(self.root.iterdir()):
+            if d.is_dir() and (d / META_FILE).exists():
+                found.append(self.meta(d.name))
+        return found
+
+    def active_version(self):
+        """Version recorded as active on disk (may be newer than the one in memory)"""
+        return self._read_state()["active"]
+
+    # --- Publishing and activation ---
+
+    def publish(self, weights_path, trained_labels=None, metrics=None):
+        """Copy trained weights into a new version folder; returns the version name"""
+        with self._state_lock():
+            version = self._reserve_version()
+        return self._fill_version(version, weights_path, trained_labels, metrics)
+
+    def _reserve_version(self):
+        # Caller holds the state lock
+        existing = [d.name for d in self.root.iterdir() if d.is_dir() and d.name.startswith('v')]
+        number = max([int(name[1:]) for name in existing if name[1:].isdigit()] or [0]) + 1
+        version = f"v{number:04d}"
+        self.version_dir(version).mkdir()
+        return version
+
+    def _fill_version(self, version, weights_path, trained_labels, metrics):
+        version_dir = self.version_dir(version)
+        shutil.copy2(weights_path, self.weights_path(version))
+        names = YOLO(str(self.weights_path(version))).names
+        write_json_atomic(version_dir / META_FILE, {
+            "version": version,
+            "created_at": time.time(),
+            "class_names": [names[i] for i in range(len(names))],
+            "trained_labels": list(trained_labels or []),
+            "metrics": metrics
+        })
+        print(f"Published model {version}")
+        return version
+
+    def load_runtime_model(self, version):
+        """Model for the configured backend, falling back to PyTorch weights"""
+        if self.backend != 'torch':
+            runtime = (self.meta(version).get('runtimes') or {}).get(self.backend, {})
+            if runtime.get('parity_ok'):
+                try:
+                    return load_runtime(self.version_dir(version), self.backend), self.backend
+                except Exception as e:
+                    print(f"Could not load {self.backend} model for {version}: {e}")
+            else:
+                print(f"No verified {self.backend} export for {version}; serving PyTorch weights")
+        return YOLO(str(self.weights_path(version))), 'torch'
+
+    def load(self, version):
+        """Load a version and run a few warm-up passes so its first request isn't slow"""
+        started = time.time()
+        model, backend = self.load_runtime_model(version)
+        dummy = np.zeros((self.imgsz, self.imgsz, 3), dtype=np.uint8)
+        for _ in range(WARMUP_RUNS):
+            model(dummy, verbose=False)
+        MODEL_LOAD_SECONDS.observe(time.time() - started, backend=backend)
+        print(f"Loaded and warmed model {version} ({backend}) in {time.time() - started:.2f}s")
+        return model
+
+    def _warm_model(self, version):
+        """The kept previous model if it is `version`, else a freshly loaded one"""
+        previous_version, previous_model = self._previous
+        if previous_version == version and previous_model is not None:
+            return previous_model
+        return self.load(version)
+
+    def _swap(self, version, model):
+        # Caller holds self._lock
+        if self._active[0] != version:
+            self._previous = self._active
+        self._active = (version, model)
+
+    def activate(self, version, model=None, record=True):
+        """Make `version` the serving model (loading it first, off the request path)"""
+        if model is None:
+            model = self._warm_model(version)
+        if record:
+            with self._state_lock():
+                state = self._read_state()
+                history = [v for v in state["history"] if v != version] + [version]
+                self._write_state({"active": version, "history": history})
+                self._swap(version, model)
+        else:
+            with self._lock:
+                self._swap(version, model)
+        if self.on_activate:
+            self.on_activate(version)
+        print(f"Activated model {version}")
+        return version
+
+    def rollback(self):
+        """Re-activate the previously active version; returns it, or None.
+
+        Usually instant: the previous model is still loaded. Raises
+        RuntimeError if another activation happened while it was loading.
+        """
+        history = self._read_state()["history"]
+        if len(history) < 2:
+            return None
+        previous = history[-2]
+        model = self._warm_model(previous)
+        with self._state_lock():
+            state = self._read_state()
+            if state["history"] != history:
+                raise RuntimeError("The active model changed during the rollback; try again")
+            self._write_state({"active": previous, "history": history[:-1]})
+            self._swap(previous, model)
+        if self.on_activate:
+            self.on_activate(previous)
+        print(f"Rolled back to model {previous}")
+        return previous
+
+    def current(self):
+        """The (version, model) pair new requests should use"""
+        return self._active
+
+    def sync_active(self):
+        """Load the version recorded on disk if another process activated a different one"""
+        version = self.active_version()
+        if version is None or version == self._active[0]:
+            return None
+        print(f"Model {version} was activated by another worker; loading it")
+        return self.activate(version, record=False)
+
+    def watch(self, interval=2.0):
+        """Keep this process serving the version in registry.json (run in a thread)"""
+        path = self.root / REGISTRY_FILE
+        last_seen = None
+        while True:
+            time.sleep(interval)
+            try:
+                mtime = path.stat().st_mtime_ns if path.exists() else None
+                if mtime != last_seen:
+                    self.sync_active()
+                    last_seen = mtime
+            except Exception as e:
+                print(f"Model sync failed: {e}")
+
+    def bootstrap(self, legacy_weights=None, trained_labels=None, base_weights='yolov8n-cls.pt'):
+        """Activate the recorded version, importing legacy weights on first run"""
+        # Locked: the gunicorn master and train_worker.py may both boot at once
+        with self._state_lock():
+            version = self.active_version()
+            if version is None and legacy_weights is not None and Path(legacy_weights).exists():
+                version = self._fill_version(self._reserve_version(), legacy_weights, trained_labels, None)
+                self._write_state({"active": version, "history": [version]})
+        if version is not None:
+            try:
+                return self.activate(version)
+            except Exception as e:
+                print(f"Error loading model {version}: {e}")
+
+        # Nothing trained yet: serve the base model without registering it
+        try:
+            print(f"Loading model from: {base_weights}")
+            self._active = ('base', YOLO(base_weights))
+            if self.on_activate:
+                self.on_activate('base')
+            return 'base'
+        except Exception as e:
+            print(f"Error loading model: {e}")
+            return None
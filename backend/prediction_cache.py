@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Rough per-entry bookkeeping cost on top of the serialized prediction
+ENTRY_OVERHEAD_BYTES = 256
+# How long a URL's prediction is served without asking the origin again;
+# after that it is revalidated with a conditional request
+URL_TTL_SECONDS = float(os.environ.get("PREDICTION_URL_TTL", 300))
+
+
+class PredictionCache:
+    """Memory-bounded LRU of predictions keyed by image content hash.
+
+    A second index maps source URLs to content hashes (plus the HTTP
+    validators of the download) so repeated URL predictions skip the
+    download too: within `url_ttl` seconds entirely, after that via a
+    conditional request. Entries belong to one model version; switching
+    versions empties the cache.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_urls=10000, url_ttl=URL_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.max_urls = max_urls
+        self.url_ttl = url_ttl
+        self._entries = OrderedDict()  # digest -> (prediction, size)
+        self._urls = OrderedDict()  # url -> (digest, validators, checked_at)
+        self._bytes = 0
+        self._model_version = None
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.url_hits = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key_for(data):
+        """Content hash of the encoded image bytes"""
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def set_model_version(self, version):
+        """Drop every entry if the serving model changed"""
+        with self._lock:
+            if version == self._model_version:
+                return
+            self._model_version = version
+            self.clear()
+
+    def clear(self):
+        """Drop every entry (e.g. when the set of predictable classes changed)"""
+        with self._lock:
+            self._entries.clear()
+            self._urls.clear()
+            self._bytes = 0
+            self.invalidations += 1
+
+    def get(self, digest):
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return entry[0]
+
+    def _url_entry(self, url):
+        # Caller holds the lock
+        mapping = self._urls.get(url)
+        if mapping is None:
+            return None, None
+        entry = self._entries.get(mapping[0])
+        if entry is None:
+            # Content was evicted; forget the stale URL mapping too
+            del self._urls[url]
+            return None, None
+        return mapping, entry
+
+    def get_url(self, url):
+        """Cached prediction for a URL fetched less than `url_ttl` seconds ago, or None"""
+        with self._lock:
+            mapping, entry = self._url_entry(url)
+            if mapping is None or time.time() - mapping[2] > self.url_ttl:
+                return None
+            self._urls.move_to_end(url)
+            self._entries.move_to_end(mapping[0])
+            self.hits += 1
+            self.url_hits += 1
+            return entry[0]
+
+    def url_validators(self, url):
+        """ETag/Last-Modified of a cached URL's download, for a conditional re-fetch"""
+        with self._lock:
+            mapping, _ = self._url_entry(url)
+            return mapping[1] if mapping else None
+
+    def revalidated(self, url):
+        """The origin answered 304: restart the URL's TTL and return its prediction (or None)"""
+        with self._lock:
+            mapping, entry = self._url_entry(url)
+            if mapping is None:
+                return None
+            self._urls[url] = (mapping[0], mapping[1], time.time())
+            self._urls.move_to_end(url)
+            self._entries.move_to_end(mapping[0])
+            self.hits += 1
+            self.url_hits += 1
+            self.revalidations += 1
+            return entry[0]
+
+    def _set_url(self, url, digest, validators):
+        # Caller holds the lock
+        self._urls[url] = (digest, validators, time.time())
+        self._urls.move_to_end(url)
+        while len(self._urls) > self.max_urls:
+            self._urls.popitem(last=False)
+
+    def put(self, digest, prediction, model_version, url=None, validators=None):
+        """Store a prediction made by `model_version` (ignored if it is stale)"""
+        size = len(json.dumps(prediction)) + ENTRY_OVERHEAD_BYTES
+        with self._lock:
+            if model_version != self._model_version or size > self.max_bytes:
+                return
+            old = self._entries.pop(digest, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[digest] = (prediction, size)
+            self._bytes += size
+            if url:
+                self._set_url(url, digest, validators)
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def remember_url(self, url, digest, validators=None):
+        """Point a URL at content that is already cached"""
+        with self._lock:
+            if digest in self._entries:
+                self._set_url(url, digest, validators)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'model_version': self._model_version,
+                'entries': len(self._entries),
+                'urls': len(self._urls),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'url_hits': self.url_hits,
+                'revalidations': self.revalidations,
+                'misses': self.misses,
+                'hit_rate': (self.hits / lookups) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
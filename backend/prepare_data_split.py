@@ -1,48 +1,115 @@
 import os
+import json
 import shutil
 import random
 from pathlib import Path
 
-def split_dataset(source_dir, output_dir="data", train_ratio=0.8):
+from dataset_manifest import DatasetManifest
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+# Dataset manifest database, next to the dataset folder
+MANIFEST_DB = "dataset_manifest.db"
+
+
+def materialize(src, dst, mode):
+    """Place src at dst as a hardlink (falling back to symlink/copy) or a copy"""
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+    if mode == "link":
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+        try:
+            os.symlink(src.resolve(), dst)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+
+def split_dataset(source_dir, output_dir="data", train_ratio=0.8, mode="link", manifest=None):
+    """Incrementally maintain a train/val split of source_dir in output_dir.
+
+    Split assignments are stored in the dataset manifest, so existing
+    images keep their train/val side across runs and only classes with
+    new, replaced or deleted images are touched. With mode="link" the
+    split is made of hardlinks instead of copies.
+    """
     source_path = Path(source_dir)
     data_path = Path(output_dir)
-    
+    if manifest is None:
+        manifest = DatasetManifest(source_path.parent / MANIFEST_DB, source_path)
+    manifest.sync()
+
     # Create train and val directories
     train_dir = data_path / "train"
     val_dir = data_path / "val"
-    
-    # Always recreate data directory to ensure it tracks all current classes
-    if data_path.exists():
-        print("Removing existing data directory...")
-        shutil.rmtree(data_path)
+    split_dirs = {"train": train_dir, "val": val_dir}
+
+    settings = json.dumps({"train_ratio": train_ratio, "mode": mode})
+    if manifest.setting("split") != settings or not data_path.exists():
+        # No usable history: start from a clean data directory
+        if data_path.exists():
+            print("Removing existing data directory...")
+            shutil.rmtree(data_path)
+        manifest.reset_splits()
+        manifest.set_setting("split", settings)
 
     data_path.mkdir(exist_ok=True)
 
-    classes = [d.name for d in source_path.iterdir() if d.is_dir()]
-    print(f"Found classes: {classes}")
+    classes = {}
+    for row in manifest.split_rows():
+        classes.setdefault(row["class"], []).append(row)
+    print(f"Found classes: {sorted(classes)}")
+
+    for cls, rows in classes.items():
+        live = [row for row in rows if not row["missing"] and row["valid"]]
+        stale = [row for row in rows if row["missing"] or not row["valid"]]
+        if not stale and all(row["split"] and row["linked"] for row in live):
+            continue
+
+        # Drop links for files that were removed or became unreadable
+        for row in stale:
+            link = split_dirs[row["split"]] / cls / row["name"]
+            if link.exists() or link.is_symlink():
+                link.unlink()
+        manifest.purge([row["relpath"] for row in stale if row["missing"]])
+        manifest.clear_links([row["relpath"] for row in stale if not row["missing"]])
+
+        if not live:
+            # Classes deleted from the dataset disappear from the split too
+            for split_dir in split_dirs.values():
+                if (split_dir / cls).exists():
+                    shutil.rmtree(split_dir / cls)
+            print(f"Class {cls}: removed")
+            continue
 
-    for cls in classes:
         # Create class folders in train and val
         (train_dir / cls).mkdir(parents=True, exist_ok=True)
         (val_dir / cls).mkdir(parents=True, exist_ok=True)
-        
-        # Get all images for the class
-        cls_path = source_path / cls
-        images = [f for f in cls_path.iterdir() if f.is_file() and f.suffix.lower() in ['.jpg', '.jpeg', '.png']]
-        random.shuffle(images)
-        
-        split_idx = int(len(images) * train_ratio)
-        train_imgs = images[:split_idx]
-        val_imgs = images[split_idx:]
-        
-        # Copy images
-        for img in train_imgs:
-            shutil.copy2(img, train_dir / cls / img.name)
-            
-        for img in val_imgs:
-            shutil.copy2(img, val_dir / cls / img.name)
-            
-        print(f"Class {cls}: {len(train_imgs)} train, {len(val_imgs)} val")
+
+        # Replaced files keep their side; new files fill val up to its share
+        relink = [row for row in live if row["split"] and not row["linked"]]
+        new_images = [row for row in live if not row["split"]]
+        random.shuffle(new_images)
+        val_target = len(live) - int(len(live) * train_ratio)
+        val_count = sum(1 for row in live if row["split"] == "val")
+
+        assignments = []
+        for row in relink + new_images:
+            split = row["split"]
+            if split is None:
+                split = "val" if val_count < val_target else "train"
+                if split == "val":
+                    val_count += 1
+            materialize(source_path / cls / row["name"], split_dirs[split] / cls / row["name"], mode)
+            assignments.append((row["relpath"], split))
+        manifest.record_links(assignments)
+
+        train_count = len(live) - val_count
+        print(f"Class {cls}: {train_count} train, {val_count} val ({len(new_images)} new)")
 
 if __name__ == "__main__":
     split_dataset("dataset")
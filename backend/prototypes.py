@@ -0,0 +1,328 @@
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from ultralytics import YOLO
+
+from file_utils import file_lock
+
+# auto: answer with a prototype-only class when an image is nearest to one; off: head only
+PROTOTYPE_MODE = os.environ.get("PROTOTYPE_MODE", "auto").lower()
+# Softmax temperature over cosine similarities
+PROTOTYPE_TEMPERATURE = float(os.environ.get("PROTOTYPE_TEMPERATURE", 0.05))
+# Images embedded per class (sampled with a per-class seed)
+PROTOTYPE_MAX_IMAGES = int(os.environ.get("PROTOTYPE_MAX_IMAGES", 100))
+PROTOTYPE_BATCH = 32
+# Model versions whose prototypes are kept, so switching back (e.g. a
+# rollback) only re-embeds classes whose images changed since
+PROTOTYPE_KEEP_BACKBONES = int(os.environ.get("PROTOTYPE_KEEP_BACKBONES", 3))
+
+
+def head_linear(model):
+    """Final Linear layer of a YOLO classifier's head; None for exported runtimes (ONNX, OpenVINO)"""
+    try:
+        predictor = model.predictor
+        net = predictor.model.model if predictor is not None else model.model
+        return net.model[-1].linear
+    except (AttributeError, IndexError, TypeError):
+        return None
+
+
+@contextmanager
+def capture_features(model):
+    """Collect the pooled backbone features of every forward pass of `model` inside the block.
+
+    A forward pre-hook on the head's final Linear layer captures its input,
+    so images go through the regular ultralytics preprocessing exactly as
+    they do for prediction. Yields a list that receives one array per
+    forward pass; it stays empty when the model can't be hooked.
+    """
+    captured = []
+    linear = head_linear(model)
+    if linear is None:
+        yield captured
+        return
+    handle = linear.register_forward_pre_hook(
+        lambda module, inputs: captured.append(inputs[0].detach().float().cpu().numpy())
+    )
+    try:
+        yield captured
+    finally:
+        handle.remove()
+
+
+def normalize(features):
+    return features / np.maximum(np.linalg.norm(features, axis=-1, keepdims=True), 1e-12)
+
+
+class Embedder:
+    """Pre-classifier features of a YOLO classification model (see capture_features)"""
+
+    def __init__(self, weights):
+        self.model = YOLO(str(weights))
+        self._lock = threading.Lock()
+
+    def embed(self, images, batch=PROTOTYPE_BATCH):
+        """L2-normalized feature vectors, one row per image (path or BGR array)"""
+        with self._lock:
+            if self.model.predictor is None:
+                self.model(images[:1], verbose=False) # sets up the predictor
+            with capture_features(self.model) as captured:
+                for start in range(0, len(images), batch):
+                    self.model(images[start:start + batch], verbose=False)
+        return normalize(np.concatenate(captured))
+
+
+class PrototypeIndex:
+    """Per-class mean embeddings of dataset/<class>/ images.
+
+    Lets classes that are not in the model's head yet be predicted by
+    nearest class mean, seconds after their images are added. Prototypes
+    belong to one backbone (model version). The sets of the last
+    PROTOTYPE_KEEP_BACKBONES versions are kept, each with per-class image
+    signatures, so activating a version again only re-embeds classes whose
+    images changed since; a version never seen before is built from scratch.
+    The index is saved to disk and re-read when another process updates it;
+    builds hold a file lock, so when every worker asks for the same classes
+    at once only the first embeds them. Classes, image lists and signatures
+    come from the dataset manifest, not from listing dataset/.
+    """
+
+    def __init__(self, path, manifest, weights_for, on_change=None, check_interval=1.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self.manifest = manifest
+        self.weights_for = weights_for  # backbone version -> weights path
+        self.on_change = on_change
+        self.check_interval = check_interval
+        self.backbone = None
+        self.classes = []
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.signatures = {}  # class -> [image count, newest mtime_ns]
+        self._stored = {}  # backbone -> (classes, vectors, signatures), most recently used first
+        self._embedder = None  # (backbone, Embedder)
+        self._file_signature = None
+        self._checked_at = 0.0
+        self._lock = threading.RLock()
+        self._executor = None
+        self._executor_pid = None
+        self._load(accept_any_backbone=True)
+
+    # --- Persistence ---
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _load(self, accept_any_backbone=False):
+        """Read every stored set; returns True if the current backbone's set was loaded"""
+        with self._lock:
+            self._file_signature = self._stat()
+            if self._file_signature is None:
+                return False
+            try:
+                with np.load(self.path, allow_pickle=False) as data:
+                    meta = json.loads(str(data['meta']))
+                    if 'sets' in meta:
+                        stored = {entry['backbone']: (entry['classes'], data[f"vectors_{i}"], entry['signatures'])
+                                  for i, entry in enumerate(meta['sets'])}
+                    else: # single-backbone file written before sets were kept
+                        stored = {meta['backbone']: (meta['classes'], data['vectors'], meta['signatures'])}
+            except Exception as e:
+                print(f"Ignoring unreadable prototype index: {e}")
+                return False
+            self._stored = stored
+            if accept_any_backbone and self.backbone is None and stored:
+                self.backbone = next(iter(stored))
+            return self._activate_stored()
+
+    def _activate_stored(self):
+        # Caller holds the lock
+        if self.backbone not in self._stored:
+            return False
+        self.classes, self.vectors, self.signatures = self._stored[self.backbone]
+        return True
+
+    def _save(self):
+        # Caller holds the lock
+        self._stored = {self.backbone: (self.classes, self.vectors, self.signatures),
+                        **{b: entry for b, entry in self._stored.items() if b != self.backbone}}
+        kept = list(self._stored.items())[:max(1, PROTOTYPE_KEEP_BACKBONES)]
+        self._stored = dict(kept)
+        meta = {'sets': [{'backbone': b, 'classes': classes, 'signatures': signatures}
+                         for b, (classes, _, signatures) in kept]}
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, meta=np.array(json.dumps(meta)),
+                     **{f"vectors_{i}": vectors for i, (_, (_, vectors, _)) in enumerate(kept)})
+        os.replace(tmp_path, self.path)
+        self._file_signature = self._stat()
+
+    def poll(self):
+        """Pick up prototypes saved by another process (stat at most once per interval)"""
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        if self._stat() != self._file_signature and self._load():
+            self._changed()
+
+    def _changed(self):
+        if self.on_change:
+            self.on_change()
+
+    # --- Building ---
+
+    def set_backbone(self, backbone):
+        """Model version whose features the prototypes must come from"""
+        with self._lock:
+            if backbone == self.backbone:
+                return
+            self.backbone = backbone
+            self._embedder = None
+            if not self._activate_stored():
+                self.classes, self.signatures = [], {}
+                self.vectors = np.zeros((0, 0), dtype=np.float32)
+            # Another process may already have (re)built them for this version
+            if self._stat() != self._file_signature:
+                self._load()
+        self._changed()
+
+    def _get_embedder(self):
+        with self._lock:
+            backbone = self.backbone
+            if self._embedder is None or self._embedder[0] != backbone:
+                self._embedder = (backbone, Embedder(self.weights_for(backbone)))
+            return self._embedder
+
+    def dataset_classes(self):
+        return list(self.manifest.classes())
+
+    def _class_images(self, cls):
+        return [self.manifest.dataset_dir / relpath for relpath in self.manifest.images(cls)]
+
+    def update(self, classes=None):
+        """(Re)build prototypes of `classes` (default: every dataset class) whose images changed"""
+        with file_lock(self.lock_path):
+            # Start from whatever another process built while we waited
+            if self._stat() != self._file_signature and self._load():
+                self._changed()
+            return self._update(classes)
+
+    def _update(self, classes):
+        started = time.time()
+        backbone, embedder = self.backbone, None
+        built = {}
+        current = self.manifest.class_signatures()
+        for cls in classes or current:
+            signature = current.get(cls)
+            if signature is None:
+                continue
+            with self._lock:
+                if self.signatures.get(cls) == signature and cls in self.classes:
+                    continue
+            images = self._class_images(cls)
+            if not images:
+                continue
+            if len(images) > PROTOTYPE_MAX_IMAGES:
+                images = random.Random(cls).sample(images, PROTOTYPE_MAX_IMAGES)
+            if embedder is None: # loaded only once something needs embedding
+                backbone, embedder = self._get_embedder()
+            built[cls] = (normalize(embedder.embed([str(p) for p in images]).mean(axis=0)), signature)
+
+        with self._lock:
+            if backbone != self.backbone:
+                return 0 # the model changed while we were embedding
+            present = set(current)
+            vectors = {cls: self.vectors[i] for i, cls in enumerate(self.classes) if cls in present}
+            signatures = {cls: sig for cls, sig in self.signatures.items() if cls in present}
+            for cls, (vector, signature) in built.items():
+                vectors[cls], signatures[cls] = vector, signature
+            if not built and len(vectors) == len(self.classes):
+                return 0
+            self.classes = sorted(vectors)
+            self.signatures = signatures
+            self.vectors = np.stack([vectors[cls] for cls in self.classes]).astype(np.float32) \
+                if self.classes else np.zeros((0, 0), dtype=np.float32)
+            self._save()
+        print(f"Prototypes: built {len(built)} classes in {time.time() - started:.1f}s ({len(self.classes)} total)")
+        self._changed()
+        return len(built)
+
+    def update_async(self, classes=None):
+        """update() on a background thread (one per process, created after any fork)"""
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prototypes")
+            self._executor_pid = os.getpid()
+
+        def run():
+            try:
+                self.update(classes)
+            except Exception as e:
+                print(f"Prototype update failed: {e}")
+        return self._executor.submit(run)
+
+    def remove_class(self, cls):
+        """Forget a deleted class in every stored set"""
+        with file_lock(self.lock_path), self._lock:
+            if self._stat() != self._file_signature:
+                self._load()
+            if self.backbone is not None:
+                self._stored[self.backbone] = (self.classes, self.vectors, self.signatures)
+            if not any(cls in classes for classes, _, _ in self._stored.values()):
+                return
+            for backbone, (classes, vectors, signatures) in list(self._stored.items()):
+                keep = [i for i, name in enumerate(classes) if name != cls]
+                self._stored[backbone] = ([classes[i] for i in keep], vectors[keep],
+                                          {name: sig for name, sig in signatures.items() if name != cls})
+            self._activate_stored()
+            self._save()
+        self._changed()
+
+    # --- Prediction ---
+
+    def classes_outside(self, head_classes):
+        """Classes with prototypes that the model head cannot predict"""
+        self.poll()
+        return [cls for cls in self.classes if cls not in head_classes]
+
+    def classify(self, image, top_k=5):
+        """classify_embedding() of an image, embedded with the backbone's own weights.
+
+        Costs a forward pass of its own; prefer features captured during
+        the prediction's forward pass where the serving model allows it.
+        """
+        if not self.classes:
+            return []
+        backbone, embedder = self._get_embedder()
+        return self.classify_embedding(embedder.embed([image])[0], backbone, top_k)
+
+    def classify_embedding(self, features, backbone, top_k=5):
+        """[(class, probability)] by cosine similarity to each prototype, best first.
+
+        `features` are the pre-classifier features of an image under model
+        version `backbone`; nothing is returned if the prototypes belong to
+        another version.
+        """
+        with self._lock:
+            if backbone != self.backbone:
+                return []
+            classes, vectors = list(self.classes), self.vectors
+        if not classes:
+            return []
+        similarities = vectors @ normalize(np.asarray(features, dtype=np.float32))
+        logits = similarities / PROTOTYPE_TEMPERATURE
+        probs = np.exp(logits - logits.max())
+        probs /= probs.sum()
+        order = np.argsort(-probs)[:top_k]
+        return [(classes[i], float(probs[i])) for i in order]
@@ -0,0 +1,109 @@
+import os
+import shutil
+import threading
+from pathlib import Path
+
+from PIL import Image, ImageOps, features
+
+from file_utils import file_digest
+
+# Requested sizes are rounded up to one of these, so the cache stays bounded
+THUMBNAIL_SIZES = [int(s) for s in os.environ.get("THUMBNAIL_SIZES", "128,256,512").split(",")]
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", 80))
+
+
+class ThumbnailCache:
+    """On-demand thumbnails of dataset images, cached on disk.
+
+    Thumbnails are stored per class as `<content hash>_<size>.<ext>`, so a
+    changed source file simply maps to a new name and identical images
+    share one thumbnail. Source hashes come from the dataset manifest when
+    its row still matches the file's size and mtime; otherwise the file is
+    hashed and memoized by identity (size, mtime, inode) until it changes.
+    """
+
+    def __init__(self, root, source_dir, manifest=None, sizes=THUMBNAIL_SIZES, quality=THUMBNAIL_QUALITY):
+        self.root = Path(root)
+        self.source_dir = Path(source_dir)
+        self.manifest = manifest
+        self.sizes = sorted(sizes)
+        self.quality = quality
+        self.format, self.extension, self.mimetype = (
+            ('WEBP', '.webp', 'image/webp') if features.check('webp') else ('JPEG', '.jpg', 'image/jpeg')
+        )
+        self._digests = {}  # relative path -> (signature, content hash)
+        self._lock = threading.Lock()
+
+    def size_for(self, requested):
+        """Smallest cached size at least `requested` (the largest if none is)"""
+        for size in self.sizes:
+            if size >= requested:
+                return size
+        return self.sizes[-1]
+
+    def source_path(self, relpath):
+        """Absolute path of a dataset image, refusing anything outside the dataset"""
+        path = (self.source_dir / relpath).resolve()
+        if self.source_dir.resolve() not in path.parents or not path.is_file():
+            raise FileNotFoundError(relpath)
+        return path
+
+    def digest(self, relpath):
+        """Content hash of a dataset image, re-hashed only if the file changed"""
+        path = self.source_path(relpath)
+        stat = path.stat()
+        signature = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        with self._lock:
+            entry = self._digests.get(relpath)
+        if entry and entry[0] == signature:
+            return entry[1]
+        row = self.manifest.get(relpath) if self.manifest is not None else None
+        if row and row['digest'] and (row['size'], row['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+            digest = row['digest']
+        else:
+            digest = file_digest(path)
+        with self._lock:
+            previous = self._digests.get(relpath)
+            self._digests[relpath] = (signature, digest)
+        if previous and previous[1] != digest:
+            self._discard(relpath, previous[1])
+        return digest
+
+    def _class_dir(self, relpath):
+        return self.root / Path(relpath).parent
+
+    def _discard(self, relpath, digest):
+        # The source changed; its old thumbnails can't be requested by content any more
+        for stale in self._class_dir(relpath).glob(f"{digest}_*"):
+            try:
+                stale.unlink()
+            except OSError:
+                pass
+
+    def get(self, relpath, requested_size):
+        """Return (thumbnail path, content hash, size), generating the thumbnail if needed"""
+        size = self.size_for(requested_size)
+        digest = self.digest(relpath)
+        target = self._class_dir(relpath) / f"{digest}_{size}{self.extension}"
+        if not target.exists():
+            self._render(self.source_path(relpath), target, size)
+        return target, digest, size
+
+    def _render(self, source, target, size):
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with Image.open(source) as image:
+            # Let the JPEG decoder skip straight to a nearby scale
+            image.draft('RGB', (size, size))
+            image = ImageOps.exif_transpose(image)
+            image = image.convert('RGB')
+            image.thumbnail((size, size), Image.LANCZOS)
+            tmp_path = target.with_name(f".{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            image.save(tmp_path, self.format, quality=self.quality)
+        os.replace(tmp_path, target)
+
+    def remove_class(self, class_name):
+        """Drop every cached thumbnail of a class"""
+        shutil.rmtree(self.root / class_name, ignore_errors=True)
+        with self._lock:
+            for relpath in [p for p in self._digests if Path(p).parent.name == class_name]:
+                del self._digests[relpath]
@@ -0,0 +1,18 @@
+"""Dedicated training process, so web workers only serve predictions.
+
+Run alongside gunicorn (the Dockerfile and Procfile do); gunicorn.conf.py
+keeps training out of the web workers (TRAINING_IN_WEB_WORKERS=false):
+
+    python train_worker.py
+"""
+import os
+
+os.environ["DEFER_BACKGROUND_WORKERS"] = "true"
+
+import app
+
+if __name__ == '__main__':
+    app.run_exclusive("dedup-sync", app.sync_dedup_index)
+    app.start_metrics_export()
+    print("Training worker waiting for jobs...")
+    app.job_queue.run_worker(app.run_training_workflow)
@@ -0,0 +1,177 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import torch
+
+from file_utils import available_cpus
+
+# Cores this container may use (affinity and cgroup quota), not the host's
+CPU_COUNT = available_cpus()
+
+# Server-side defaults; /train/start can override each of them per job
+TRAIN_EPOCHS = int(os.environ.get("TRAIN_EPOCHS", 20))
+TRAIN_IMGSZ = int(os.environ.get("TRAIN_IMGSZ", 224))
+TRAIN_BATCH = os.environ.get("TRAIN_BATCH", "auto") # a number or "auto"
+TRAIN_WORKERS = int(os.environ.get("TRAIN_WORKERS", min(4, max(1, CPU_COUNT // 2))))
+# torch threads while a job trains; the remaining cores keep serving predictions
+TRAIN_THREADS = int(os.environ.get("TRAIN_THREADS", max(1, CPU_COUNT // 2)))
+TRAIN_TIME_BUDGET = float(os.environ.get("TRAIN_TIME_BUDGET_MINUTES", 0)) # 0: no limit
+# Stop after this many epochs without a validation top-1 improvement (0: never)
+TRAIN_PATIENCE = int(os.environ.get("TRAIN_PATIENCE", 5))
+
+# Accepted range of every option: (type, min, max)
+OPTIONS = {
+    'epochs': (int, 1, 300),
+    'imgsz': (int, 32, 640),
+    'batch': (int, 1, 256),
+    'workers': (int, 0, 32),
+    'threads': (int, 1, CPU_COUNT),
+    'time_budget': (float, 0, 24 * 60),
+    'patience': (int, 0, 300)
+}
+
+# Auto-batch: rough training memory of one yolov8n-cls sample at 224px
+AUTO_BATCH_BYTES_PER_IMAGE = 24 * 1024 * 1024
+AUTO_BATCH_MEMORY_FRACTION = 0.25
+AUTO_BATCH_RANGE = (8, 64)
+
+
+def default_config():
+    return {
+        'epochs': TRAIN_EPOCHS,
+        'imgsz': TRAIN_IMGSZ,
+        'batch': TRAIN_BATCH if TRAIN_BATCH == 'auto' else int(TRAIN_BATCH),
+        'workers': TRAIN_WORKERS,
+        'threads': TRAIN_THREADS,
+        'time_budget': TRAIN_TIME_BUDGET,
+        'patience': TRAIN_PATIENCE
+    }
+
+
+def parse_training_config(options):
+    """Validate the `config` object of a /train/start request.
+
+    Returns the overrides as canonical JSON (None if there are none), so
+    jobs asking for the same settings compare equal. Raises ValueError.
+    """
+    if options is None:
+        return None
+    if not isinstance(options, dict):
+        raise ValueError("config must be an object")
+    overrides = {}
+    for key, value in options.items():
+        if key not in OPTIONS:
+            raise ValueError(f"Unknown training option '{key}' (expected one of {', '.join(OPTIONS)})")
+        if key == 'batch' and value == 'auto':
+            overrides[key] = value
+            continue
+        kind, low, high = OPTIONS[key]
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or (kind is int and value != int(value)):
+            raise ValueError(f"{key} must be {'an integer' if kind is int else 'a number'}")
+        if not low <= value <= high:
+            raise ValueError(f"{key} must be between {low} and {high}")
+        if key == 'imgsz' and value % 32:
+            raise ValueError("imgsz must be a multiple of 32")
+        overrides[key] = kind(value)
+    return json.dumps(overrides, sort_keys=True) if overrides else None
+
+
+def resolve_config(overrides):
+    """Defaults merged with a job's overrides (a dict or None), with "auto" batch worked out"""
+    config = {**default_config(), **(overrides or {})}
+    if config['batch'] == 'auto':
+        config['batch'] = cpu_auto_batch(config['imgsz'])
+    return config
+
+
+def available_memory():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024 ** 3
+
+
+def cpu_auto_batch(imgsz):
+    """Batch size for CPU training.
+
+    Ultralytics' autobatch only measures CUDA memory. On CPU, larger
+    batches barely raise throughput but cost memory that the serving
+    workers need, so take the largest power of two whose estimated
+    footprint fits a fraction of free RAM, within AUTO_BATCH_RANGE.
+    """
+    per_image = AUTO_BATCH_BYTES_PER_IMAGE * (imgsz / 224) ** 2
+    fits = int(available_memory() * AUTO_BATCH_MEMORY_FRACTION / per_image)
+    low, high = AUTO_BATCH_RANGE
+    batch = low
+    while batch * 2 <= min(fits, high):
+        batch *= 2
+    return batch
+
+
+class EarlyStopping:
+    """Trainer callbacks that end a job's run early.
+
+    Stops when validation top-1 hasn't improved for `patience` epochs, or
+    when another epoch would take the job past `time_budget` minutes
+    (counted from construction, so a fallback run shares the budget).
+    Setting trainer.stop in on_fit_epoch_end ends training after the
+    current epoch, with best.pt already saved.
+    """
+
+    def __init__(self, patience, time_budget):
+        self.patience = patience
+        self.budget = time_budget * 60
+        self.started = time.time()
+        self.stopped = None
+        self._run_started = None
+        self._best = None
+        self._stale_epochs = 0
+
+    def callbacks(self):
+        return {
+            'on_train_start': self.on_train_start,
+            'on_fit_epoch_end': self.on_fit_epoch_end
+        }
+
+    def on_train_start(self, trainer):
+        self._run_started = time.time()
+        self._best = None
+        self._stale_epochs = 0
+
+    def on_fit_epoch_end(self, trainer):
+        epoch = trainer.epoch + 1
+        top1 = (trainer.metrics or {}).get('metrics/accuracy_top1')
+        if top1 is not None:
+            if self._best is None or top1 > self._best:
+                self._best, self._stale_epochs = top1, 0
+            else:
+                self._stale_epochs += 1
+
+        reason = None
+        if self.patience and self._stale_epochs >= self.patience:
+            reason = f"no top-1 improvement for {self.patience} epochs"
+        elif self.budget:
+            per_epoch = (time.time() - self._run_started) / epoch
+            if time.time() - self.started + per_epoch > self.budget:
+                reason = f"time budget of {self.budget / 60:g} minutes"
+        if reason and epoch < trainer.epochs:
+            print(f"Stopping training after epoch {epoch}/{trainer.epochs}: {reason}")
+            self.stopped = {'epoch': epoch, 'epochs': trainer.epochs, 'reason': reason}
+            trainer.stop = True
+
+
+@contextmanager
+def torch_threads(threads):
+    """Limit torch intra-op threads while training, then restore them.
+
+    The setting is per process: in a web worker it also applies to
+    predictions served while the job runs.
+    """
+    previous = torch.get_num_threads()
+    torch.set_num_threads(threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous)
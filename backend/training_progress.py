@@ -0,0 +1,69 @@
+import time
+
+
+def _number(value):
+    try:
+        return round(float(value), 4)
+    except (TypeError, ValueError):
+        return None
+
+
+class EpochReporter:
+    """Trainer callback that reports loss, top-1, epoch time and ETA after every epoch.
+
+    `on_epoch(entry, history)` is called with the metrics of the epoch that
+    just finished and the list of all epochs reported so far. One reporter
+    can follow several runs (e.g. an incremental run and its fallback);
+    `phase` tags which run an entry belongs to.
+    """
+
+    def __init__(self, on_epoch):
+        self.on_epoch = on_epoch
+        self.history = []
+        self.phase = None
+        self._phase_epochs = []
+        self._epoch_started = None
+
+    def callbacks(self, phase):
+        """Callbacks for YOLO.add_callback, for a run called `phase`"""
+        self.phase = phase
+        self._phase_epochs = []
+        return {
+            'on_train_epoch_start': self.on_train_epoch_start,
+            'on_fit_epoch_end': self.on_fit_epoch_end
+        }
+
+    def on_train_epoch_start(self, trainer):
+        self._epoch_started = time.time()
+
+    def on_fit_epoch_end(self, trainer):
+        # on_fit_epoch_end runs after validation, so the epoch time includes it
+        epoch_time = getattr(trainer, 'epoch_time', None)
+        if self._epoch_started is not None:
+            epoch_time = time.time() - self._epoch_started
+        self._phase_epochs.append(epoch_time or 0.0)
+
+        epoch, epochs = trainer.epoch + 1, trainer.epochs
+        metrics = trainer.metrics or {}
+        loss = None
+        if getattr(trainer, 'tloss', None) is not None:
+            loss = trainer.label_loss_items(trainer.tloss, prefix='train').get('train/loss')
+        average = sum(self._phase_epochs) / len(self._phase_epochs)
+
+        entry = {
+            'phase': self.phase,
+            'epoch': epoch,
+            'epochs': epochs,
+            'loss': _number(loss),
+            'val_loss': _number(metrics.get('val/loss')),
+            'top1': _number(metrics.get('metrics/accuracy_top1')),
+            'top5': _number(metrics.get('metrics/accuracy_top5')),
+            'epoch_time': _number(epoch_time),
+            'eta_seconds': _number(average * max(0, epochs - epoch))
+        }
+        self.history.append(entry)
+        try:
+            self.on_epoch(entry, self.history)
+        except Exception as e:
+            # Never let progress reporting break a training run
+            print(f"Could not report epoch progress: {e}")
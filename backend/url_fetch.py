@@ -0,0 +1,89 @@
+import os
+import time
+from collections import namedtuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from download_images import HEADERS
+
+URL_FETCH_MAX_BYTES = int(float(os.environ.get("URL_FETCH_MAX_MB", 10)) * 1024 * 1024)
+URL_CONNECT_TIMEOUT = float(os.environ.get("URL_CONNECT_TIMEOUT", 3.05))
+URL_READ_TIMEOUT = float(os.environ.get("URL_READ_TIMEOUT", 5))
+# Whole download, however slowly the server trickles bytes
+URL_FETCH_DEADLINE = float(os.environ.get("URL_FETCH_DEADLINE", 10))
+URL_FETCH_POOL_SIZE = int(os.environ.get("URL_FETCH_POOL_SIZE", 32))
+CHUNK_SIZE = 64 * 1024
+# Some image hosts and CDNs label images as generic binary
+GENERIC_CONTENT_TYPES = ['application/octet-stream', 'binary/octet-stream']
+
+# body is None when the server answered 304 Not Modified
+FetchResult = namedtuple('FetchResult', ['body', 'validators'])
+
+
+class UrlFetchError(ValueError):
+    """The URL did not return a usable image body"""
+
+
+class UrlFetcher:
+    """Pooled, streaming image downloads for URL predictions.
+
+    One keep-alive session is shared by every request thread. Bodies are
+    streamed into memory and abandoned as soon as they exceed the byte
+    cap, the overall deadline passes, or the content type is not an image.
+    Passing the validators of an earlier download makes the request
+    conditional, so an unchanged image is not downloaded again.
+    """
+
+    def __init__(self, max_bytes=URL_FETCH_MAX_BYTES, connect_timeout=URL_CONNECT_TIMEOUT,
+                 read_timeout=URL_READ_TIMEOUT, deadline=URL_FETCH_DEADLINE, pool_size=URL_FETCH_POOL_SIZE):
+        self.max_bytes = max_bytes
+        self.timeout = (connect_timeout, read_timeout)
+        self.deadline = deadline
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update(HEADERS)
+
+    def fetch(self, url, validators=None):
+        """Download `url`; returns a FetchResult (body None if `validators` are still current)"""
+        if urlparse(url).scheme not in ('http', 'https'):
+            raise UrlFetchError("Only http(s) URLs are supported")
+
+        headers = {}
+        if validators:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+        deadline = time.monotonic() + self.deadline
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+            if response.status_code == 304 and headers:
+                return FetchResult(None, validators)
+            response.raise_for_status()
+
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if content_type and not content_type.startswith('image/') and content_type not in GENERIC_CONTENT_TYPES:
+                raise UrlFetchError(f"URL is not an image (Content-Type: {content_type})")
+            declared = response.headers.get('Content-Length')
+            if declared and declared.isdigit() and int(declared) > self.max_bytes:
+                raise UrlFetchError(f"Image too large ({declared} bytes)")
+
+            body = bytearray()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                body += chunk
+                if len(body) > self.max_bytes:
+                    raise UrlFetchError(f"Image larger than {self.max_bytes} bytes")
+                if time.monotonic() > deadline:
+                    raise UrlFetchError(f"Download took longer than {self.deadline}s")
+            if not body:
+                raise UrlFetchError("Empty response")
+
+            validators = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')
+            }
+            return FetchResult(body, validators if any(validators.values()) else None)
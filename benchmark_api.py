@@ -0,0 +1,372 @@
+"""Offline load test for the backend's /predict endpoints.
+
+Starts the backend locally (gunicorn, as in backend/Dockerfile, unless
+--server-cmd or --base-url says otherwise) and serves the bundled data/
+and test_download/ images from a local HTTP server, so URL predictions
+never leave the machine. Each scenario runs at every concurrency level;
+latencies, a latency histogram, throughput and the prediction cache hit
+ratio are written to a JSON file tagged with the current git commit.
+
+The bundled images are few enough that every one is cached after the
+warm-up, so the backend's prediction cache is off unless --cache is given.
+
+    python benchmark_api.py --concurrency 1,4,16 --duration 20
+    python benchmark_api.py --scenarios upload --workers 4
+    python benchmark_api.py --cache
+    python benchmark_api.py --compare benchmark_results/a.json benchmark_results/b.json
+"""
+import argparse
+import functools
+import http.server
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import requests
+
+ROOT = Path(__file__).resolve().parent
+BACKEND_DIR = ROOT / "backend"
+IMAGE_DIRS = [ROOT / "data", ROOT / "test_download"]
+RESULTS_DIR = ROOT / "benchmark_results"
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+SCENARIOS = ['upload', 'url', 'batch']
+# Upper bounds (ms) of the latency histogram buckets
+HISTOGRAM_BUCKETS_MS = [5, 10, 25, 50, 75, 100, 150, 250, 500, 750, 1000, 2500, 5000, 10000]
+# How often a started backend exports its metrics, and how long to wait before
+# reading the cache counters so every worker's latest values are included
+METRICS_EXPORT_INTERVAL_S = 1.0
+METRICS_SETTLE_S = 1.5
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def git_info():
+    def git(*args):
+        try:
+            return subprocess.check_output(['git', *args], cwd=ROOT, stderr=subprocess.DEVNULL, text=True).strip()
+        except Exception:
+            return None
+    return {
+        'commit': git('rev-parse', 'HEAD'),
+        'subject': git('log', '-1', '--format=%s'),
+        'dirty': bool(git('status', '--porcelain', '--untracked-files=no'))
+    }
+
+
+def find_images():
+    images = []
+    for image_dir in IMAGE_DIRS:
+        for path in sorted(image_dir.rglob('*')):
+            if path.suffix.lower() in IMAGE_EXTENSIONS:
+                images.append(path)
+    return images
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_image_server(port):
+    """Serve the repo root so bundled images are reachable as http://127.0.0.1:<port>/data/..."""
+    handler = functools.partial(QuietHandler, directory=str(ROOT))
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, name="image-server", daemon=True).start()
+    return server
+
+
+def start_backend(server_cmd, port, env_overrides, log_path):
+    env = {**os.environ, 'PORT': str(port), **env_overrides}
+    log = open(log_path, 'w')
+    process = subprocess.Popen(server_cmd.format(port=port), shell=True, cwd=BACKEND_DIR, env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+    return process, log
+
+
+def wait_until_ready(base_url, process=None, timeout=180):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Backend exited with code {process.returncode}")
+        try:
+            if requests.get(f"{base_url}/predict/cache", timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"Backend at {base_url} did not become ready in {timeout}s")
+
+
+def cache_counters(base_url):
+    """(hits, misses) of the prediction cache summed over all workers, or None"""
+    time.sleep(METRICS_SETTLE_S)
+    counters = {}
+    try:
+        for line in requests.get(f"{base_url}/metrics", timeout=5).text.splitlines():
+            name, _, value = line.partition(' ')
+            if name in ('leaf_prediction_cache_hits_total', 'leaf_prediction_cache_misses_total'):
+                counters[name] = float(value)
+    except (requests.RequestException, ValueError):
+        return None
+    if len(counters) != 2:
+        return None
+    return counters['leaf_prediction_cache_hits_total'], counters['leaf_prediction_cache_misses_total']
+
+
+def cache_usage(before, after):
+    if before is None or after is None:
+        return None
+    hits, misses = after[0] - before[0], after[1] - before[1]
+    lookups = hits + misses
+    return {'hits': int(hits), 'misses': int(misses), 'hit_ratio': round(hits / lookups, 4) if lookups else None}
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(q / 100 * (len(sorted_values) - 1))))
+    return round(sorted_values[index], 2)
+
+
+def histogram(latencies_ms):
+    counts = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+    for value in latencies_ms:
+        for i, bound in enumerate(HISTOGRAM_BUCKETS_MS):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+    labels = [f"<={bound}" for bound in HISTOGRAM_BUCKETS_MS] + [f">{HISTOGRAM_BUCKETS_MS[-1]}"]
+    return dict(zip(labels, counts))
+
+
+def make_request(scenario, images, image_server_url, batch_size):
+    """Build the kwargs of one /predict-style request"""
+    if scenario == 'upload':
+        path = random.choice(images)
+        return 'predict', {'files': {'file': (path.name, path.read_bytes())}}
+    if scenario == 'url':
+        path = random.choice(images)
+        return 'predict', {'json': {'url': f"{image_server_url}/{path.relative_to(ROOT).as_posix()}"}}
+    chosen = random.sample(images, min(batch_size, len(images)))
+    return 'predict/batch', {'json': {'urls': [f"{image_server_url}/{p.relative_to(ROOT).as_posix()}" for p in chosen]}}
+
+
+def run_load(base_url, scenario, concurrency, duration, warmup, images, image_server_url, batch_size):
+    """Drive `concurrency` closed-loop clients for `duration` seconds"""
+    local = threading.local()
+
+    def session():
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return local.session
+
+    def one_request():
+        endpoint, kwargs = make_request(scenario, images, image_server_url, batch_size)
+        started = time.perf_counter()
+        try:
+            response = session().post(f"{base_url}/{endpoint}", timeout=60, **kwargs)
+            body = response.content # read streamed batch responses to the end
+            ok = response.status_code == 200 and (scenario != 'batch' or b'"error"' not in body)
+            status = response.status_code
+        except requests.RequestException as e:
+            ok, status = False, type(e).__name__
+        return (time.perf_counter() - started) * 1000, ok, status
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda _: one_request(), range(warmup)))
+        cache_before = cache_counters(base_url)
+
+        latencies, errors = [], {}
+        errors_lock = threading.Lock()
+        stop_at = time.perf_counter() + duration
+
+        def client():
+            while time.perf_counter() < stop_at:
+                latency, ok, status = one_request()
+                if ok:
+                    latencies.append(latency)
+                else:
+                    with errors_lock:
+                        errors[str(status)] = errors.get(str(status), 0) + 1
+
+        started = time.perf_counter()
+        for future in [pool.submit(client) for _ in range(concurrency)]:
+            future.result()
+        elapsed = time.perf_counter() - started
+    cache = cache_usage(cache_before, cache_counters(base_url))
+
+    latencies.sort()
+    requests_ok = len(latencies)
+    images_per_request = batch_size if scenario == 'batch' else 1
+    return {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'duration_s': round(elapsed, 2),
+        'requests': requests_ok + sum(errors.values()),
+        'errors': errors,
+        'throughput_rps': round(requests_ok / elapsed, 2),
+        'throughput_ips': round(requests_ok * images_per_request / elapsed, 2),
+        'latency_ms': {
+            'mean': round(sum(latencies) / requests_ok, 2) if requests_ok else None,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': round(latencies[-1], 2) if latencies else None
+        },
+        'histogram_ms': histogram(latencies),
+        # Cache lookups during the measured window (not the warm-up)
+        'cache': cache
+    }
+
+
+def print_run(run):
+    latency = run['latency_ms']
+    cache = run.get('cache') or {}
+    hit_ratio = 'n/a' if cache.get('hit_ratio') is None else f"{cache['hit_ratio']:.0%}"
+    print(f"{run['scenario']:>7} c={run['concurrency']:<3} {run['throughput_rps']:>8.2f} req/s "
+          f"p50 {latency['p50']}ms p95 {latency['p95']}ms p99 {latency['p99']}ms "
+          f"cache hits {hit_ratio} errors {sum(run['errors'].values())}")
+
+
+def compare(baseline_path, candidate_path):
+    """Print p50/p95/p99 and throughput changes between two result files"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(candidate_path) as f:
+        candidate = json.load(f)
+    print(f"baseline:  {baseline['git']['commit'][:10]} {baseline['git']['subject']}")
+    print(f"candidate: {candidate['git']['commit'][:10]} {candidate['git']['subject']}\n")
+
+    def change(old, new):
+        if not old or new is None:
+            return "    n/a"
+        return f"{(new - old) / old * 100:+6.1f}%"
+
+    old_runs = {(r['scenario'], r['concurrency']): r for r in baseline['runs']}
+    print(f"{'scenario':>8} {'conc':>4} {'req/s':>16} {'p50':>16} {'p95':>16} {'p99':>16}")
+    for run in candidate['runs']:
+        old = old_runs.get((run['scenario'], run['concurrency']))
+        if old is None:
+            continue
+        cells = [f"{run['throughput_rps']:>8.1f} {change(old['throughput_rps'], run['throughput_rps'])}"]
+        for q in ['p50', 'p95', 'p99']:
+            cells.append(f"{run['latency_ms'][q] or 0:>8.1f} {change(old['latency_ms'][q], run['latency_ms'][q])}")
+        print(f"{run['scenario']:>8} {run['concurrency']:>4} " + " ".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default='upload,url', help=f"comma-separated, from {','.join(SCENARIOS)}")
+    parser.add_argument('--concurrency', default='1,4,16', help="comma-separated client counts")
+    parser.add_argument('--duration', type=float, default=15, help="seconds per scenario and concurrency level")
+    parser.add_argument('--warmup', type=int, default=10, help="requests sent before measuring")
+    parser.add_argument('--batch-size', type=int, default=8, help="URLs per /predict/batch request")
+    parser.add_argument('--cache', action='store_true',
+                        help="keep the backend prediction cache on (measures cache hits, not the model)")
+    parser.add_argument('--workers', type=int, help="backend worker processes (WEB_CONCURRENCY)")
+    parser.add_argument('--server-cmd', default="gunicorn -c gunicorn.conf.py --bind 127.0.0.1:{port} app:app",
+                        help="command that starts the backend from backend/ ({port} is substituted)")
+    parser.add_argument('--base-url', help="benchmark an already running backend instead of starting one")
+    parser.add_argument('--output', help="result file (default benchmark_results/<time>_<commit>.json)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CANDIDATE'), help="compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    levels = [int(c) for c in args.concurrency.split(',')]
+    random.seed(args.seed)
+
+    images = find_images()
+    if not images:
+        sys.exit(f"No images found under {', '.join(str(d) for d in IMAGE_DIRS)}")
+
+    image_server = start_image_server(free_port())
+    image_server_url = f"http://127.0.0.1:{image_server.server_address[1]}"
+
+    process, log = None, None
+    env_overrides = {'METRICS_EXPORT_INTERVAL': str(METRICS_EXPORT_INTERVAL_S)}
+    if not args.cache:
+        env_overrides['PREDICTION_CACHE_MAX_MB'] = '0'
+    if args.workers:
+        env_overrides['WEB_CONCURRENCY'] = str(args.workers)
+    base_url = args.base_url
+    if base_url is None:
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        RESULTS_DIR.mkdir(exist_ok=True)
+        log_path = RESULTS_DIR / "backend.log"
+        print(f"Starting backend: {args.server_cmd.format(port=port)} (log: {log_path})")
+        process, log = start_backend(args.server_cmd, port, env_overrides, log_path)
+
+    runs = []
+    try:
+        wait_until_ready(base_url, process)
+        for scenario in scenarios:
+            for concurrency in levels:
+                run = run_load(base_url, scenario, concurrency, args.duration, args.warmup,
+                               images, image_server_url, args.batch_size)
+                print_run(run)
+                runs.append(run)
+        server_cache = requests.get(f"{base_url}/predict/cache", timeout=5).json()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+            log.close()
+        image_server.shutdown()
+
+    git = git_info()
+    output = Path(args.output) if args.output else \
+        RESULTS_DIR / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{(git['commit'] or 'nogit')[:10]}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'git': git,
+            'config': {
+                'scenarios': scenarios,
+                'concurrency': levels,
+                'duration_s': args.duration,
+                'warmup': args.warmup,
+                'batch_size': args.batch_size,
+                'cache': None if args.base_url else args.cache,
+                'workers': args.workers,
+                'server_cmd': None if args.base_url else args.server_cmd,
+                'images': len(images)
+            },
+            'machine': {
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'cpu_count': os.cpu_count()
+            },
+            'server_cache': server_cache,
+            'runs': runs
+        }, f, indent=2)
+    print(f"\nSaved results to {output}")
+
+
+if __name__ == '__main__':
+    main()
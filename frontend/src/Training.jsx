@@ -1,5 +1,5 @@
 import { Link } from 'react-router-dom'
-import { useState, useEffect } from 'react'
+import { useState, useEffect, useRef } from 'react'
 import config from './config'
 
 function Training() {
@@ -14,19 +14,47 @@ function Training() {
     const [selectedFiles, setSelectedFiles] = useState([])
     const [uploadingFiles, setUploadingFiles] = useState(false)
     const [imageCount, setImageCount] = useState('')
+    const [jobId, setJobId] = useState(null)
+    const [progress, setProgress] = useState(0)
+    const [lastEpoch, setLastEpoch] = useState(null)
+    const [previewTarget, setPreviewTarget] = useState(0)
+    const previewAbort = useRef(null)
 
     useEffect(() => {
         // Fetch trained labels on mount
         fetchTrainedLabels();
+        // Leaving the page closes a running preview stream, which stops its downloads
+        return () => previewAbort.current?.abort();
     }, []);
 
+    const isRunning = status !== 'idle' && status !== 'completed' && status !== 'error';
+
     useEffect(() => {
-        let interval;
-        if (status !== 'idle' && status !== 'completed' && status !== 'error') {
-            interval = setInterval(checkStatus, 2000);
-        }
-        return () => clearInterval(interval);
-    }, [status]);
+        // Subscribe to pushed status updates while a job is queued or running
+        if (!isRunning) return;
+        const query = jobId ? `?job_id=${jobId}` : '';
+        const source = new EventSource(`${config.API_URL}/train/events${query}`);
+        source.addEventListener('status', (event) => {
+            const data = JSON.parse(event.data);
+            applyStatus(data);
+            if (data.status === 'completed' || data.status === 'error') {
+                source.close();
+            }
+        });
+        let poll = null;
+        source.onerror = () => {
+            // The browser reconnects on its own unless the server refused the
+            // stream (e.g. 503 when too many are open): then poll instead
+            if (source.readyState === EventSource.CLOSED && !poll) {
+                checkStatus();
+                poll = setInterval(checkStatus, 3000);
+            }
+        };
+        return () => {
+            source.close();
+            clearInterval(poll);
+        };
+    }, [isRunning, jobId]);
 
     const fetchTrainedLabels = async () => {
         try {
@@ -38,57 +66,105 @@ function Training() {
         }
     }
 
+    const applyStatus = (data) => {
+        setStatus(data.status);
+        setMessage(data.message);
+        setProgress(data.progress || 0);
+        const epochs = data.epochs || [];
+        setLastEpoch(epochs.length ? epochs[epochs.length - 1] : null);
+
+        // Reset preview state when training completes
+        if (data.status === 'completed') {
+            if (data.result) {
+                setTrainingResult(data.result);
+            }
+            setShowPreview(false);
+            setPreviewImages([]);
+            // Refresh trained labels list
+            fetchTrainedLabels();
+        }
+    }
+
     const checkStatus = async () => {
         try {
-            const res = await fetch(`${config.API_URL}/train/status`);
-            const data = await res.json();
-            setStatus(data.status);
-            setMessage(data.message);
-
-            // Reset preview state when training completes
-            if (data.status === 'completed') {
-                if (data.result) {
-                    setTrainingResult(data.result);
-                }
-                setShowPreview(false);
-                setPreviewImages([]);
-                // Refresh trained labels list
-                fetchTrainedLabels();
-            }
+            const query = jobId ? `?job_id=${jobId}` : '';
+            const res = await fetch(`${config.API_URL}/train/status${query}`);
+            applyStatus(await res.json());
         } catch (error) {
-            console.error("Polling error", error);
+            console.error("Status error", error);
         }
     }
 
+    const formatDuration = (seconds) => {
+        if (seconds == null) return '';
+        const s = Math.round(seconds);
+        return s >= 60 ? `${Math.floor(s / 60)}m ${s % 60}s` : `${s}s`;
+    }
+
     const handlePreview = async () => {
-        setLoadingPreview(true);
         const count = parseInt(imageCount);
         if (!count || count < 5) {
             alert("Please enter a valid number of images (at least 5)");
-            setLoadingPreview(false);
             return;
         }
+        setLoadingPreview(true);
+        setPreviewImages([]);
+        setPreviewTarget(count);
+        const controller = new AbortController();
+        previewAbort.current = controller;
         try {
             const res = await fetch(`${config.API_URL}/train/preview`, {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: { 'Content-Type': 'application/json', 'Accept': 'application/x-ndjson' },
                 body: JSON.stringify({
                     leaf_name: leafName,
-                    max_images: count
-                })
+                    max_images: count,
+                    stream: true
+                }),
+                signal: controller.signal
             });
 
-            if (res.ok) {
-                const data = await res.json();
-                setPreviewImages(data.images);
-                setShowPreview(true);
-            } else {
+            if (!res.ok) {
                 const data = await res.json();
                 alert(data.error || 'Failed to fetch preview images');
+                return;
+            }
+
+            // One NDJSON line per image as soon as it is saved; the last
+            // line lists every image the class now has
+            setShowPreview(true);
+            const reader = res.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
+                for (const line of lines) {
+                    if (!line.trim()) continue;
+                    const event = JSON.parse(line);
+                    if (event.type === 'image') {
+                        setPreviewImages(prev => [...prev, event.thumbnail || event.image]);
+                    } else if (event.type === 'done') {
+                        setPreviewImages(event.thumbnails || event.images);
+                    } else if (event.type === 'error') {
+                        // The download failed: show why and stop reading (the server cancels the rest)
+                        alert(event.error || 'Failed to fetch preview images');
+                        await reader.cancel();
+                        return;
+                    }
+                }
             }
         } catch (error) {
-            alert("Failed to load preview images");
+            if (error.name !== 'AbortError') {
+                alert("Failed to load preview images");
+            }
         } finally {
+            if (previewAbort.current === controller) {
+                previewAbort.current = null;
+            }
             setLoadingPreview(false);
         }
     }
@@ -123,10 +199,11 @@ function Training() {
 
             if (res.ok) {
                 const data = await res.json();
-                setPreviewImages(data.images);
+                setPreviewImages(data.thumbnails || data.images);
                 setShowPreview(true);
                 setSelectedFiles([]);
-                alert(`Successfully uploaded ${data.count} images!`);
+                const skipped = (data.rejected || []).length;
+                alert(`Successfully uploaded ${data.count} images!` + (skipped ? ` ${skipped} file(s) were not valid images and were skipped.` : ''));
             } else {
                 const data = await res.json();
                 alert(data.error || 'Failed to upload images');
@@ -146,8 +223,10 @@ function Training() {
                 body: JSON.stringify({ leaf_name: leafName })
             });
             if (res.ok) {
-                setStatus('starting');
-                setMessage('Starting process...');
+                const data = await res.json();
+                setJobId(data.job_id);
+                setStatus(data.status || 'queued');
+                setMessage(data.message || 'Starting process...');
                 setShowPreview(false);
             } else {
                 const data = await res.json();
@@ -186,13 +265,18 @@ function Training() {
     }
 
     const handleCancel = () => {
+        // Closing the stream cancels the downloads still running on the server
+        previewAbort.current?.abort();
         setShowPreview(false);
         setPreviewImages([]);
     }
 
     const handleReset = () => {
+        setJobId(null);
         setStatus('idle');
         setMessage('');
+        setProgress(0);
+        setLastEpoch(null);
         setLeafName('');
         setShowPreview(false);
         setPreviewImages([]);
@@ -221,7 +305,11 @@ function Training() {
                     <div className="space-y-6">
                         <div className="bg-blue-50/50 border border-blue-200 rounded-xl p-4">
                             <h2 className="text-lg font-bold text-blue-900 mb-2">Preview: {leafName}</h2>
-                            <p className="text-sm text-blue-700">Found {previewImages.length} images. Review them below and confirm to start training.</p>
+                            <p className="text-sm text-blue-700">
+                                {loadingPreview
+                                    ? `Downloading... ${previewImages.length} of ${previewTarget} images so far.`
+                                    : `Found ${previewImages.length} images. Review them below and confirm to start training.`}
+                            </p>
                         </div>
 
                         {/* Image Gallery */}
@@ -231,6 +319,8 @@ function Training() {
                                     <img
                                         src={`${config.API_URL}${imgUrl}`}
                                         alt={`Preview ${idx + 1}`}
+                                        loading="lazy"
+                                        decoding="async"
                                         className="w-full h-full object-cover"
                                         onError={(e) => {
                                             e.target.style.display = 'none';
@@ -250,7 +340,8 @@ function Training() {
                             </button>
                             <button
                                 onClick={handleStartTraining}
-                                className="flex-1 bg-blue-600 hover:bg-blue-700 text-white font-bold py-3 px-4 rounded-xl shadow-lg shadow-blue-500/30 transition-all active:scale-95"
+                                disabled={loadingPreview}
+                                className="flex-1 bg-blue-600 hover:bg-blue-700 disabled:bg-slate-300 disabled:shadow-none disabled:cursor-not-allowed text-white font-bold py-3 px-4 rounded-xl shadow-lg shadow-blue-500/30 transition-all active:scale-95"
                             >
                                 Confirm & Start Training
                             </button>
@@ -471,6 +562,32 @@ function Training() {
                             {message}
                         </p>
 
+                        <div className="mt-6 max-w-xs mx-auto h-2 bg-slate-100 rounded-full overflow-hidden">
+                            <div className="h-full bg-blue-500 transition-all duration-500" style={{ width: `${Math.round(progress * 100)}%` }}></div>
+                        </div>
+
+                        {status === 'training' && lastEpoch && (
+                            <div className="mt-4 grid grid-cols-3 gap-3 max-w-sm mx-auto text-sm">
+                                <div className="bg-slate-50 rounded-lg p-2">
+                                    <div className="text-slate-400 text-xs">Loss</div>
+                                    <div className="font-semibold text-slate-700">{lastEpoch.loss != null ? lastEpoch.loss.toFixed(3) : '-'}</div>
+                                </div>
+                                <div className="bg-slate-50 rounded-lg p-2">
+                                    <div className="text-slate-400 text-xs">Top-1</div>
+                                    <div className="font-semibold text-slate-700">{lastEpoch.top1 != null ? `${(lastEpoch.top1 * 100).toFixed(1)}%` : '-'}</div>
+                                </div>
+                                <div className="bg-slate-50 rounded-lg p-2">
+                                    <div className="text-slate-400 text-xs">ETA</div>
+                                    <div className="font-semibold text-slate-700">{formatDuration(lastEpoch.eta_seconds)}</div>
+                                </div>
+                            </div>
+                        )}
+                        {status === 'training' && lastEpoch && (
+                            <p className="mt-2 text-xs text-slate-400">
+                                Epoch {lastEpoch.epoch}/{lastEpoch.epochs} · {formatDuration(lastEpoch.epoch_time)} per epoch
+                            </p>
+                        )}
+
                         <div className="mt-8 flex justify-center gap-2">
                             <span className={`h-2 w-2 rounded-full ${['downloading', 'preparing', 'training', 'finalizing'].includes(status) ? 'bg-blue-500' : 'bg-slate-200'}`}></span>
                             <span className={`h-2 w-2 rounded-full ${['preparing', 'training', 'finalizing'].includes(status) ? 'bg-blue-500' : 'bg-slate-200'}`}></span>